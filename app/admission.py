@@ -0,0 +1,102 @@
+"""Control de admisión de ejecuciones del agente: tope global, cola acotada con timeout y un turno por hilo."""
+import asyncio
+import os
+import time
+
+from app import metrics, tracing
+
+MAX_CONCURRENT_RUNS = int(os.getenv("MAX_CONCURRENT_RUNS", 8))
+MAX_QUEUED_RUNS = int(os.getenv("MAX_QUEUED_RUNS", 32))
+ADMISSION_TIMEOUT = float(os.getenv("ADMISSION_TIMEOUT", 20))
+
+wait_seconds = metrics.histogram("admission_wait_seconds", "Espera hasta obtener turno de hilo y plaza global")
+rejected_queue_full = metrics.counter("admission_rejected_queue_full_total", "Peticiones rechazadas con la cola llena")
+rejected_timeout = metrics.counter("admission_rejected_timeout_total", "Peticiones rechazadas por esperar demasiado")
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """Plaza concedida; `release` es idempotente para poder llamarla desde varios caminos de salida."""
+
+    def __init__(self, controller: "AdmissionController", thread_id: str):
+        self._controller = controller
+        self._thread_id = thread_id
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(self._thread_id)
+
+
+class AdmissionController:
+    """Limita las ejecuciones simultáneas del agente y serializa los turnos de una misma conversación.
+
+    Primero se toma el candado del hilo y después la plaza global, así una petición que espera a un turno
+    anterior de su misma conversación no ocupa una plaza. Las que esperan (por cualquiera de los dos) cuentan
+    para la cola: si ya hay `max_queue` esperando se rechaza al momento, y si no se obtiene turno en `timeout`
+    segundos también.
+    """
+
+    def __init__(self, max_in_flight: int = MAX_CONCURRENT_RUNS, max_queue: int = MAX_QUEUED_RUNS,
+                 timeout: float = ADMISSION_TIMEOUT):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._threads: dict[str, list] = {}  # thread_id -> [Lock, peticiones que lo usan]
+        metrics.gauge("admission_in_flight", "Ejecuciones del agente en curso", fn=lambda: self.in_flight)
+        metrics.gauge("admission_queue_depth", "Peticiones esperando turno", fn=lambda: self.waiting)
+
+    def _thread_lock(self, thread_id: str) -> asyncio.Lock:
+        entry = self._threads.setdefault(thread_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        return entry[0]
+
+    def _forget_thread(self, thread_id: str):
+        entry = self._threads[thread_id]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._threads[thread_id]
+
+    async def acquire(self, thread_id: str) -> Ticket:
+        busy = self._slots.locked() or (thread_id in self._threads and self._threads[thread_id][0].locked())
+        if busy and self.waiting >= self.max_queue:
+            rejected_queue_full.inc()
+            raise AdmissionRejected("queue_full", retry_after=self.timeout)
+
+        lock = self._thread_lock(thread_id)
+        start = time.perf_counter()
+        self.waiting += 1
+        have_lock = False
+        try:
+            await asyncio.wait_for(lock.acquire(), self.timeout)
+            have_lock = True
+            await asyncio.wait_for(self._slots.acquire(), max(0.0, self.timeout - (time.perf_counter() - start)))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if have_lock:
+                lock.release()
+            self._forget_thread(thread_id)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            rejected_timeout.inc()
+            raise AdmissionRejected("timeout", retry_after=self.timeout) from None
+        finally:
+            self.waiting -= 1
+        tracing.observe("admission_wait", time.perf_counter() - start, wait_seconds)
+        self.in_flight += 1
+        return Ticket(self, thread_id)
+
+    def _release(self, thread_id: str):
+        self.in_flight -= 1
+        self._slots.release()
+        self._threads[thread_id][0].release()
+        self._forget_thread(thread_id)
@@ -0,0 +1,212 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from app import metrics, tracing
+
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Clave canónica de una consulta: minúsculas, espacios colapsados y sin signos de interrogación/exclamación."""
+    return _SPACES_RE.sub(" ", query.lower()).strip(" ¿?¡!.")
+
+
+class TTLCache:
+    """Caché LRU acotada en tamaño, con caducidad por entrada y contadores de aciertos/fallos."""
+
+    def __init__(self, maxsize: int = 256, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """Cachea los embeddings de consultas (por consulta normalizada); los documentos pasan sin cachear."""
+
+    def __init__(self, underlying: Embeddings, cache: TTLCache):
+        self.underlying = underlying
+        self.cache = cache
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.underlying.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        key = normalize_query(text)
+        vector = self.cache.get(key)
+        if vector is None:
+            with tracing.span("embedding"):
+                vector = self.underlying.embed_query(text)
+            self.cache.set(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        key = normalize_query(text)
+        vector = self.cache.get(key)
+        if vector is None:
+            with tracing.span("embedding"):
+                vector = await self.underlying.aembed_query(text)
+            self.cache.set(key, vector)
+        return vector
+
+
+def _unit(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SemanticAnswerCache:
+    """Respuestas completas a preguntas que abren un hilo, buscadas por similitud coseno de su embedding.
+
+    Cada entrada guarda cuánto tardó la ejecución original del agente, que es lo que se ahorra en cada acierto.
+    Las respuestas dependen de una huella (versión del índice, prompt de sistema, modelo): si la huella con la
+    que se consulta o guarda cambia, la caché se vacía entera. Además cada entrada tiene un ámbito (p. ej. las
+    CCAA y cifras de la pregunta) y solo se compara con preguntas del mismo ámbito: "alquiler en Madrid" y
+    "alquiler en Valencia" pueden superar el umbral de similitud pero nunca comparten respuesta.
+    Acotada a `maxsize` entradas por orden de uso.
+    """
+
+    def __init__(self, maxsize: int = 256, threshold: float = 0.95):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.fingerprint = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.saved_seconds = 0.0
+        self._entries: OrderedDict[int, dict] = OrderedDict()
+        self._matrix = None  # vectores de las entradas apilados, se recalcula al cambiar las entradas
+        self._keys = []
+        self._scopes = []
+        self._next_key = 0
+        self._lock = threading.Lock()
+
+    def _check_fingerprint(self, fingerprint):
+        if fingerprint != self.fingerprint:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._matrix = None
+            self.fingerprint = fingerprint
+
+    def _nearest(self, vector: np.ndarray, scope) -> tuple[int | None, float]:
+        if not self._entries:
+            return None, 0.0
+        if self._matrix is None:
+            self._keys = list(self._entries)
+            self._scopes = [self._entries[k]["scope"] for k in self._keys]
+            self._matrix = np.stack([self._entries[k]["vector"] for k in self._keys])
+        scores = np.where([s == scope for s in self._scopes], self._matrix @ vector, -np.inf)
+        best = int(np.argmax(scores))
+        if scores[best] == -np.inf:
+            return None, 0.0
+        return self._keys[best], float(scores[best])
+
+    def lookup(self, vector, fingerprint, scope=None) -> str | None:
+        vector = _unit(vector)
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            key, score = self._nearest(vector, scope)
+            if key is None or score < self.threshold:
+                self.misses += 1
+                return None
+            entry = self._entries[key]
+            entry["hits"] += 1
+            entry["saved_seconds"] += entry["latency"]
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += entry["latency"]
+            return entry["answer"]
+
+    def store(self, question: str, vector, answer: str, latency: float, fingerprint, scope=None):
+        vector = _unit(vector)
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            key, score = self._nearest(vector, scope)
+            if key is not None and score >= self.threshold:
+                return  # otra petición casi idéntica ya la guardó
+            self._entries[self._next_key] = {"question": question, "vector": vector, "scope": scope, "answer": answer,
+                                             "latency": latency, "hits": 0, "saved_seconds": 0.0}
+            self._next_key += 1
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._matrix = None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def stats(self, top: int = 10) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            entries = sorted(self._entries.values(), key=lambda e: e["hits"], reverse=True)[:top]
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / total if total else 0.0,
+                "saved_seconds": round(self.saved_seconds, 3),
+                "top_entries": [{"question": e["question"], "hits": e["hits"], "latency_s": round(e["latency"], 3),
+                                 "saved_s": round(e["saved_seconds"], 3)} for e in entries],
+            }
+
+
+def register_cache_metrics(name: str, cache):
+    """Exporta los contadores de una caché (TTLCache o SemanticAnswerCache) como métricas `<name>_cache_*`."""
+    metrics.counter(f"{name}_cache_hits_total", f"Aciertos de la caché {name}", fn=lambda: cache.hits)
+    metrics.counter(f"{name}_cache_misses_total", f"Fallos de la caché {name}", fn=lambda: cache.misses)
+    metrics.counter(f"{name}_cache_evictions_total", f"Entradas expulsadas de la caché {name}",
+                    fn=lambda: cache.evictions)
+    metrics.gauge(f"{name}_cache_size", f"Entradas en la caché {name}", fn=lambda: cache.stats()["size"])
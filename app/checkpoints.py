@@ -0,0 +1,186 @@
+"""Persistencia de checkpoints de LangGraph en SQLite: WAL, pool de lectura, retención por hilo y caducidad de hilos."""
+import asyncio
+import os
+import time
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+
+import aiosqlite
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+from app import metrics, tracing
+from app.logging_config import logger
+
+CHECKPOINT_DB_PATH = os.getenv("CHECKPOINT_DB_PATH", "db/chatbot_memory.db")
+CHECKPOINT_KEEP_LAST = int(os.getenv("CHECKPOINT_KEEP_LAST", 10))
+CHECKPOINT_READ_POOL = int(os.getenv("CHECKPOINT_READ_POOL", 3))
+THREAD_TTL_SECONDS = float(os.getenv("THREAD_TTL_SECONDS", 24 * 3600))
+SWEEP_INTERVAL_SECONDS = float(os.getenv("SWEEP_INTERVAL_SECONDS", 600))
+
+write_seconds = metrics.histogram("checkpoint_write_seconds", "Latencia de aput/aput_writes")
+pruned_total = metrics.counter("checkpoints_pruned_total", "Checkpoints antiguos eliminados por retención")
+expired_total = metrics.counter("threads_expired_total", "Hilos eliminados por inactividad")
+deleted_total = metrics.counter("threads_deleted_total", "Hilos eliminados (goodbye o caducidad)")
+
+
+def db_size_bytes(path: str) -> int:
+    """Tamaño en disco de la base de datos, incluido el fichero WAL."""
+    return sum(os.path.getsize(p) for p in (path, f"{path}-wal") if os.path.exists(p))
+
+
+class PooledSqliteSaver(AsyncSqliteSaver):
+    """AsyncSqliteSaver que escribe por la conexión principal y reparte las lecturas entre un pool de conexiones.
+
+    En modo WAL los lectores no esperan al escritor, así que `aget_tuple`/`alist` de unas conversaciones no
+    hacen cola detrás de las escrituras de otras. Cada `aput` registra la actividad del hilo y, cada
+    `keep_last` escrituras, borra los checkpoints (y sus writes) anteriores a los `keep_last` más recientes.
+    """
+
+    def __init__(self, conn: aiosqlite.Connection, *, keep_last: int = CHECKPOINT_KEEP_LAST, **kwargs):
+        super().__init__(conn, **kwargs)
+        self.keep_last = keep_last
+        self._readers: asyncio.Queue[AsyncSqliteSaver] = asyncio.Queue()
+        self._pool_size = 0
+        self._puts_since_prune: dict[tuple[str, str], int] = {}
+
+    @classmethod
+    @asynccontextmanager
+    async def open(cls, path: str = CHECKPOINT_DB_PATH, *, pool_size: int = CHECKPOINT_READ_POOL,
+                   keep_last: int = CHECKPOINT_KEEP_LAST) -> AsyncIterator["PooledSqliteSaver"]:
+        conn = await aiosqlite.connect(path)
+        saver = cls(conn, keep_last=keep_last)
+        readers = []
+        try:
+            await saver.setup()
+            for _ in range(pool_size):
+                reader_conn = await aiosqlite.connect(path)
+                await reader_conn.execute("PRAGMA query_only=ON")
+                reader = AsyncSqliteSaver(reader_conn, serde=saver.serde)
+                reader.is_setup = True
+                readers.append(reader)
+                saver._readers.put_nowait(reader)
+            saver._pool_size = len(readers)
+            metrics.gauge("checkpoint_db_size_bytes", "Tamaño de la base de datos de checkpoints",
+                          fn=lambda: db_size_bytes(path))
+            yield saver
+        finally:
+            for reader in readers:
+                await reader.conn.close()
+            await conn.close()
+
+    async def setup(self) -> None:
+        if self.is_setup:
+            return
+        # auto_vacuum solo tiene efecto en una base de datos nueva, antes de crear las tablas
+        await self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await super().setup()
+        async with self.lock:
+            await self.conn.executescript(
+                """
+                PRAGMA synchronous=NORMAL;
+                PRAGMA busy_timeout=5000;
+                CREATE TABLE IF NOT EXISTS thread_activity (
+                    thread_id TEXT PRIMARY KEY,
+                    last_seen REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS thread_activity_last_seen ON thread_activity (last_seen);
+                """
+            )
+            # Hilos anteriores a esta tabla: cuentan como activos desde ahora
+            await self.conn.execute(
+                "INSERT OR IGNORE INTO thread_activity SELECT DISTINCT thread_id, ? FROM checkpoints", (time.time(),))
+            await self.conn.commit()
+
+    @asynccontextmanager
+    async def _reader(self) -> AsyncIterator[AsyncSqliteSaver]:
+        if not self._pool_size:
+            yield super()
+            return
+        reader = await self._readers.get()
+        try:
+            yield reader
+        finally:
+            self._readers.put_nowait(reader)
+
+    async def aget_tuple(self, config):
+        async with self._reader() as reader:
+            return await reader.aget_tuple(config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        async with self._reader() as reader:
+            async for item in reader.alist(config, filter=filter, before=before, limit=limit):
+                yield item
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        start = time.perf_counter()
+        next_config = await super().aput(config, checkpoint, metadata, new_versions)
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        key = (thread_id, checkpoint_ns)
+        self._puts_since_prune[key] = self._puts_since_prune.get(key, 0) + 1
+        async with self.lock:
+            await self.conn.execute(
+                "INSERT INTO thread_activity (thread_id, last_seen) VALUES (?, ?) "
+                "ON CONFLICT(thread_id) DO UPDATE SET last_seen = excluded.last_seen", (thread_id, time.time()))
+            if self.keep_last and self._puts_since_prune[key] >= self.keep_last:
+                self._puts_since_prune[key] = 0
+                await self._prune(thread_id, checkpoint_ns)
+            await self.conn.commit()
+        tracing.observe("checkpoint_write", time.perf_counter() - start, write_seconds)
+        return next_config
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        with tracing.span("checkpoint_write", write_seconds):
+            await super().aput_writes(config, writes, task_id, task_path)
+
+    async def _prune(self, thread_id: str, checkpoint_ns: str) -> int:
+        """Borra lo anterior a los `keep_last` checkpoints más recientes del hilo (los ids uuid6 ordenan por tiempo)."""
+        async with self.conn.execute(
+            "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+            "ORDER BY checkpoint_id DESC LIMIT 1 OFFSET ?", (thread_id, checkpoint_ns, self.keep_last - 1)
+        ) as cur:
+            row = await cur.fetchone()
+        if row is None:
+            return 0
+        params = (thread_id, checkpoint_ns, row[0])
+        await self.conn.execute(
+            "DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?", params)
+        cur = await self.conn.execute(
+            "DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?", params)
+        pruned_total.inc(cur.rowcount)
+        return cur.rowcount
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await super().adelete_thread(thread_id)
+        async with self.lock:
+            await self.conn.execute("DELETE FROM thread_activity WHERE thread_id = ?", (str(thread_id),))
+            await self.conn.commit()
+        self._puts_since_prune = {k: v for k, v in self._puts_since_prune.items() if k[0] != str(thread_id)}
+        deleted_total.inc()
+
+    async def sweep_idle_threads(self, ttl: float = THREAD_TTL_SECONDS) -> int:
+        """Elimina los hilos sin actividad en `ttl` segundos y devuelve cuántos."""
+        async with self.lock, self.conn.execute(
+            "SELECT thread_id FROM thread_activity WHERE last_seen < ?", (time.time() - ttl,)
+        ) as cur:
+            thread_ids = [row[0] for row in await cur.fetchall()]
+        for thread_id in thread_ids:
+            await self.adelete_thread(thread_id)
+        if thread_ids:
+            expired_total.inc(len(thread_ids))
+            async with self.lock:
+                # Devuelven filas: hay que recorrerlas para que el pragma se ejecute entero
+                for pragma in ("PRAGMA incremental_vacuum", "PRAGMA wal_checkpoint(TRUNCATE)"):
+                    async with self.conn.execute(pragma) as cur:
+                        await cur.fetchall()
+        return len(thread_ids)
+
+    async def run_sweeper(self, interval: float = SWEEP_INTERVAL_SECONDS, ttl: float = THREAD_TTL_SECONDS):
+        while True:
+            try:
+                expired = await self.sweep_idle_threads(ttl)
+                if expired:
+                    logger.info("Checkpoint sweeper removed %d idle threads.", expired)
+            except Exception as e:
+                logger.warning("Checkpoint sweeper failed: %s", e)
+            await asyncio.sleep(interval)
@@ -0,0 +1,145 @@
+"""Ensamblado del contexto que devuelve regional_tax_deductions_details.
+
+Los chunks recuperados se agrupan por subapartado, los contiguos o solapados (CHUNK_OVERLAP) se vuelven a unir,
+el prefijo [CCAA][Categoría][Subapartado] se escribe una vez por grupo y el resultado se recorta a un
+presupuesto de tokens medido con el mismo tokenizer que la ingesta.
+"""
+import json
+import os
+import threading
+
+from langchain.docstore.document import Document
+
+from app import metrics
+from app.logging_config import logger
+from ingest.chunking import CHUNK_INDEX_KEY, TOKENIZER_NAME, build_prefijo
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1200))
+MIN_OVERLAP_CHARS = 16
+MIN_TRUNCATED_TOKENS = 32
+GAP = "\n[...]\n"
+
+context_tokens = metrics.histogram("context_tokens", "Tokens del contexto devuelto por la herramienta de detalles",
+                                   buckets=(100, 250, 500, 750, 1000, 1500, 2000, 3000, 5000))
+context_tokens_saved = metrics.counter("context_tokens_saved_total",
+                                       "Tokens ahorrados frente a concatenar los chunks tal cual")
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def _get_tokenizer():
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            try:
+                from transformers import AutoTokenizer
+                _tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_NAME)
+            except Exception as e:
+                logger.warning("Tokenizer %s unavailable, counting ~4 chars per token: %s", TOKENIZER_NAME, e)
+                _tokenizer = False
+        return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    tokenizer = _get_tokenizer()
+    if not tokenizer:
+        return (len(text) + 3) // 4
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Los primeros `max_tokens` tokens de `text`, cortando por el último espacio para no partir palabras."""
+    tokenizer = _get_tokenizer()
+    if not tokenizer:
+        cut = text[:max_tokens * 4]
+    else:
+        encoding = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        offsets = encoding["offset_mapping"]
+        if len(offsets) <= max_tokens:
+            return text
+        cut = text[:offsets[max_tokens - 1][1]]
+    if len(cut) >= len(text):
+        return text
+    return cut.rsplit(" ", 1)[0].rstrip() + " …"
+
+
+def merge_overlapping(previous: str, following: str) -> str:
+    """Une dos chunks consecutivos quitando el texto repetido por el solapamiento (sufijo de uno = prefijo del otro)."""
+    anchor = following[:MIN_OVERLAP_CHARS]
+    start = previous.find(anchor) if len(anchor) == MIN_OVERLAP_CHARS else -1
+    while start != -1:
+        if following.startswith(previous[start:]):
+            return previous + following[len(previous) - start:]
+        start = previous.find(anchor, start + 1)
+    return f"{previous}\n{following}"
+
+
+def _prefijo(metadata: dict) -> str:
+    return build_prefijo(metadata) if "ccaa" in metadata and "categoria" in metadata else ""
+
+
+def _body(doc: Document) -> str:
+    prefijo = _prefijo(doc.metadata)
+    content = doc.page_content
+    return content[len(prefijo):].lstrip("\n") if prefijo and content.startswith(prefijo) else content
+
+
+def _group_key(metadata: dict) -> str:
+    return json.dumps({k: v for k, v in metadata.items() if k != CHUNK_INDEX_KEY}, ensure_ascii=False, sort_keys=True)
+
+
+def group_chunks(docs: list[Document]) -> list[tuple[str, list[str]]]:
+    """(prefijo, tramos de texto) por subapartado, en el orden en que aparece cada uno en el ranking."""
+    groups: dict[str, list[Document]] = {}
+    for doc in docs:
+        groups.setdefault(_group_key(doc.metadata), []).append(doc)
+
+    result = []
+    for members in groups.values():
+        has_index = all(CHUNK_INDEX_KEY in d.metadata for d in members)
+        if has_index:
+            members = sorted(members, key=lambda d: d.metadata[CHUNK_INDEX_KEY])
+        segments, last_index = [], None
+        for doc in members:
+            body = _body(doc)
+            index = doc.metadata.get(CHUNK_INDEX_KEY) if has_index else None
+            if segments and index is not None and index == last_index:
+                continue  # el mismo chunk repetido
+            if segments and index is not None and index == last_index + 1:
+                segments[-1] = merge_overlapping(segments[-1], body)
+            elif body not in segments:
+                segments.append(body)
+            last_index = index
+        prefijo = _prefijo(members[0].metadata)
+        result.append((prefijo, segments))
+    return result
+
+
+def assemble_context(docs: list[Document], budget: int = CONTEXT_TOKEN_BUDGET) -> tuple[str, dict]:
+    """Texto para el LLM y un informe con los tokens antes/después del ensamblado."""
+    raw = "\n\n".join(f"* {doc.page_content}" for doc in docs)
+    blocks = []
+    used = 0
+    truncated = False
+    for prefijo, segments in group_chunks(docs):
+        block = f"* {prefijo}\n" + GAP.join(segments) if prefijo else "* " + GAP.join(segments)
+        tokens = count_tokens(block) + (1 if blocks else 0)  # + el separador entre bloques
+        remaining = budget - used
+        if tokens > remaining:
+            truncated = True
+            if remaining >= MIN_TRUNCATED_TOKENS:
+                blocks.append(truncate_to_tokens(block, remaining - 1))
+            break
+        blocks.append(block)
+        used += tokens
+    text = "\n\n".join(blocks)
+    report = {"chunks": len(docs), "groups": len(blocks), "raw_tokens": count_tokens(raw),
+              "tokens": count_tokens(text), "truncated": truncated}
+    report["saved_tokens"] = report["raw_tokens"] - report["tokens"]
+    context_tokens.observe(report["tokens"])
+    context_tokens_saved.inc(max(0, report["saved_tokens"]))
+    logger.info("Context assembled: %d chunks -> %d groups, %d -> %d tokens (saved %d%s).", report["chunks"],
+                report["groups"], report["raw_tokens"], report["tokens"], report["saved_tokens"],
+                ", truncated" if truncated else "")
+    return text, report
@@ -0,0 +1,145 @@
+"""Atajo determinista para las preguntas que solo piden el listado de deducciones de una o varias CCAA.
+
+Se responde directamente desde DEDUCCIONES_POR_CCAA, sin pasar por el LLM. Todo lo que no encaje con seguridad
+(otra intención, un tema concreto, una CCAA desconocida o dudosa) sigue hacia el agente.
+"""
+import difflib
+import os
+import re
+import threading
+import unicodedata
+
+from app import metrics
+
+ROUTER_ENABLED = os.getenv("INTENT_ROUTER", "1") == "1"
+FUZZY_CUTOFF = float(os.getenv("INTENT_ROUTER_FUZZY_CUTOFF", 0.8))
+MAX_WORDS = 20
+
+# Nombre para mostrar y alias habituales; para las CCAA que no estén aquí se derivan del slug
+CCAA_ALIASES = {
+    "comunidad-autonoma-andalucia": ("Andalucía", ["andalucia", "andaluza", "junta de andalucia", "sevilla"]),
+    "comunidad-autonoma-cataluna": ("Cataluña", ["cataluna", "catalunya", "catalana", "generalitat de catalunya",
+                                                 "barcelona"]),
+    "comunidad-madrid": ("Comunidad de Madrid", ["madrid", "comunidad de madrid", "comunidad madrid"]),
+    "comunitat-valenciana": ("Comunitat Valenciana", ["valencia", "valenciana", "comunidad valenciana",
+                                                      "comunitat valenciana", "alicante", "castellon"]),
+}
+SLUG_PREFIXES = ("comunidad", "autonoma", "comunitat", "region", "principado", "foral", "ciudad", "de", "del")
+
+LIST_WORDS = {"que", "cuales", "cual", "lista", "listado", "listame", "enumera", "enumerame", "dime", "muestrame",
+              "ensename", "hay", "existen", "existe", "tiene", "tienen", "ofrece", "disponibles", "todas", "puedo",
+              "aplicar", "aplicarme", "son", "quiero", "saber", "conocer", "ver"}
+DEDUCTION_WORDS = {"deducciones", "deduccion", "autonomicas", "autonomica", "fiscales", "irpf", "renta", "tramo",
+                   "autonomico"}
+FILLER_WORDS = {"en", "de", "la", "el", "los", "las", "del", "para", "a", "y", "e", "me", "mi", "se", "comunidad",
+                "autonoma", "region", "ccaa", "hola", "buenas", "actualmente", "vigentes", "2024", "2025"}
+
+hits_total = metrics.counter("intent_router_hits_total", "Preguntas respondidas por el router sin llamar al LLM")
+misses_total = metrics.counter("intent_router_misses_total", "Preguntas que el router deja pasar al agente")
+
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9]+")
+
+
+def fold(text: str) -> str:
+    """Minúsculas, sin tildes ni signos: 'Cataluña?' -> 'cataluna'."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return _NON_ALNUM_RE.sub(" ", text).strip()
+
+
+def slug_aliases(slug: str) -> list[str]:
+    words = slug.split("-")
+    while words[:-1] and words[0] in SLUG_PREFIXES:
+        words = words[1:]
+    return list(dict.fromkeys([" ".join(words), slug.replace("-", " ")]))
+
+
+class IntentRouter:
+    """Reconoce "¿qué deducciones hay en <CCAA>?" y lo contesta con el listado precalculado.
+
+    Las CCAA se resuelven con un índice de alias (exacto, por n-gramas de hasta tres palabras) y, para palabras
+    sueltas mal escritas, con difflib. La pregunta solo se atiende si, quitando las CCAA, todo lo que queda son
+    palabras de listado o de relleno: "deducciones por alquiler en Madrid" ya no es un listado y va al agente.
+    """
+
+    def __init__(self, deducciones: dict[str, list[str]], fuzzy_cutoff: float = FUZZY_CUTOFF):
+        self.deducciones = deducciones
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.names = {}
+        self.aliases: dict[str, str] = {}  # alias normalizado -> slug
+        for slug in deducciones:
+            name, aliases = CCAA_ALIASES.get(slug, (slug.replace("-", " ").title(), []))
+            self.names[slug] = name
+            for alias in [*aliases, fold(name), *slug_aliases(slug)]:
+                self.aliases.setdefault(fold(alias), slug)
+        self._vocabulary = LIST_WORDS | DEDUCTION_WORDS | FILLER_WORDS
+        self._single_word_aliases = [a for a in self.aliases if " " not in a]
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _fuzzy_slug(self, word: str) -> str | None:
+        """Slug de una palabra mal escrita, solo si todos los alias parecidos apuntan a la misma CCAA."""
+        matches = difflib.get_close_matches(word, self._single_word_aliases, n=3, cutoff=self.fuzzy_cutoff)
+        slugs = {self.aliases[m] for m in matches}
+        return slugs.pop() if len(slugs) == 1 else None
+
+    def resolve_ccaa(self, words: list[str]) -> tuple[list[str], list[str]] | None:
+        """Separa las CCAA mencionadas del resto de palabras. None si alguna palabra parece una CCAA pero es dudosa."""
+        slugs, rest = [], []
+        i = 0
+        while i < len(words):
+            for n in (3, 2, 1):
+                slug = self.aliases.get(" ".join(words[i:i + n])) if i + n <= len(words) else None
+                if slug:
+                    break
+            else:
+                n = 1
+                word = words[i]
+                if word not in self._vocabulary and len(word) >= 5:
+                    slug = self._fuzzy_slug(word)
+                    if slug is None and difflib.get_close_matches(word, self._single_word_aliases, n=1, cutoff=0.6):
+                        return None
+            if slug:
+                if slug not in slugs:
+                    slugs.append(slug)
+            else:
+                rest.append(words[i])
+            i += n
+        return slugs, rest
+
+    def match(self, message: str) -> list[str] | None:
+        """Slugs cuyo listado pide el mensaje, o None si no es (solo) una petición de listado."""
+        words = fold(message).replace("por favor", " ").split()
+        if not words or len(words) > MAX_WORDS or "deducciones" not in words:
+            return None
+        resolved = self.resolve_ccaa(words)
+        if resolved is None:
+            return None
+        slugs, rest = resolved
+        if not slugs or any(not self.deducciones.get(slug) for slug in slugs):
+            return None
+        if any(w not in self._vocabulary for w in rest) or not any(w in LIST_WORDS for w in rest):
+            return None
+        return slugs
+
+    def answer(self, slugs: list[str]) -> str:
+        sections = [f"**{self.names[slug]}** ({len(self.deducciones[slug])} deducciones):\n"
+                    + "\n".join(f"- {d}" for d in self.deducciones[slug]) for slug in slugs]
+        return ("Estas son las deducciones autonómicas del IRPF disponibles:\n\n" + "\n\n".join(sections)
+                + "\n\nSi quieres conocer los requisitos o el importe de alguna, pregúntame por ella.")
+
+    def route(self, message: str) -> str | None:
+        """Respuesta directa para el mensaje o None si debe atenderlo el agente."""
+        slugs = self.match(message)
+        with self._lock:
+            if slugs is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        (misses_total if slugs is None else hits_total).inc()
+        return self.answer(slugs) if slugs is not None else None
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 3) if total else 0.0}
@@ -1,44 +1,104 @@
+import atexit
+import json
 import logging
+import logging.handlers
 import os
-from datetime import datetime
+import queue
+import random
+from datetime import datetime, timezone
 
 # --- Logging Configuration --- START ---
-LOG_DIR = "logs"
+# Los módulos solo encolan el registro (QueueHandler); formatearlo y escribirlo a disco o consola lo hace el hilo
+# del QueueListener, fuera del event loop. El fichero es JSON (un registro por línea) y rota por tamaño.
+LOG_DIR = os.getenv("LOG_DIR", "logs")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
+LOG_CONSOLE_LEVEL = os.getenv("LOG_CONSOLE_LEVEL", "INFO").upper()
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+# Fracción de peticiones de /api/chat que registran los chunks completos del agente (a nivel DEBUG)
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", 0.0))
+
 if not os.path.exists(LOG_DIR):
     os.makedirs(LOG_DIR)
 
+log_filename = os.path.join(LOG_DIR, "chatbot_api.log")
+
+# Atributos propios de LogRecord: el resto (los pasados con extra=...) van como campos del JSON
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Un objeto JSON por registro: ts, level, logger, message, los campos de `extra` y la excepción si la hay."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que no formatea en el hilo que registra: el mensaje (msg % args) se construye en el listener.
 
-current_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-log_filename = os.path.join(LOG_DIR, f"chatbot_api_{current_time}.log")
+    La cola es del mismo proceso, así que el registro viaja tal cual; los argumentos deben ser objetos que no
+    cambien después de registrarlos (los chunks del agente no cambian).
+    """
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        # Con la cola llena se descarta el registro en vez de bloquear al que registra
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def should_log_payloads() -> bool:
+    """Decide por petición si se registran sus payloads (LOG_PAYLOAD_SAMPLE_RATE)."""
+    return LOG_PAYLOAD_SAMPLE_RATE > 0 and random.random() < LOG_PAYLOAD_SAMPLE_RATE
 
 
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG) 
+logger.setLevel(min(logging.getLevelName(LOG_LEVEL), logging.getLevelName(LOG_CONSOLE_LEVEL)))
 
 for handler in logger.handlers[:]:
     logger.removeHandler(handler)
-    handler.close() 
+    handler.close()
 
 
-file_handler = logging.FileHandler(log_filename, encoding='utf-8')
-file_handler.setLevel(logging.DEBUG) 
+file_handler = logging.handlers.RotatingFileHandler(log_filename, maxBytes=LOG_MAX_BYTES,
+                                                    backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+file_handler.setLevel(LOG_LEVEL)
+file_handler.setFormatter(JsonFormatter())
 
 
 console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO) 
-
+console_handler.setLevel(LOG_CONSOLE_LEVEL)
+console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
 
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+queue_handler = LazyQueueHandler(log_queue)
+listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
 
-logger.addHandler(file_handler)
-logger.addHandler(console_handler) 
+logger.addHandler(queue_handler)
 
-logging.info(f"Logging initialized from logging_config.py. Log file: {log_filename}")
+logging.info("Logging initialized from logging_config.py. Log file: %s", log_filename)
 
 logging.getLogger("aiosqlite").setLevel(logging.INFO)
 
 def get_logger(name=None):
-    return logging.getLogger(name) 
\ No newline at end of file
+    return logging.getLogger(name)
@@ -3,49 +3,128 @@ import os
 import logging
 load_dotenv()
 load_dotenv(".env.prompts")
-from fastapi import FastAPI, HTTPException, Request, HTTPException, Depends, APIRouter
+from fastapi import FastAPI, HTTPException, Request, HTTPException, Depends, APIRouter, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from langchain.chat_models import init_chat_model
-from app.tools import regional_tax_deductions_details, list_regional_tax_deductions, internet_search_tool
+from app.tools import regional_tax_deductions_details, list_regional_tax_deductions, internet_search_tool, is_degraded_result, cache_stats, preload_vectorstore, refresh_vectorstore, index_status, WARMUP_QUERY, DEDUCCIONES_POR_CCAA, get_vectorstore, aclose_web_search
 import time
 import os
 import logging
 from langchain.globals import set_verbose
-set_verbose(True)
+set_verbose(os.getenv("LANGCHAIN_VERBOSE", "0") == "1")
 from langmem.short_term import SummarizationNode
 from langgraph.prebuilt import create_react_agent
 from app.tools import regional_tax_deductions_details, list_regional_tax_deductions, internet_search_tool
 from langchain.chat_models import init_chat_model
 from langchain_core.messages.utils import count_tokens_approximately
-from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+from app.checkpoints import PooledSqliteSaver
 from typing import Any
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langgraph.prebuilt.chat_agent_executor import AgentState, RunnableCallable
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
 import asyncio
 import json
-import aiosqlite 
-from contextlib import asynccontextmanager 
-from app.utils import custom_summarize_llm_input, RateLimiter
+from contextlib import asynccontextmanager, AsyncExitStack
+from app.utils import custom_summarize_llm_input, acustom_summarize_llm_input, deferred_summarizer, BackgroundSummaries, SUMMARY_MODE, RateLimiter
 from functools import partial
-from app.logging_config import logger
+from app.logging_config import logger, queue_handler, should_log_payloads
+from app.streaming import stream_agent, stream_direct_answer
+from app.intent_router import IntentRouter, ROUTER_ENABLED, fold
+from app.cache import SemanticAnswerCache
+import hashlib
+from app.rate_limit import rate_limit_headers
+from app.admission import AdmissionController, AdmissionRejected
+from app import metrics, tracing
+from app.cache import register_cache_metrics
 
 # Placeholder for memory, will be initialized on startup
-memory: AsyncSqliteSaver | None = None
+memory: PooledSqliteSaver | None = None
 agent: Any = None 
+background_summaries: BackgroundSummaries | None = None
+admission = AdmissionController()
+intent_router = IntentRouter(DEDUCCIONES_POR_CCAA) if ROUTER_ENABLED else None
+# Resuelve las CCAA de la pregunta para el ámbito de la caché de respuestas, aunque el router esté desactivado
+ccaa_resolver = intent_router or IntentRouter(DEDUCCIONES_POR_CCAA)
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 256))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_MAX_CHARS = int(os.getenv("ANSWER_CACHE_MAX_CHARS", 300))
+answer_cache = SemanticAnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_THRESHOLD) if ANSWER_CACHE_SIZE > 0 else None
+if answer_cache is not None:
+    register_cache_metrics("answer", answer_cache)
+metrics.counter("log_records_dropped_total", "Registros de log descartados con la cola llena",
+                fn=lambda: queue_handler.dropped)
+SNAPSHOT_POLL_INTERVAL = float(os.getenv("SNAPSHOT_POLL_INTERVAL", 30))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def answer_cache_scope(message: str) -> tuple | None:
+    """(CCAA, cifras) que menciona la pregunta: dos preguntas solo comparten respuesta si coinciden.
+    None si alguna palabra parece una CCAA pero no se puede resolver con seguridad."""
+    words = fold(message).split()
+    resolved = ccaa_resolver.resolve_ccaa(words)
+    if resolved is None:
+        return None
+    return tuple(sorted(resolved[0])), tuple(w for w in words if w.isdigit())
+
+def cacheable_answer(messages: list) -> str | None:
+    """Respuesta final del turno, o None si no hay o alguna herramienta devolvió un error o un mensaje degradado."""
+    final = messages[-1] if messages else None
+    if not isinstance(final, AIMessage) or not isinstance(final.content, str) or not final.content.strip():
+        return None
+    last_human = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=-1)
+    for message in messages[last_human + 1:]:
+        if isinstance(message, ToolMessage) and (message.status == "error" or is_degraded_result(message.content)):
+            return None
+    return final.content
+
+async def first_turn_embedding(message: str, config: dict):
+    """(embedding, huella, ámbito) del mensaje si abre el hilo y puede usar la caché de respuestas; si no, None.
+
+    La huella agrupa lo que hace válida una respuesta guardada: snapshot del índice, prompt de sistema y modelo.
+    """
+    if answer_cache is None or len(message) > ANSWER_CACHE_MAX_CHARS:
+        return None
+    scope = answer_cache_scope(message)
+    if scope is None:
+        return None
+    state = await agent.aget_state(config)
+    if state.values.get("messages"):
+        return None
+    try:
+        vectorstore = await asyncio.to_thread(get_vectorstore)
+        vector = await vectorstore.embeddings.aembed_query(message)
+    except Exception as e:
+        logging.warning("Answer cache skipped, could not embed the question: %s", e)
+        return None
+    prompt_hash = hashlib.sha256(os.getenv("SYSTEM_TEMPLATE_AEAT", "").encode()).hexdigest()
+    return vector, (vectorstore.version, prompt_hash, os.getenv("LLM_MODEL")), scope
+
+async def poll_index_snapshots(interval: float = SNAPSHOT_POLL_INTERVAL):
+    """Comprueba periódicamente si la ingesta publicó un snapshot nuevo y lo carga en caliente en un hilo aparte."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(refresh_vectorstore, WARMUP_QUERY)
+        except Exception as e:
+            logging.warning("Index snapshot reload failed, keeping the current one: %s", e)
 
 class State(AgentState):
     context: dict[str, Any]
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global memory, agent
-    conn = await aiosqlite.connect("db/chatbot_memory.db")
-    memory = AsyncSqliteSaver(conn=conn)
-    await memory.setup()
-    logging.info("AsyncSqliteSaver initialized and setup called.")
+    global memory, agent, background_summaries
+    exit_stack = AsyncExitStack()
+    memory = await exit_stack.enter_async_context(PooledSqliteSaver.open())
+    sweeper = asyncio.create_task(memory.run_sweeper())
+    logging.info("PooledSqliteSaver initialized (WAL, read pool, retention) and thread sweeper started.")
+    if os.getenv("PRELOAD_INDEX", "1") == "1":
+        try:
+            await asyncio.to_thread(preload_vectorstore)
+        except Exception as e:
+            logging.error("FAISS preload failed, it will be retried on the first tool call: %s", e)
+    snapshot_poller = asyncio.create_task(poll_index_snapshots()) if SNAPSHOT_POLL_INTERVAL > 0 else None
     llm = init_chat_model(model=os.getenv("LLM_MODEL"), model_provider=os.getenv("LLM_PROVIDER"), temperature=0.5)
 
     INITIAL_SUMMARY_PROMPT = ChatPromptTemplate.from_messages(
@@ -66,8 +145,11 @@ async def lifespan(app: FastAPI):
         output_messages_key="summarized_part_output_key", 
     )
 
-    summarizer = partial(custom_summarize_llm_input, internal_summarizer=internal_summarizer, n_last_messages=1)
-    custom_summarizer_runnable = RunnableCallable(summarizer)
+    # En modo "background" el hook solo resume si el historial ya no cabe; el resto se pliega tras cada respuesta
+    hook_summarizer = deferred_summarizer(internal_summarizer) if SUMMARY_MODE == "background" else internal_summarizer
+    summarizer = partial(custom_summarize_llm_input, internal_summarizer=hook_summarizer, n_last_messages=1)
+    asummarizer = partial(acustom_summarize_llm_input, internal_summarizer=hook_summarizer, n_last_messages=1)
+    custom_summarizer_runnable = RunnableCallable(summarizer, asummarizer)
     
     agent_prompt_for_startup = ChatPromptTemplate.from_messages(
         [
@@ -84,13 +166,18 @@ async def lifespan(app: FastAPI):
         checkpointer=memory,
         pre_model_hook=custom_summarizer_runnable,
     )
-    logging.info("Agent re-initialized with AsyncSqliteSaver in lifespan startup.")
+    if SUMMARY_MODE == "background":
+        background_summaries = BackgroundSummaries(agent, internal_summarizer)
+    logging.info("Agent re-initialized with PooledSqliteSaver in lifespan startup.")
     
     yield 
     
-    if memory and hasattr(memory, 'conn') and memory.conn:
-        await memory.conn.close()
-        logging.info("AsyncSqliteSaver connection closed during lifespan shutdown.")
+    sweeper.cancel()
+    if snapshot_poller:
+        snapshot_poller.cancel()
+    await aclose_web_search()
+    await exit_stack.aclose()
+    logging.info("Checkpoint connections closed during lifespan shutdown.")
 
 app = FastAPI(title="Chat fiscal 2024", lifespan=lifespan)
 
@@ -105,6 +192,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  
     allow_headers=["*"],  
+    expose_headers=["Retry-After", "RateLimit-Limit", "RateLimit-Remaining", "RateLimit-Reset", "RateLimit-Policy"],
 )
 
 class ChatBody(BaseModel):       
@@ -113,74 +201,109 @@ class ChatBody(BaseModel):
 ip_rate_limiter_chat = RateLimiter(requests_limit=10, time_window=120, limit_type="ip_path")
 global_rate_limiter_chat = RateLimiter(requests_limit=60, time_window=3600, limit_type="global_path")
 @router.post("/chat", dependencies=[Depends(ip_rate_limiter_chat), Depends(global_rate_limiter_chat)])
-async def chat(body: ChatBody):
+async def chat(body: ChatBody, request: Request):
     if not memory or not agent: 
         raise HTTPException(status_code=503, detail="Memory Saver or Agent not initialized.")
+    trace = tracing.start_trace("chat", thread_id=body.thread_id)
+    # El rate limit se evalúa en las dependencias, antes de que exista la traza
+    trace.add("rate_limit", getattr(request.state, "rate_limit_seconds", 0.0))
     dynamic_config = {
         "configurable": {
             "thread_id": body.thread_id
-        }
+        },
+        "callbacks": [tracing.StageCallbackHandler(trace)],
     }
+    started = trace.started
+    log_payloads = should_log_payloads()
+    if log_payloads:
+        logging.debug("Chat request payload: %r", body.message, extra={"thread_id": body.thread_id})
+    try:
+        ticket = await admission.acquire(body.thread_id)
+    except AdmissionRejected as e:
+        trace.attributes["rejected"] = e.reason
+        trace.finish()
+        logging.warning("Chat request for thread_id %s rejected by admission control: %s", body.thread_id, e.reason)
+        raise HTTPException(status_code=503, detail=f"Server busy ({e.reason}). Try again later.",
+                            headers={"Retry-After": str(int(e.retry_after))})
     async def event_stream():
         try:
-            logging.debug(f"Starting agent.astream for thread_id: {body.thread_id} with AsyncSqliteSaver")
-            async for chunk in agent.astream(
-                {"messages": [HumanMessage(content=body.message)]},
-                config=dynamic_config
-            ):
-                logging.debug(f"Raw chunk from agent.astream: {chunk}")
-                token_to_send = None
-
-                # Check for AIMessage content within an 'agent' chunk
-                if "agent" in chunk and isinstance(chunk["agent"], dict) and "messages" in chunk["agent"]:
-                    agent_messages = chunk["agent"]["messages"]
-                    if agent_messages and isinstance(agent_messages, list) and len(agent_messages) > 0:
-                        last_agent_message = agent_messages[-1]
-                        # Ensure it's an AIMessage and has non-empty content
-                        if hasattr(last_agent_message, 'content') and isinstance(last_agent_message.content, str) and last_agent_message.content.strip():
-                            token_to_send = last_agent_message.content # Send the full content of this AIMessage
-                            logging.debug(f"Extracted AIMessage content from chunk['agent']['messages'][-1].content: '{token_to_send}'")
-                
-                #Add handling for 'tools' chunks here if wanted
-
-                if token_to_send: 
-                    data_to_send = {"token": token_to_send}
-                    yield f"data: {json.dumps(data_to_send)}\n\n"
-                    await asyncio.sleep(0.01)
+            yield ": admitted\n\n"
+            if background_summaries:
+                await background_summaries.wait(body.thread_id)
+            direct_answer = intent_router.route(body.message) if intent_router else None
+            cache_probe = None
+            if direct_answer is not None:
+                events = stream_direct_answer(agent, body.message, direct_answer, dynamic_config, started)
+            else:
+                cache_probe = await first_turn_embedding(body.message, dynamic_config)
+                cached_answer = answer_cache.lookup(*cache_probe) if cache_probe else None
+                if cached_answer is not None:
+                    events = stream_direct_answer(agent, body.message, cached_answer, dynamic_config, started,
+                                                  source="cache")
+                    cache_probe = None
                 else:
-                    logging.debug("No new displayable AIMessage content extracted from this chunk.")
-
-            logging.debug(f"Finished agent.astream for thread_id: {body.thread_id}")
-            
-            # mock_sources = [
-            #     {"title": "Portal AEAT - Deducciones Autonómicas", "url": "https://sede.agenciatributaria.gob.es/Sede/ayuda/manuales-videos-folletos/manuales-practicos/manual-practico-renta/capitulo-16-deducciones-autonomicas.html"},
-            # ]
-            # if mock_sources: 
-            #     sources_payload = json.dumps({"sources_used": mock_sources})
-            #     yield f"data: {sources_payload}\n\n"
-            
-            end_event_payload = json.dumps({"event": "end"})
-            yield f"data: {end_event_payload}\n\n"
+                    logging.debug("Starting agent stream for thread_id: %s", body.thread_id)
+                    # Lo que se ahorra un acierto es la ejecución del agente, sin la espera de admisión
+                    agent_started = time.perf_counter()
+                    events = stream_agent(agent, {"messages": [HumanMessage(content=body.message)]}, dynamic_config, started,
+                                          log_payloads)
+            async for event in events:
+                yield event
+            if cache_probe:
+                answer = cacheable_answer((await agent.aget_state(dynamic_config)).values["messages"])
+                if answer is not None:
+                    vector, fingerprint, scope = cache_probe
+                    answer_cache.store(body.message, vector, answer, time.perf_counter() - agent_started, fingerprint,
+                                       scope)
+            logging.debug("Finished agent stream for thread_id: %s", body.thread_id)
+            if background_summaries:
+                background_summaries.schedule(dynamic_config)
         except Exception as e:
-            logging.error(f"Error during stream for thread_id {body.thread_id}: {e}", exc_info=True)
+            logging.error("Error during stream for thread_id %s: %s", body.thread_id, e, exc_info=True)
             error_data = {"error": str(e)}
             yield f"data: {json.dumps(error_data)}\n\n"
-    return StreamingResponse(event_stream(), media_type="text/event-stream")
+        finally:
+            ticket.release()
+            trace.finish()
+    stream = event_stream()
+    # Arranca el generador: desde aquí su finally libera la plaza aunque el cliente se desconecte antes de leer
+    await anext(stream)
+    return StreamingResponse(stream, media_type="text/event-stream", headers=rate_limit_headers(request))
 
 class GoodbyeBody(BaseModel):
     thread_id: str
 @router.post("/goodbye")
 async def goodbye(body: GoodbyeBody):
     thread_id_to_clear = body.thread_id
-    logging.info(f"Received request to clear memory for thread_id: {thread_id_to_clear} (using SqliteSaver).")
-    logging.warning(f"Automatic thread deletion for {thread_id_to_clear} is not actively performed with the current SqliteSaver setup. Conversation will persist in the DB.")
-    return {"status": "request_logged_sqlite_no_delete_action", "thread_id": thread_id_to_clear,
-            "message": "SqliteSaver is in use. Specific thread deletion is not automatically performed by this endpoint."}
+    if not memory:
+        raise HTTPException(status_code=503, detail="Memory Saver not initialized.")
+    logging.info("Received request to clear memory for thread_id: %s.", thread_id_to_clear)
+    if background_summaries:
+        # Un resumen pendiente volvería a crear el hilo después de borrarlo
+        await background_summaries.wait(thread_id_to_clear)
+    await memory.adelete_thread(thread_id_to_clear)
+    return {"status": "deleted", "thread_id": thread_id_to_clear}
 
 @router.get("/health")
 async def health_check():
     return {"status": "ok"}
 
+@router.get("/stats")
+async def stats():
+    return {"cache": cache_stats(), "intent_router": intent_router.stats() if intent_router else None,
+            "answer_cache": answer_cache.stats() if answer_cache else None,
+            "metrics": metrics.snapshot()}
+
+@router.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@router.get("/admin/index")
+async def admin_index(x_admin_token: str | None = Header(default=None)):
+    if ADMIN_TOKEN and x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Forbidden.")
+    return await asyncio.to_thread(index_status)
+
 app.include_router(router, prefix="/api")
 
 #TODO: Add guardrails to the agent.
\ No newline at end of file
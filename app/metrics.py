@@ -0,0 +1,191 @@
+"""Métricas en memoria del proceso: contadores e histogramas con buckets fijos, expuestos en /api/stats (JSON) y
+/api/metrics (formato de texto de Prometheus)."""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class Counter:
+    """Contador monótono; con `fn` se lee de un contador que ya lleva otro objeto (p. ej. los aciertos de una caché)."""
+
+    def __init__(self, name: str, description: str = "", fn=None):
+        self.name = name
+        self.description = description
+        self.fn = fn
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n: float = 1):
+        with self._lock:
+            self.value += n
+
+    def snapshot(self):
+        if self.fn is None:
+            return self.value
+        try:
+            return self.fn()
+        except Exception:
+            return None
+
+
+class Gauge:
+    """Valor instantáneo: fijado con set() o calculado al leerlo con `fn`."""
+
+    def __init__(self, name: str, description: str = "", fn=None):
+        self.name = name
+        self.description = description
+        self.fn = fn
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def snapshot(self):
+        if self.fn is None:
+            return self.value
+        try:
+            return self.fn()
+        except Exception:
+            return None
+
+
+class Histogram:
+    """Histograma acumulado; los cuantiles se aproximan por el límite superior del bucket."""
+
+    def __init__(self, name: str, description: str = "", buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # el último es +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q: float) -> float | None:
+        with self._lock:
+            if not self.count:
+                return None
+            target = q * self.count
+            acumulado = 0
+            for i, n in enumerate(self.counts):
+                acumulado += n
+                if acumulado >= target:
+                    return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def cumulative(self) -> tuple[list[tuple[float, int]], float, int]:
+        """([(límite superior, acumulado)], suma, total) leídos a la vez, para exportar en formato Prometheus."""
+        with self._lock:
+            counts, total_sum, count = list(self.counts), self.sum, self.count
+        acumulado, buckets = 0, []
+        for bound, n in zip((*self.buckets, float("inf")), counts):
+            acumulado += n
+            buckets.append((bound, acumulado))
+        return buckets, total_sum, count
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "avg": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+        }
+
+
+def process_memory() -> dict:
+    """RSS del proceso en bytes, separando memoria anónima y páginas de ficheros (mmap, compartibles entre procesos)."""
+    usage = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "RssAnon", "RssFile"):
+                    usage[key] = int(value.split()[0]) * 1024
+    except OSError:
+        import resource
+        usage["VmRSS"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {"rss": usage.get("VmRSS"), "anon": usage.get("RssAnon"), "file": usage.get("RssFile")}
+
+
+def _get_or_create(cls, name, *args, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, *args, **kwargs)
+        return metric
+
+
+def counter(name: str, description: str = "", fn=None) -> Counter:
+    return _get_or_create(Counter, name, description, fn)
+
+
+def gauge(name: str, description: str = "", fn=None) -> Gauge:
+    return _get_or_create(Gauge, name, description, fn)
+
+
+def histogram(name: str, description: str = "", buckets=DEFAULT_BUCKETS) -> Histogram:
+    return _get_or_create(Histogram, name, description, buckets)
+
+
+gauge("process_resident_memory_bytes", "RSS del proceso", fn=lambda: process_memory()["rss"])
+
+
+def snapshot() -> dict:
+    with _registry_lock:
+        metrics = dict(_registry)
+    return {name: metric.snapshot() for name, metric in sorted(metrics.items())}
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def render_prometheus(prefix: str = "") -> str:
+    """Todas las métricas en el formato de texto de Prometheus (0.0.4)."""
+    with _registry_lock:
+        metrics = dict(_registry)
+    lines = []
+    for name, metric in sorted(metrics.items()):
+        full_name = prefix + name
+        kind = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}[type(metric)]
+        if isinstance(metric, Histogram):
+            buckets, total_sum, count = metric.cumulative()
+            samples = [(f'{full_name}_bucket{{le="{_format_value(bound)}"}}', n) for bound, n in buckets]
+            samples += [(f"{full_name}_sum", total_sum), (f"{full_name}_count", count)]
+        else:
+            value = metric.snapshot()
+            if value is None:
+                continue
+            samples = [(full_name, value)]
+        if metric.description:
+            lines.append(f"# HELP {full_name} {_escape_help(metric.description)}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        lines.extend(f"{sample} {_format_value(value)}" for sample, value in samples)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,180 @@
+"""Rate limiting por token bucket con backend intercambiable: en memoria (un proceso) o SQLite (varios workers)."""
+import asyncio
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi import HTTPException, Request, Response
+
+from app import tracing
+from app.logging_config import logger
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # "memory" o "sqlite"
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", "db/rate_limit.db")
+
+
+def _take(tokens: float, updated: float, now: float, capacity: float, rate: float) -> tuple[bool, float, float]:
+    """Rellena el bucket hasta `now` y gasta un token. Devuelve (permitido, tokens restantes, instante en que se llena)."""
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    allowed = tokens >= 1
+    if allowed:
+        tokens -= 1
+    return allowed, tokens, now + (capacity - tokens) / rate
+
+
+class MemoryBackend:
+    """Buckets en un OrderedDict por orden de uso: cada llamada es O(1) y la expiración es perezosa.
+
+    Un bucket que ya se ha rellenado del todo equivale a no tenerlo, así que en cada llamada se descartan
+    los menos usados mientras estén llenos; nunca se recorre el diccionario completo.
+    """
+
+    blocking = False
+
+    def __init__(self):
+        self._buckets: OrderedDict[str, tuple[float, float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, capacity: int, rate: float) -> tuple[bool, float, float]:
+        now = time.monotonic()
+        with self._lock:
+            while self._buckets:
+                oldest = next(iter(self._buckets.values()))
+                if oldest[2] > now:
+                    break
+                self._buckets.popitem(last=False)
+            tokens, updated, _ = self._buckets.get(key, (capacity, now, now))
+            allowed, tokens, full_at = _take(tokens, updated, now, capacity, rate)
+            self._buckets[key] = (tokens, now, full_at)
+            self._buckets.move_to_end(key)
+        return allowed, tokens, full_at - now
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SQLiteBackend:
+    """Buckets en una tabla SQLite compartida por todos los workers de la máquina.
+
+    Cada comprobación es una transacción IMMEDIATE sobre una fila (por clave primaria); las filas llenas se
+    borran cada `sweep_every` llamadas con un DELETE por índice.
+    """
+
+    blocking = True  # puede esperar hasta `timeout` s al bloqueo de escritura: se llama desde un hilo
+
+    def __init__(self, path: str = RATE_LIMIT_DB, sweep_every: int = 500):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL,
+                full_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS rate_limit_buckets_full_at ON rate_limit_buckets (full_at);
+            """
+        )
+        self._lock = threading.Lock()
+        self._sweep_every = sweep_every
+        self._calls = 0
+
+    def take(self, key: str, capacity: int, rate: float) -> tuple[bool, float, float]:
+        now = time.time()  # reloj de pared: lo comparten los procesos
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT tokens, updated FROM rate_limit_buckets WHERE key = ?", (key,)).fetchone()
+                tokens, updated = row if row else (capacity, now)
+                allowed, tokens, full_at = _take(tokens, updated, now, capacity, rate)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO rate_limit_buckets (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)",
+                    (key, tokens, now, full_at))
+                self._calls += 1
+                if self._calls % self._sweep_every == 0:
+                    self._conn.execute("DELETE FROM rate_limit_buckets WHERE full_at <= ?", (now,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return allowed, tokens, full_at - now
+
+
+_default_backend = None
+
+
+def default_backend():
+    global _default_backend
+    if _default_backend is None:
+        _default_backend = SQLiteBackend(RATE_LIMIT_DB) if RATE_LIMIT_BACKEND == "sqlite" else MemoryBackend()
+    return _default_backend
+
+
+class RateLimiter:
+    """Dependencia de FastAPI: `requests_limit` peticiones por `time_window` segundos, por IP y ruta o global por ruta.
+
+    Token bucket de capacidad `requests_limit` que se rellena a `requests_limit / time_window` tokens por segundo.
+    Añade las cabeceras RateLimit-* a la respuesta (y Retry-After al 429).
+    """
+
+    def __init__(self, requests_limit: int, time_window: int, limit_type: str = "ip_path", backend=None):
+        if limit_type not in ("ip_path", "global_path"):
+            raise ValueError("Invalid limit_type specified for RateLimiter")
+        self.requests_limit = requests_limit
+        self.time_window = time_window
+        self.limit_type = limit_type
+        self.rate = requests_limit / time_window
+        self.backend = backend
+
+    def _key(self, request: Request) -> str:
+        route_path = request.url.path
+        if self.limit_type == "ip_path":
+            return f"ip:{request.client.host}:{route_path}"
+        return f"global:{route_path}"
+
+    def _headers(self, remaining: float, reset: float) -> dict[str, str]:
+        return {
+            "RateLimit-Limit": str(self.requests_limit),
+            "RateLimit-Remaining": str(math.floor(remaining)),
+            "RateLimit-Reset": str(math.ceil(reset)),
+            "RateLimit-Policy": f"{self.requests_limit};w={self.time_window}",
+        }
+
+    async def __call__(self, request: Request, response: Response):
+        backend = self.backend if self.backend is not None else default_backend()
+        start = time.perf_counter()
+        if getattr(backend, "blocking", False):
+            allowed, remaining, reset = await asyncio.to_thread(backend.take, self._key(request), self.requests_limit,
+                                                                self.rate)
+        else:
+            allowed, remaining, reset = backend.take(self._key(request), self.requests_limit, self.rate)
+        elapsed = time.perf_counter() - start
+        tracing.observe("rate_limit", elapsed)
+        # Las dependencias se ejecutan antes de que el endpoint abra su traza: se la pasa el endpoint
+        request.state.rate_limit_seconds = getattr(request.state, "rate_limit_seconds", 0.0) + elapsed
+        headers = self._headers(remaining, reset)
+        if not allowed:
+            retry_after = math.ceil((1 - remaining) / self.rate)
+            if self.limit_type == "global_path":
+                logger.warning("Global rate limit hit for path %s. Limit: %s/%ss.", request.url.path, self.requests_limit,
+                               self.time_window)
+            raise HTTPException(status_code=429, detail=f"Too Many Requests. Limit type: {self.limit_type}",
+                                headers={**headers, "Retry-After": str(retry_after)})
+        # Con varios limitadores en la misma ruta se anuncia el más restrictivo
+        previous = getattr(request.state, "rate_limit_headers", None)
+        if previous is None or int(previous["RateLimit-Remaining"]) >= int(headers["RateLimit-Remaining"]):
+            request.state.rate_limit_headers = headers
+            response.headers.update(headers)
+        return True
+
+
+def rate_limit_headers(request: Request) -> dict[str, str]:
+    """Cabeceras RateLimit-* calculadas por las dependencias, para respuestas devueltas directamente (p. ej. streaming)."""
+    return getattr(request.state, "rate_limit_headers", None) or {}
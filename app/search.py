@@ -0,0 +1,154 @@
+"""Búsqueda en internet (API de Tavily) asíncrona: un único cliente HTTP con pool de conexiones, un tiempo
+máximo duro por llamada y una caché persistente en SQLite por (consulta normalizada, dominios)."""
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import httpx
+
+from app import metrics, tracing
+from app.cache import TTLCache, normalize_query
+from ingest.embeddings import close_stale_client
+
+TAVILY_API_URL = os.getenv("TAVILY_API_URL", "https://api.tavily.com")
+SEARCH_TIMEOUT = float(os.getenv("SEARCH_TIMEOUT", 8))
+SEARCH_MAX_CONNECTIONS = int(os.getenv("SEARCH_MAX_CONNECTIONS", 10))
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", "db/cache/search.sqlite")
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", 7 * 24 * 3600))
+
+search_seconds = metrics.histogram("internet_search_seconds", "Latencia de las búsquedas en internet no cacheadas")
+search_timeouts = metrics.counter("internet_search_timeouts_total", "Búsquedas cortadas por superar SEARCH_TIMEOUT")
+
+
+def search_key(query: str, domains: list[str], max_results: int) -> str:
+    raw = json.dumps([normalize_query(query), sorted(domains), max_results], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SearchCache:
+    """Resultados de búsqueda en SQLite con caducidad, y delante una TTLCache en memoria para los más repetidos."""
+
+    def __init__(self, path=SEARCH_CACHE_PATH, ttl: float = SEARCH_CACHE_TTL, memory_size: int = 256):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.memory = TTLCache(maxsize=memory_size, ttl=ttl)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS search_cache (
+                key TEXT PRIMARY KEY,
+                results TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            """
+        )
+        with self._lock:
+            self._conn.execute("DELETE FROM search_cache WHERE expires_at <= ?", (time.time(),))
+            self._conn.commit()
+
+    def _get_disk(self, key: str) -> list[dict] | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT results FROM search_cache WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        if row is None:
+            return None
+        results = json.loads(row[0])
+        self.memory.set(key, results)
+        return results
+
+    def _set_disk(self, key: str, results: list[dict]):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO search_cache (key, results, expires_at) VALUES (?, ?, ?)",
+                               (key, json.dumps(results, ensure_ascii=False), time.time() + self.ttl))
+            self._conn.commit()
+
+    def get(self, key: str) -> list[dict] | None:
+        results = self.memory.get(key)
+        return results if results is not None else self._get_disk(key)
+
+    def set(self, key: str, results: list[dict]):
+        self.memory.set(key, results)
+        self._set_disk(key, results)
+
+    # Desde el event loop: el acierto en memoria se resuelve en el momento; la lectura y el commit (fsync,
+    # espera al bloqueo) de SQLite van a un hilo
+
+    async def aget(self, key: str) -> list[dict] | None:
+        results = self.memory.get(key)
+        return results if results is not None else await asyncio.to_thread(self._get_disk, key)
+
+    async def aset(self, key: str, results: list[dict]):
+        self.memory.set(key, results)
+        await asyncio.to_thread(self._set_disk, key, results)
+
+
+class TavilySearch:
+    """Cliente de `POST /search` de Tavily.
+
+    El AsyncClient se crea una vez por event loop y mantiene las conexiones abiertas entre búsquedas.
+    `timeout` es el presupuesto total de la llamada (conexión, espera y lectura): pasado ese tiempo se
+    cancela y se lanza asyncio.TimeoutError, así un proveedor lento nunca retiene al worker más de eso.
+    """
+
+    def __init__(self, api_key: str | None = None, base_url: str = TAVILY_API_URL, timeout: float = SEARCH_TIMEOUT,
+                 cache: SearchCache | None = None, max_connections: int = SEARCH_MAX_CONNECTIONS):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.cache = cache
+        self.max_connections = max_connections
+        self._client = None
+        self._client_loop = None
+
+    async def _get_client(self) -> httpx.AsyncClient:
+        # Un AsyncClient solo puede usarse desde el event loop en el que se creó
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            stale, stale_loop = self._client, self._client_loop
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout,
+                                             limits=httpx.Limits(max_connections=self.max_connections))
+            self._client_loop = loop
+            if stale is not None:
+                await close_stale_client(stale, stale_loop)
+        return self._client
+
+    async def _post(self, payload: dict) -> dict:
+        resp = await (await self._get_client()).post("/search", json=payload)
+        resp.raise_for_status()
+        return resp.json()
+
+    async def search(self, query: str, include_domains: list[str] | None = None, max_results: int = 3) -> list[dict]:
+        domains = list(include_domains or [])
+        key = search_key(query, domains, max_results)
+        if self.cache is not None:
+            cached = await self.cache.aget(key)
+            if cached is not None:
+                return cached
+        api_key = self.api_key or os.getenv("TAVILY_API_KEY")
+        payload = {"api_key": api_key, "query": query, "max_results": max_results, "search_depth": "advanced",
+                   "include_domains": domains}
+        start = time.perf_counter()
+        try:
+            data = await asyncio.wait_for(self._post(payload), self.timeout)
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            search_timeouts.inc()
+            raise asyncio.TimeoutError(f"search exceeded {self.timeout}s") from None
+        tracing.observe("internet_search", time.perf_counter() - start, search_seconds)
+        results = [{"title": r.get("title"), "url": r.get("url"), "content": r.get("content")}
+                   for r in data.get("results", [])]
+        if self.cache is not None and results:
+            await self.cache.aset(key, results)
+        return results
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
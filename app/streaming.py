@@ -0,0 +1,187 @@
+"""Streaming SSE de /api/chat: tokens del LLM según llegan, eventos de herramientas y escrituras agrupadas."""
+import asyncio
+import json
+import logging
+import os
+import time
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from app import metrics, tracing
+
+SSE_BATCH_CHARS = int(os.getenv("SSE_BATCH_CHARS", 48))
+SSE_BATCH_MS = float(os.getenv("SSE_BATCH_MS", 40))
+AGENT_NODE = "agent"
+
+ttft_seconds = metrics.histogram("chat_time_to_first_token_seconds", "Desde la petición hasta el primer token enviado")
+stream_seconds = metrics.histogram("chat_stream_duration_seconds", "Duración total del stream de /api/chat")
+
+
+def sse(payload: dict) -> str:
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def _text(content) -> str:
+    # Algunos proveedores devuelven el contenido como lista de bloques
+    if isinstance(content, str):
+        return content
+    return "".join(b.get("text", "") for b in content if isinstance(b, dict) and b.get("type") == "text")
+
+
+class SSEBatcher:
+    """Agrupa tokens en un solo evento hasta `max_chars` caracteres o `max_delay` segundos desde el primero pendiente."""
+
+    def __init__(self, max_chars: int = SSE_BATCH_CHARS, max_delay: float = SSE_BATCH_MS / 1000):
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+        self._parts = []
+        self._size = 0
+        self._since = None
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._parts)
+
+    def add(self, token: str) -> str | None:
+        if not self._parts:
+            self._since = time.monotonic()
+        self._parts.append(token)
+        self._size += len(token)
+        return self.flush() if self._size >= self.max_chars else self.poll()
+
+    def poll(self) -> str | None:
+        """Vacía el buffer si el token pendiente más antiguo ya esperó `max_delay`."""
+        if self._parts and time.monotonic() - self._since >= self.max_delay:
+            return self.flush()
+        return None
+
+    def flush(self) -> str | None:
+        if not self._parts:
+            return None
+        text = "".join(self._parts)
+        self._parts, self._size, self._since = [], 0, None
+        return sse({"token": text})
+
+
+async def _with_ticks(stream, interval: float):
+    """Reenvía los elementos de `stream` y produce None si no llega nada en `interval` segundos."""
+    iterator = stream.__aiter__()
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=interval)
+            if not done:
+                yield None
+                continue
+            task, pending = pending, None
+            try:
+                item = task.result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+def _tool_events(node: str, update) -> list[dict]:
+    messages = update.get("messages", []) if isinstance(update, dict) else []
+    events = []
+    for message in messages:
+        if node == AGENT_NODE and isinstance(message, AIMessage):
+            events.extend({"event": "tool_start", "tool": call["name"], "id": call.get("id")} for call in message.tool_calls)
+        elif isinstance(message, ToolMessage):
+            events.append({"event": "tool_end", "tool": message.name, "id": message.tool_call_id,
+                           "status": getattr(message, "status", "success")})
+    return events
+
+
+async def stream_agent(agent, agent_input: dict, config: dict, started: float | None = None,
+                       log_payloads: bool = False):
+    """Genera los eventos SSE de una ejecución del agente.
+
+    Usa stream_mode ["messages", "updates"]: "messages" aporta los tokens del nodo del agente según se generan
+    (los del resumidor del pre_model_hook se descartan) y "updates" los inicios y finales de herramientas.
+    Si el modelo no emite tokens, el mensaje completo del nodo se envía al terminar, como antes.
+    Con `log_payloads` (petición muestreada) cada chunk se registra completo a nivel DEBUG.
+    """
+    started = started or time.perf_counter()
+    batcher = SSEBatcher()
+    first_token_at = None
+    streamed_ids = set()
+
+    def first_token():
+        nonlocal first_token_at
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+            ttft_seconds.observe(first_token_at - started)
+            if (trace := tracing.current_trace()) is not None:
+                trace.first_token()
+
+    stream = agent.astream(agent_input, config=config, stream_mode=["messages", "updates"])
+    async for item in _with_ticks(stream, batcher.max_delay):
+        if item is None:
+            if (data := batcher.poll()) is not None:
+                yield data
+            continue
+        mode, chunk = item
+        if log_payloads:
+            logging.debug("Agent chunk (%s): %r", mode, chunk,
+                          extra={"thread_id": config["configurable"].get("thread_id"), "stream_mode": mode})
+        if mode == "messages":
+            message, meta = chunk
+            token = _text(message.content)
+            if meta.get("langgraph_node") != AGENT_NODE or not token:
+                continue
+            streamed_ids.add(message.id)
+            if first_token_at is None:
+                # El primer token sale sin esperar al lote
+                first_token()
+                data = batcher.add(token)  # un primer token largo ya lo vacía el propio lote
+                yield data if data is not None else batcher.flush()
+            elif (data := batcher.add(token)) is not None:
+                yield data
+            continue
+
+        for node, update in chunk.items():
+            if node == AGENT_NODE and isinstance(update, dict) and update.get("messages"):
+                last = update["messages"][-1]
+                if isinstance(last, AIMessage) and last.id not in streamed_ids and _text(last.content).strip():
+                    first_token()
+                    batcher.add(_text(last.content))
+            events = _tool_events(node, update)
+            if events or batcher.pending:
+                if (data := batcher.flush()) is not None:
+                    yield data
+            for event in events:
+                yield sse(event)
+
+    if (data := batcher.flush()) is not None:
+        yield data
+    total = time.perf_counter() - started
+    stream_seconds.observe(total)
+    ttft = first_token_at - started if first_token_at is not None else None
+    logging.info("Chat stream finished in %.3fs (time to first token: %s)", total,
+                 f"{ttft:.3f}s" if ttft is not None else "n/a")
+    yield sse({"event": "end", "ttft_ms": round(ttft * 1000) if ttft is not None else None})
+
+
+async def stream_direct_answer(agent, message: str, answer: str, config: dict, started: float | None = None,
+                               source: str = "router"):
+    """Eventos SSE de una respuesta obtenida sin el LLM (router de intenciones o caché de respuestas).
+
+    El turno se guarda en el hilo como si lo hubiera contestado el agente, así las preguntas siguientes lo ven.
+    """
+    started = started or time.perf_counter()
+    await agent.aupdate_state(config, {"messages": [HumanMessage(content=message), AIMessage(content=answer)]},
+                              as_node=AGENT_NODE)
+    total = time.perf_counter() - started
+    ttft_seconds.observe(total)
+    if (trace := tracing.current_trace()) is not None:
+        trace.first_token()
+    stream_seconds.observe(total)
+    logging.info("Chat answered by %s in %.3fs", source, total)
+    yield sse({"token": answer})
+    yield sse({"event": "end", "ttft_ms": round(total * 1000), "source": source})
@@ -1,46 +1,235 @@
 from dotenv import load_dotenv
 load_dotenv()
 import os, json
+import asyncio
+import functools
+import gc
+import hashlib
 from pathlib import Path
 import sys
 import threading 
+import time
 project_root = Path(__file__).resolve().parent.parent
 sys.path.insert(0, str(project_root))
 from langchain_community.vectorstores import FAISS
-from langchain_community.tools import TavilySearchResults 
 from langchain.docstore.document import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 #from langchain_community.embeddings import FastEmbedEmbeddings
-from langchain_community.embeddings import OllamaEmbeddings
+from ingest.embeddings import EMBED_ENDPOINT, OllamaBatchEmbeddings
+from ingest.load_faiss import PARTITIONS_DIR, PartitionedVectorStore, UnknownCCAAError, load_vectorstore
+from ingest.snapshots import current_version
+from app.cache import CachedQueryEmbeddings, TTLCache, normalize_query, register_cache_metrics
+from app.search import SearchCache, TavilySearch
+from app.context import assemble_context, count_tokens
+from app import metrics, tracing
 from langchain_core.tools import tool
-from typing import Union, List, Optional 
+from typing import Union, List, Optional, Literal
 
 DB_DIR = str(project_root / "db/")
+SEARCH_K = 5
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
 _vectorstore = None
-_retriever = None
 _lock = threading.Lock()
+_reload_lock = threading.Lock()
+_loaded_at = None
+# Cada cuánto, como mucho, el camino de lectura mira si en disco hay otro snapshot (solo lee CURRENT o hace stat);
+# así las cachés se invalidan tras una reingesta aunque SNAPSHOT_POLL_INTERVAL=0. 0 lo desactiva
+INDEX_CHECK_INTERVAL = float(os.getenv("INDEX_CHECK_INTERVAL", 10))
+_checked_at = time.monotonic()
 
-def get_retriever(search_kwargs={"k": 5}):
-    global _vectorstore, _retriever
-    if _retriever is None:
+# Cachés delante del retriever: resultados por (consulta normalizada, parámetros) y embeddings de consultas
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", 512))
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", 3600))
+retrieval_cache = TTLCache(maxsize=RETRIEVAL_CACHE_SIZE, ttl=RETRIEVAL_CACHE_TTL)
+query_embedding_cache = TTLCache(maxsize=RETRIEVAL_CACHE_SIZE, ttl=RETRIEVAL_CACHE_TTL)
+register_cache_metrics("retrieval", retrieval_cache)
+register_cache_metrics("query_embedding", query_embedding_cache)
+index_swaps = metrics.counter("index_swaps_total", "Snapshots del índice cargados en caliente")
+index_reload_seconds = metrics.histogram("index_reload_seconds", "Carga y calentamiento de un snapshot nuevo")
+
+def index_signature(db_dir) -> tuple:
+    """(ruta, mtime, tamaño) de los ficheros del índice sin snapshots: cambia cuando se reconstruye alguna partición."""
+    root = Path(db_dir)
+    files = [p for p in root.glob(f"{PARTITIONS_DIR}/*/*") if p.is_file()]
+    files += [p for p in (root / "index.faiss", root / "index.pkl") if p.exists()]
+    return tuple(sorted((str(p), st.st_mtime_ns, st.st_size) for p in files for st in [p.stat()]))
+
+def index_version(db_dir=None) -> Optional[str]:
+    """Versión del índice en disco: el snapshot al que apunta CURRENT o, con el layout antiguo, un hash de sus ficheros."""
+    db_dir = db_dir or DB_DIR
+    version = current_version(db_dir)
+    if version is not None:
+        return version
+    signature = index_signature(db_dir)
+    return "legacy-" + hashlib.sha1(repr(signature).encode()).hexdigest()[:12] if signature else None
+
+def cache_stats() -> dict:
+    return {"retrieval": retrieval_cache.stats(), "query_embeddings": query_embedding_cache.stats()}
+
+def _load() -> PartitionedVectorStore:
+    version = index_version(DB_DIR)
+    embeddings = OllamaBatchEmbeddings(
+        model=os.getenv("EMBEDDING_MODEL"),
+        base_url=os.getenv("OLLAMA_HOST"),
+        batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", 32)),
+        max_concurrency=int(os.getenv("EMBEDDING_CONCURRENCY", 4)),
+    )
+    vectorstore = load_vectorstore(DB_DIR, CachedQueryEmbeddings(embeddings, query_embedding_cache))
+    vectorstore.version = vectorstore.version or version
+    indexed_model = vectorstore.manifest.get("embedding_model")
+    if indexed_model and indexed_model != os.getenv("EMBEDDING_MODEL"):
+        print(f"WARNING: snapshot {vectorstore.version} was embedded with '{indexed_model}' "
+              f"but EMBEDDING_MODEL is '{os.getenv('EMBEDDING_MODEL')}'.")
+    # Índices antiguos (db/ sin snapshots o manifest sin endpoint) se hicieron con /api/embeddings, sin normalizar:
+    # mezclados con consultas normalizadas, las distancias L2 no ordenan bien
+    indexed_endpoint = vectorstore.manifest.get("embedding_endpoint")
+    if indexed_endpoint != EMBED_ENDPOINT:
+        print(f"WARNING: snapshot {vectorstore.version} was embedded with '{indexed_endpoint or '/api/embeddings'}' "
+              f"but queries use {EMBED_ENDPOINT} (L2-normalised vectors); re-run the ingestion to rebuild the index.")
+    return vectorstore
+
+def _index_check_due() -> bool:
+    return INDEX_CHECK_INTERVAL > 0 and time.monotonic() - _checked_at >= INDEX_CHECK_INTERVAL
+
+def _refresh_if_changed(vectorstore: PartitionedVectorStore) -> PartitionedVectorStore:
+    """Si toca comprobarlo y el snapshot en disco no es el cargado, lo carga aquí; si falla se sigue con el actual."""
+    global _checked_at
+    if not _index_check_due():
+        return vectorstore
+    _checked_at = time.monotonic()
+    version = index_version(DB_DIR)
+    if version is None or version == vectorstore.version:
+        return vectorstore
+    try:
+        refresh_vectorstore()
+    except Exception as e:
+        print(f"WARNING: reload of snapshot {version} failed, keeping {vectorstore.version}: {e}")
+    return _vectorstore
+
+def get_vectorstore() -> PartitionedVectorStore:
+    global _vectorstore, _loaded_at
+    vectorstore = _vectorstore
+    if vectorstore is not None:
+        return _refresh_if_changed(vectorstore)
+    with _lock:
+        if _vectorstore is None:
+            try:   
+                _vectorstore = _load()
+                _loaded_at = time.time()
+                print(f"FAISS partitions loaded successfully from {DB_DIR} (version {_vectorstore.version}): "
+                      f"{', '.join(_vectorstore.slugs)}.")
+            except Exception as e:
+                print(f"CRITICAL: Failed to load FAISS index from {DB_DIR}. Error: {e}")
+                raise  
+        return _vectorstore
+
+def refresh_vectorstore(warmup_query: Optional[str] = None) -> bool:
+    """Si en disco hay un snapshot distinto del activo, lo carga y calienta aparte y después sustituye la referencia.
+
+    Las peticiones en curso terminan con el índice que ya tenían; el antiguo se libera cuando la última lo suelta
+    (los ficheros mapeados siguen siendo legibles aunque la ingesta borre su snapshot). Devuelve si hubo cambio.
+    """
+    global _vectorstore, _loaded_at
+    with _reload_lock:
+        old = _vectorstore
+        version = index_version(DB_DIR)
+        if old is None or version is None or version == old.version:
+            return False
+        start = time.perf_counter()
+        new = _load()
+        if warmup_query:
+            try:
+                new.hybrid_search(warmup_query, k=SEARCH_K)
+            except Exception as e:
+                print(f"WARNING: warmup of snapshot {new.version} failed: {e}")
         with _lock:
-            if _retriever is None:  
-                try:   
-                    embeddings = OllamaEmbeddings(
-                        model=os.getenv("EMBEDDING_MODEL"),
-                        base_url=os.getenv("OLLAMA_HOST")
-                    )      
-                    _vectorstore = FAISS.load_local(
-                        DB_DIR,
-                        embeddings,
-                        allow_dangerous_deserialization=True
-                    )
-                    _retriever = _vectorstore.as_retriever(search_kwargs=search_kwargs)
-                    print(f"FAISS index loaded successfully from {DB_DIR}.")
-                except Exception as e:
-                    print(f"CRITICAL: Failed to load FAISS index from {DB_DIR}. Error: {e}")
-                    raise  
-    return _retriever
+            _vectorstore = new
+            _loaded_at = time.time()
+        index_reload_seconds.observe(time.perf_counter() - start)
+        index_swaps.inc()
+        # Las claves de la caché de resultados llevan la versión: lo antiguo ya no se consultará
+        retrieval_cache.clear()
+        if old.manifest.get("embedding_model") != new.manifest.get("embedding_model"):
+            query_embedding_cache.clear()
+        print(f"FAISS index swapped {old.version} -> {new.version} in {time.perf_counter() - start:.2f}s.")
+    del old
+    gc.collect()
+    return True
+
+def index_status() -> dict:
+    vectorstore = _vectorstore
+    status = {"active_version": None, "loaded_at": _loaded_at, "available_version": index_version(DB_DIR),
+              "partitions": [], "manifest": {}}
+    if vectorstore is not None:
+        manifest = vectorstore.manifest
+        status.update(
+            active_version=vectorstore.version,
+            partitions=vectorstore.slugs,
+            manifest={k: manifest[k] for k in ("created_at", "embedding_model", "tokenizer", "chunking", "index_type",
+                                                "n_docs", "n_chunks") if k in manifest},
+        )
+    return status
+
+WARMUP_QUERY = os.getenv("WARMUP_QUERY", "deducción por alquiler de vivienda habitual")
+
+def _mb(n) -> str:
+    return f"{n / 1e6:.1f} MB" if n is not None else "n/a"
+
+def preload_vectorstore(warmup_query: Optional[str] = WARMUP_QUERY) -> PartitionedVectorStore:
+    """Carga el índice al arrancar y, con `warmup_query`, hace una búsqueda híbrida para abrir la conexión con Ollama
+    y traer a memoria las páginas del índice, así la primera petición real no paga la carga."""
+    before = metrics.process_memory()
+    start = time.perf_counter()
+    vectorstore = get_vectorstore()
+    load_seconds = time.perf_counter() - start
+    if warmup_query:
+        vectorstore.hybrid_search(warmup_query, k=SEARCH_K)
+        count_tokens(warmup_query)  # carga el tokenizer del ensamblado de contexto
+    after = metrics.process_memory()
+    print(f"FAISS index ready in {load_seconds:.2f}s (warmup {time.perf_counter() - start - load_seconds:.2f}s). "
+          f"RSS {_mb(before['rss'])} -> {_mb(after['rss'])} (anon {_mb(after['anon'])}, file-backed/mmap {_mb(after['file'])}).")
+    return vectorstore
+
+async def aget_vectorstore() -> PartitionedVectorStore:
+    # Ya cargado no hace falta salir del event loop; la primera carga y la comprobación periódica del snapshot van a un hilo
+    vectorstore = _vectorstore
+    if vectorstore is not None and not _index_check_due():
+        return vectorstore
+    return await asyncio.to_thread(get_vectorstore)
+
+# Presupuesto de tiempo por herramienta: pasado ese tiempo el agente recibe un mensaje degradado en vez de esperar
+TOOL_TIMEOUTS = {
+    "regional_tax_deductions_details": float(os.getenv("TOOL_TIMEOUT_DETAILS", 10)),
+    "list_regional_tax_deductions": float(os.getenv("TOOL_TIMEOUT_LIST", 2)),
+    "internet_search_tool": float(os.getenv("TOOL_TIMEOUT_SEARCH", 12)),
+}
+
+DEGRADED_MESSAGES: set[str] = set()
+
+def is_degraded_result(content) -> bool:
+    """Si el resultado de una herramienta es un mensaje degradado (tiempo agotado) o de error."""
+    return isinstance(content, str) and (content in DEGRADED_MESSAGES or content.startswith("Error"))
+
+def tool_budget(degraded_message: str):
+    """Mide la latencia de la herramienta y la corta al agotar su presupuesto de TOOL_TIMEOUTS."""
+    DEGRADED_MESSAGES.add(degraded_message)
+    def decorator(fn):
+        name = fn.__name__
+        latency = metrics.histogram(f"tool_{name}_seconds", f"Latencia de la herramienta {name}")
+        timeouts = metrics.counter(f"tool_{name}_timeouts_total", f"Llamadas a {name} cortadas por tiempo")
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            timeout = TOOL_TIMEOUTS.get(name)
+            with tracing.span(f"tool_{name}", latency):
+                try:
+                    return await asyncio.wait_for(fn(*args, **kwargs), timeout)
+                except asyncio.TimeoutError:
+                    timeouts.inc()
+                    print(f"WARNING: tool {name} exceeded its {timeout}s budget.")
+                    return degraded_message
+        return wrapper
+    return decorator
 
 DEDUCCIONES_DATA_PATH = project_root / "scraping" / "data" / "deducciones_por_ccaa.json"
 DEDUCCIONES_POR_CCAA = {}
@@ -53,14 +242,44 @@ except:
 VALID_SLUGS = list(DEDUCCIONES_POR_CCAA.keys())
 SLUGS_DESCRIPTION = ", ".join([f"'{s}'" for s in VALID_SLUGS]) if VALID_SLUGS else "No hay slugs cargados."
 
-@tool
-def regional_tax_deductions_details(query: str) -> str:
-    """Busca fragmentos relevantes sobre deducciones autonómicas específicas cuando necesitas detalles como el importe, los requisitos, compatibilidad, etc. Proporciona la consulta de búsqueda como argumento."""
-    retriever = get_retriever()  
-    docs = retriever.invoke(query)
+@tool(
+    description="""Busca fragmentos relevantes sobre deducciones autonómicas específicas cuando necesitas detalles como el importe, los requisitos, compatibilidad, etc. Proporciona la consulta de búsqueda como argumento.
+    Si la pregunta se refiere a una o varias comunidades autónomas, indica su slug (o lista de slugs) en 'ccaa_slugs' para buscar solo en ellas; si no, se busca en todas.
+    Los slugs válidos actualmente cargados son: {slugs}.
+    'mode' es opcional: 'hybrid' (por defecto) combina búsqueda semántica y por palabras exactas, 'lexical' busca solo términos literales (p. ej. "familia numerosa", "discapacidad igual o superior al 33") y 'vector' solo por similitud semántica.
+    """.format(slugs=SLUGS_DESCRIPTION)
+)
+@tool_budget("La búsqueda de detalles no respondió a tiempo. Responde con la información de la que dispongas "
+             "o indica al usuario que lo intente de nuevo en unos instantes.")
+async def regional_tax_deductions_details(query: str, ccaa_slugs: Optional[Union[str, List[str]]] = None,
+                                          mode: Optional[Literal["hybrid", "lexical", "vector"]] = None) -> str:
+    vectorstore = await aget_vectorstore()
+    mode = mode or RETRIEVAL_MODE
+    slugs_key = tuple(sorted({ccaa_slugs} if isinstance(ccaa_slugs, str) else set(ccaa_slugs or [])))
+    cache_key = (vectorstore.version, normalize_query(query), slugs_key, mode, SEARCH_K)
+    cached = retrieval_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    try:
+        if mode == "lexical":
+            with tracing.span("bm25_search"):
+                docs = [doc for doc, _ in await vectorstore.alexical_search_with_score(query, k=SEARCH_K, ccaa_slugs=ccaa_slugs)]
+        else:
+            vectorstore.select_slugs(ccaa_slugs)  # valida los slugs antes de pagar el embedding
+            # Si no está en caché, CachedQueryEmbeddings lo mide como etapa "embedding"
+            embedding = await vectorstore.embeddings.aembed_query(query)
+            search = vectorstore.ahybrid_search if mode == "hybrid" else vectorstore.asimilarity_search
+            with tracing.span("faiss_search"):
+                docs = await search(query, k=SEARCH_K, ccaa_slugs=ccaa_slugs, embedding=embedding)
+    except UnknownCCAAError as e:
+        return str(e)
     if not docs:
         return "No se han encontrado documentos relevantes para esa consulta."
-    return "\n\n".join(f"* {doc.page_content}" for doc in docs)
+    # Agrupa por subapartado, quita solapamientos y prefijos repetidos y recorta a CONTEXT_TOKEN_BUDGET
+    with tracing.span("context_assembly"):
+        result, _ = await asyncio.to_thread(assemble_context, docs)
+    retrieval_cache.set(cache_key, result)
+    return result
 
 @tool(
     description="""Proporciona una lista de los nombres de las deducciones fiscales disponibles para una o varias comunidades autónomas (CCAA) de España.
@@ -68,7 +287,8 @@ def regional_tax_deductions_details(query: str) -> str:
     Los slugs válidos actualmente cargados son: {slugs}. Es preferible usar esta herramienta a {name}.
     """.format(slugs=SLUGS_DESCRIPTION, name=str(regional_tax_deductions_details))
 )
-def list_regional_tax_deductions(ccaa_slugs: Union[str, List[str]]) -> str: 
+@tool_budget("No se pudo obtener la lista de deducciones a tiempo. Inténtalo con regional_tax_deductions_details.")
+async def list_regional_tax_deductions(ccaa_slugs: Union[str, List[str]]) -> str: 
     if not DEDUCCIONES_POR_CCAA:
         return "No hay datos de deducciones autonómicas cargados. Verifica la configuración del scraper."
 
@@ -96,33 +316,39 @@ def list_regional_tax_deductions(ccaa_slugs: Union[str, List[str]]) -> str:
 
     return "\n\n".join(results)
 
+ALLOWED_SEARCH_DOMAINS: List[str] = ["https://declarando.es/", "https://sede.agenciatributaria.gob.es/", "https://taxdown.es/", "https://taxscouts.es/"]
+_web_search = None
+
+def get_web_search() -> TavilySearch:
+    global _web_search
+    if _web_search is None:
+        _web_search = TavilySearch(cache=SearchCache())
+        register_cache_metrics("search_memory", _web_search.cache.memory)
+    return _web_search
+
+async def aclose_web_search():
+    if _web_search is not None:
+        await _web_search.aclose()
+
 @tool
-def internet_search_tool(query: str) -> str:
+@tool_budget("La búsqueda en internet no respondió a tiempo. Responde con la información de la que dispongas.")
+async def internet_search_tool(query: str) -> str:
     """Realiza una búsqueda en internet. Se recomienda usarlo solo como último recurso si el resto de herramientas no dan los resultados deseados. 
     """
-    ALLOWED_SEARCH_DOMAINS: List[str] = ["https://declarando.es/", "https://sede.agenciatributaria.gob.es/", "https://taxdown.es/", "https://taxscouts.es/"]
-
     if not os.getenv("TAVILY_API_KEY"):
         return "Error: La variable de entorno TAVILY_API_KEY no está configurada. Esta herramienta no puede funcionar."
-    
-    search_kwargs = {}
-    if ALLOWED_SEARCH_DOMAINS: 
-        search_kwargs['include_domains'] = ALLOWED_SEARCH_DOMAINS
-        
+
+    web_search = get_web_search()
     try:
-        tavily_tool = TavilySearchResults(max_results=3, **search_kwargs)
-        search_results = tavily_tool.invoke({"query": query})
-        if isinstance(search_results, list) and all(isinstance(item, dict) for item in search_results):
-             formatted_results = []
-             for i, res in enumerate(search_results): 
-                 title = res.get('title', 'N/A')
-                 url = res.get('url', 'N/A')
-                 content_snippet = res.get('content', 'N/A')[:250] + "..." 
-                 formatted_results.append(f"Resultado {i+1}:\nTitulo: {title}\nURL: {url}\nFragmento: {content_snippet}")
-             return "\n\n".join(formatted_results) if formatted_results else "No se encontraron resultados."
-        elif isinstance(search_results, str): 
-            return search_results
-        else:
-            return "Formato de resultados de búsqueda inesperado."
+        search_results = await web_search.search(query, include_domains=ALLOWED_SEARCH_DOMAINS, max_results=3)
+    except asyncio.TimeoutError:
+        return f"Error: la búsqueda en internet no respondió en {web_search.timeout:.0f} segundos."
     except Exception as e:
-        return f"Error durante la búsqueda en internet: {str(e)}" 
\ No newline at end of file
+        return f"Error durante la búsqueda en internet: {str(e)}"
+    formatted_results = []
+    for i, res in enumerate(search_results):
+        title = res.get('title') or 'N/A'
+        url = res.get('url') or 'N/A'
+        content_snippet = (res.get('content') or 'N/A')[:250] + "..."
+        formatted_results.append(f"Resultado {i+1}:\nTitulo: {title}\nURL: {url}\nFragmento: {content_snippet}")
+    return "\n\n".join(formatted_results) if formatted_results else "No se encontraron resultados."
@@ -0,0 +1,132 @@
+"""Trazas por petición: cada etapa (LLM, embeddings, FAISS, resumen, checkpoints, rate limit...) se mide con un
+span que alimenta su histograma y, si hay una petición en curso, su desglose de tiempos.
+
+La traza activa viaja en un ContextVar, así que la ven también las tareas y hilos que lanza la petición
+(nodos de LangGraph, asyncio.to_thread) sin pasarla explícitamente.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from app import metrics
+from app.logging_config import logger
+
+TRACE_LOG = os.getenv("TRACE_LOG", "0") == "1"
+
+_current: ContextVar["RequestTrace | None"] = ContextVar("request_trace", default=None)
+_active = 0
+_active_lock = threading.Lock()
+
+request_seconds = metrics.histogram("request_duration_seconds", "Duración total de las peticiones trazadas")
+metrics.gauge("requests_in_flight", "Peticiones trazadas en curso", fn=lambda: _active)
+
+
+def stage_histogram(stage: str) -> metrics.Histogram:
+    return metrics.histogram(f"stage_{stage}_seconds", f"Duración de la etapa {stage}")
+
+
+class RequestTrace:
+    """Desglose de una petición: por etapa, número de spans y tiempo acumulado (las etapas pueden anidarse)."""
+
+    def __init__(self, name: str, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.started = time.perf_counter()
+        self.ttft = None
+        self.stages: dict[str, list] = {}
+        self._lock = threading.Lock()
+        self._finished = False
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            entry = self.stages.setdefault(stage, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def first_token(self):
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.started
+
+    def breakdown(self) -> dict:
+        with self._lock:
+            return {stage: {"count": n, "ms": round(total * 1000, 1)} for stage, (n, total) in self.stages.items()}
+
+    def finish(self) -> float:
+        global _active
+        total = time.perf_counter() - self.started
+        if self._finished:
+            return total
+        self._finished = True
+        with _active_lock:
+            _active -= 1
+        request_seconds.observe(total)
+        if TRACE_LOG:
+            # En el fichero JSON el desglose va también como campos (trace_*) además de en el mensaje
+            breakdown = self.breakdown()
+            ttft_ms = round(self.ttft * 1000) if self.ttft is not None else None
+            logger.info("Trace %s %s total=%.0fms ttft=%sms %s", self.name,
+                        " ".join(f"{k}={v}" for k, v in self.attributes.items()), total * 1000, ttft_ms,
+                        " ".join(f"{stage}={v['ms']}ms/{v['count']}" for stage, v in breakdown.items()),
+                        extra={"trace_name": self.name, "trace_attributes": self.attributes,
+                               "trace_total_ms": round(total * 1000, 1), "trace_ttft_ms": ttft_ms,
+                               "trace_stages": breakdown})
+        return total
+
+
+def start_trace(name: str, **attributes) -> RequestTrace:
+    """Crea la traza de la petición y la deja activa en el contexto actual."""
+    global _active
+    trace = RequestTrace(name, **attributes)
+    with _active_lock:
+        _active += 1
+    _current.set(trace)
+    return trace
+
+
+def current_trace() -> RequestTrace | None:
+    return _current.get()
+
+
+def observe(stage: str, seconds: float, histogram: metrics.Histogram | None = None, trace: RequestTrace | None = None):
+    (histogram or stage_histogram(stage)).observe(seconds)
+    trace = trace or _current.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+@contextmanager
+def span(stage: str, histogram: metrics.Histogram | None = None):
+    """Mide el bloque como etapa `stage`; con `histogram` se usa ese en lugar de stage_<stage>_seconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, histogram)
+
+
+class StageCallbackHandler(BaseCallbackHandler):
+    """Mide las llamadas a modelos de chat: "llm" las del nodo del agente y "summarizer_llm" las del resumen."""
+
+    def __init__(self, trace: RequestTrace | None = None):
+        self.trace = trace
+        self._starts: dict[UUID, tuple[str, float]] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        self._starts[run_id] = ("llm" if node == "agent" else "summarizer_llm", time.perf_counter())
+
+    def _end(self, run_id: UUID):
+        started = self._starts.pop(run_id, None)
+        if started is not None:
+            observe(started[0], time.perf_counter() - started[1], trace=self.trace)
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs):
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id: UUID, **kwargs):
+        self._end(run_id)
@@ -6,9 +6,13 @@ from langchain_openai import ChatOpenAI
 from pydantic import Field, SecretStr
 from langchain_core.messages import BaseMessage 
 from pydantic import BaseModel
-from fastapi import HTTPException, Request
 import time
+import copy
+import asyncio
+from langmem.short_term import SummarizationNode
 from app.logging_config import logger
+from app import metrics, tracing
+from app.rate_limit import RateLimiter  # se mantiene la importación desde app.utils
 load_dotenv()
 
 class ChatOpenRouter(ChatOpenAI):
@@ -25,7 +29,13 @@ class ChatOpenRouter(ChatOpenAI):
         openai_api_key = openai_api_key or os.environ.get("OPENROUTER_API_KEY")
         super().__init__(base_url="https://openrouter.ai/api/v1", openai_api_key=openai_api_key, **kwargs)
         
-def custom_summarize_llm_input(state_dict: dict|BaseModel, internal_summarizer, n_last_messages) -> dict:
+SUMMARY_MODE = os.getenv("SUMMARY_MODE", "background")  # "background" o "inline"
+summarization_inline_seconds = metrics.histogram(
+    "summarization_inline_seconds", "Resúmenes hechos dentro del pre_model_hook (en el camino crítico)")
+summarization_background_seconds = metrics.histogram(
+    "summarization_background_seconds", "Resúmenes hechos en segundo plano tras enviar la respuesta")
+
+def _split_messages(state_dict: dict|BaseModel, n_last_messages: int) -> tuple[list[BaseMessage], list[BaseMessage]]:
     if isinstance(state_dict, dict):
         original_messages = state_dict.get("messages")
         #context = state_dict.get("context", {})
@@ -34,15 +44,26 @@ def custom_summarize_llm_input(state_dict: dict|BaseModel, internal_summarizer,
         #context = getattr(state_dict, "context", {})
     else:
         raise ValueError(f"Invalid input type: {type(state_dict)}")
-    messages_to_summarize_list = original_messages[:-n_last_messages]
-    last_two_messages = original_messages[-n_last_messages:]
+    return original_messages[:-n_last_messages], original_messages[-n_last_messages:]
+
+def _summary_changed(state_dict, summary_output_dict: dict) -> bool:
+    context = state_dict.get("context") if isinstance(state_dict, dict) else getattr(state_dict, "context", None)
+    previous = (context or {}).get("running_summary")
+    return summary_output_dict.get("context", {}).get("running_summary") not in (None, previous)
+
+def custom_summarize_llm_input(state_dict: dict|BaseModel, internal_summarizer, n_last_messages) -> dict:
+    messages_to_summarize_list, last_two_messages = _split_messages(state_dict, n_last_messages)
     summarized_messages_list: list[BaseMessage] = []
     
     state_update = {}
     if messages_to_summarize_list:
         state_dict["messages_to_summarize_input_key"] = messages_to_summarize_list
         try:
-            summary_output_dict = internal_summarizer.invoke(state_dict)
+            start = time.perf_counter()
+            with tracing.span("pre_model_hook"):
+                summary_output_dict = internal_summarizer.invoke(state_dict)
+            if _summary_changed(state_dict, summary_output_dict):
+                summarization_inline_seconds.observe(time.perf_counter() - start)
             summarized_messages_list = summary_output_dict.get("summarized_part_output_key", [])
             state_update = summary_output_dict
         except Exception as e:
@@ -53,43 +74,83 @@ def custom_summarize_llm_input(state_dict: dict|BaseModel, internal_summarizer,
     state_update["llm_input_messages"] = final_llm_input_list
     return state_update
 
-class RateLimiter:
-    request_counters = {} 
-    def __init__(self, requests_limit: int, time_window: int, limit_type: str = "ip_path"):
-        self.requests_limit = requests_limit
-        self.time_window = time_window
-        self.limit_type = limit_type
-
-    async def __call__(self, request: Request):
-        client_ip = request.client.host
-        route_path = request.url.path
-        current_time = int(time.time())
-
-        if self.limit_type == "ip_path":
-            key = f"ip:{client_ip}:{route_path}"
-        elif self.limit_type == "global_path":
-            key = f"global:{route_path}" 
-        else: 
-            raise ValueError("Invalid limit_type specified for RateLimiter")
-
-        if key not in RateLimiter.request_counters:
-            RateLimiter.request_counters[key] = {"timestamp": current_time, "count": 1}
-        else:
-            if current_time - RateLimiter.request_counters[key]["timestamp"] > self.time_window:
-                RateLimiter.request_counters[key]["timestamp"] = current_time
-                RateLimiter.request_counters[key]["count"] = 1
-            else:
-                if RateLimiter.request_counters[key]["count"] >= self.requests_limit:
-                    
-                    detail_msg = f"Too Many Requests. Limit type: {self.limit_type}"
-                    if self.limit_type == "global_path":
-                        logger.warning(f"Global rate limit hit for path {route_path}. Limit: {self.requests_limit}/{self.time_window}s. Current count: {RateLimiter.request_counters[key]['count']}")
-                    raise HTTPException(status_code=429, detail=detail_msg)
-                else:
-                    RateLimiter.request_counters[key]["count"] += 1
-            
-        for k in list(RateLimiter.request_counters.keys()):
-            if k.startswith(f"{self.limit_type.split('_')[0]}:"): 
-                 if current_time - RateLimiter.request_counters[k]["timestamp"] > self.time_window:
-                    RateLimiter.request_counters.pop(k, None)
+async def acustom_summarize_llm_input(state_dict: dict|BaseModel, internal_summarizer, n_last_messages) -> dict:
+    """Versión async de custom_summarize_llm_input: el resumen no bloquea el event loop del resto de conversaciones."""
+    messages_to_summarize_list, last_two_messages = _split_messages(state_dict, n_last_messages)
+    summarized_messages_list: list[BaseMessage] = []
+
+    state_update = {}
+    if messages_to_summarize_list:
+        state_dict["messages_to_summarize_input_key"] = messages_to_summarize_list
+        try:
+            start = time.perf_counter()
+            with tracing.span("pre_model_hook"):
+                summary_output_dict = await internal_summarizer.ainvoke(state_dict)
+            if _summary_changed(state_dict, summary_output_dict):
+                summarization_inline_seconds.observe(time.perf_counter() - start)
+            summarized_messages_list = summary_output_dict.get("summarized_part_output_key", [])
+            state_update = summary_output_dict
+        except Exception as e:
+            print(f"Error al invocar el internal_summarizer: {e}")
+            summarized_messages_list = messages_to_summarize_list
+
+    state_update["llm_input_messages"] = summarized_messages_list + last_two_messages
+    return state_update
+
+def deferred_summarizer(internal_summarizer: SummarizationNode) -> SummarizationNode:
+    """Copia del SummarizationNode que solo resume en línea cuando el historial ya no cabe en `max_tokens`.
+
+    Por debajo de ese límite usa el resumen acumulado (context["running_summary"]) más los mensajes nuevos
+    sin llamar al LLM; BackgroundSummaries se encarga de ir plegándolos después de cada respuesta.
+    """
+    deferred = copy.copy(internal_summarizer)
+    deferred.max_tokens_before_summary = internal_summarizer.max_tokens - internal_summarizer.max_summary_tokens
+    return deferred
+
+class BackgroundSummaries:
+    """Actualiza el resumen de un hilo en segundo plano, una vez enviada la respuesta.
+
+    El siguiente turno del mismo hilo espera (como mucho `wait_timeout` s) a que termine el refresco pendiente,
+    así nunca se pisan dos actualizaciones de context["running_summary"].
+    """
+
+    def __init__(self, agent, internal_summarizer: SummarizationNode, wait_timeout: float = 10.0):
+        self.agent = agent
+        self.internal_summarizer = internal_summarizer
+        self.wait_timeout = wait_timeout
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    async def refresh(self, config: dict) -> bool:
+        snapshot = await self.agent.aget_state(config)
+        messages = snapshot.values.get("messages", [])
+        context = snapshot.values.get("context", {})
+        if not messages or snapshot.next:
+            return False
+        start = time.perf_counter()
+        output = await self.internal_summarizer.ainvoke(
+            {"messages_to_summarize_input_key": messages, "context": context})
+        if not _summary_changed({"context": context}, output):
+            return False
+        summarization_background_seconds.observe(time.perf_counter() - start)
+        await self.agent.aupdate_state(config, {"context": output["context"]}, as_node="agent")
         return True
+
+    async def _run(self, config: dict):
+        try:
+            await self.refresh(config)
+        except Exception as e:
+            logger.warning("Background summary failed for thread_id %s: %s", config['configurable']['thread_id'], e)
+
+    def schedule(self, config: dict):
+        thread_id = config["configurable"]["thread_id"]
+        task = asyncio.create_task(self._run(config))
+        self._tasks[thread_id] = task
+        task.add_done_callback(lambda t: self._tasks.pop(thread_id, None) if self._tasks.get(thread_id) is t else None)
+
+    async def wait(self, thread_id: str):
+        task = self._tasks.get(thread_id)
+        if task is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(task), self.wait_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Background summary for thread_id %s still running; continuing without it.", thread_id)
@@ -301,6 +301,11 @@ document.addEventListener('DOMContentLoaded', () => {
                                         } else {
                                             console.warn("botMessageElement is null, cannot display sources.");
                                         }
+                                    } else if (parsedData.event === 'tool_start') {
+                                        // Progreso mientras se ejecuta una herramienta, hasta que llegue el texto
+                                        if (botMessageElement && !currentBotText) {
+                                            botMessageElement.innerHTML = `<em>Consultando ${parsedData.tool}...</em>`;
+                                        }
                                     } else if (parsedData.event === 'end') {
                                         // console.log("Received 'end' event."); 
                                     }
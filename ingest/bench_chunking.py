@@ -0,0 +1,89 @@
+"""Compara el troceado anterior (un splitter por documento) con el Chunker por lotes sobre el corpus real.
+
+Uso: python ingest/bench_chunking.py [--repeat 3] [--workers 4]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+from langchain.schema import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from transformers import AutoTokenizer
+
+load_dotenv()
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from ingest.chunking import Chunker, build_prefijo, split_documents_parallel
+
+DATA_DIR = Path("scraping/data")
+TOKENIZER_NAME = 'mixedbread-ai/mxbai-embed-large-v1'
+MAX_TOKENS_TOTAL = int(os.getenv("MAX_TOKENS_TOTAL", 512))
+CHUNK_OVERLAP = 64
+
+
+def split_legacy(doc: Document, tokenizer) -> list[Document]:
+    """Ruta anterior: tokeniza el prefijo y crea un splitter nuevo para cada documento."""
+    prefijo = build_prefijo(doc.metadata)
+    n_tokens_prefijo = len(tokenizer.encode(prefijo, add_special_tokens=False))
+    chunk_size = max(32, MAX_TOKENS_TOTAL - n_tokens_prefijo)
+    splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+        tokenizer=tokenizer,
+        chunk_size=chunk_size,
+        chunk_overlap=CHUNK_OVERLAP
+    )
+    return [Document(page_content=f"{prefijo}\n{chunk}", metadata=doc.metadata)
+            for chunk in splitter.split_text(doc.page_content)]
+
+
+def cargar_corpus() -> list[Document]:
+    documents = []
+    for jsonl_path in sorted(DATA_DIR.glob("*.jsonl")):
+        with jsonl_path.open(encoding="utf-8") as f:
+            documents.extend(Document(page_content=d["content"], metadata=d["metadata"])
+                             for d in map(json.loads, f))
+    return documents
+
+
+def medir(nombre: str, fn, repeat: int):
+    tiempos = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = fn()
+        tiempos.append(time.perf_counter() - start)
+    mejor = min(tiempos)
+    print(f"{nombre:<22} {mejor * 1000:9.1f} ms  {len(chunks):6d} chunks")
+    return mejor, chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_NAME)
+    documents = cargar_corpus()
+    if not documents:
+        print(f"No hay documentos en {DATA_DIR}. Ejecuta antes scraping/scrape.py.")
+        return
+    print(f"{len(documents)} documentos, MAX_TOKENS_TOTAL={MAX_TOKENS_TOTAL}, overlap={CHUNK_OVERLAP}\n")
+
+    t_legacy, _ = medir("anterior", lambda: [c for d in documents for c in split_legacy(d, tokenizer)], args.repeat)
+    chunker = Chunker(tokenizer, MAX_TOKENS_TOTAL, CHUNK_OVERLAP)
+    t_batch, chunks = medir("chunker por lotes", lambda: chunker.split_documents(documents), args.repeat)
+    t_pool, _ = medir(f"chunker {args.workers} procesos",
+                      lambda: split_documents_parallel(documents, TOKENIZER_NAME, MAX_TOKENS_TOTAL,
+                                                       CHUNK_OVERLAP, workers=args.workers),
+                      args.repeat)
+
+    # Comprobación fuera del tiempo medido: ningún chunk supera el presupuesto de tokens
+    max_tokens = max(len(tokenizer.encode(c.page_content, add_special_tokens=False)) for c in chunks)
+    print(f"\nMáx. tokens por chunk: {max_tokens} (límite {MAX_TOKENS_TOTAL})")
+    print(f"Aceleración: lotes x{t_legacy / t_batch:.1f}, procesos x{t_legacy / t_pool:.1f}")
+
+
+if __name__ == "__main__":
+    main()
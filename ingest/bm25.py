@@ -0,0 +1,97 @@
+import heapq
+import json
+import math
+import re
+import unicodedata
+from collections import Counter
+from pathlib import Path
+
+BM25_FILE = "bm25.json"
+
+STOPWORDS = {
+    "a", "al", "ante", "con", "como", "cual", "cuales", "cuando", "de", "del", "desde", "donde", "e", "el",
+    "ella", "en", "entre", "es", "esta", "este", "esto", "hay", "la", "las", "le", "les", "lo", "los", "mas",
+    "me", "mi", "o", "para", "pero", "por", "que", "se", "si", "sin", "sobre", "son", "su", "sus", "te",
+    "tu", "u", "un", "una", "uno", "unos", "unas", "y", "ya", "yo",
+}
+_WORD_RE = re.compile(r"\w+")
+_CONSONANT_ES_RE = re.compile(r"[^aeiou]es$")
+
+
+def _sin_acentos(text: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+def _stem(word: str) -> str:
+    # Plurales regulares: "guarderias" -> "guarderia", "donaciones" -> "donacion"
+    if len(word) > 4 and not word.isdigit():
+        if _CONSONANT_ES_RE.search(word):
+            return word[:-2]
+        if word.endswith("s"):
+            return word[:-1]
+    return word
+
+
+def tokenize(text: str) -> list[str]:
+    """Términos de un texto: unigramas normalizados más bigramas, para premiar frases exactas como "familia numerosa"."""
+    words = [_stem(w) for w in _WORD_RE.findall(_sin_acentos(text.lower()))]
+    words = [w for w in words if w not in STOPWORDS]
+    return words + [f"{a}_{b}" for a, b in zip(words, words[1:])]
+
+
+class BM25Index:
+    """Índice invertido BM25 sobre los chunks de una partición; los ids son posiciones en el índice FAISS."""
+
+    def __init__(self, postings: dict[str, list], doc_len: list[int], k1: float = 1.5, b: float = 0.75):
+        self.postings = postings
+        self.doc_len = doc_len
+        self.k1 = k1
+        self.b = b
+        self.avgdl = sum(doc_len) / len(doc_len) if doc_len else 0.0
+
+    @classmethod
+    def build(cls, texts: list[str], **kwargs) -> "BM25Index":
+        postings = {}
+        doc_len = []
+        for doc_id, text in enumerate(texts):
+            terms = tokenize(text)
+            doc_len.append(len(terms))
+            for term, tf in Counter(terms).items():
+                postings.setdefault(term, []).append([doc_id, tf])
+        return cls(postings, doc_len, **kwargs)
+
+    def search(self, query: str, k: int = 5) -> list[tuple[int, float]]:
+        n_docs = len(self.doc_len)
+        scores = Counter()
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, tf in posting:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_len[doc_id] / self.avgdl)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def save(self, directory):
+        with (Path(directory) / BM25_FILE).open("w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "doc_len": self.doc_len, "postings": self.postings}, f,
+                      ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, directory) -> "BM25Index | None":
+        path = Path(directory) / BM25_FILE
+        if not path.exists():
+            return None
+        with path.open(encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["postings"], data["doc_len"], k1=data["k1"], b=data["b"])
+
+
+def reciprocal_rank_fusion(rankings: list[list], k: int = 60) -> list:
+    """Fusiona varias listas ordenadas de claves con RRF: score = sum(1 / (k + posición))."""
+    scores = Counter()
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] += 1 / (k + rank + 1)
+    return [key for key, _ in scores.most_common()]
@@ -0,0 +1,136 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from langchain.schema import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+TOKENIZER_NAME = 'mixedbread-ai/mxbai-embed-large-v1'
+MIN_CHUNK_SIZE = 32
+SENTENCE_ENDINGS = ".;:!?"
+# Posición del chunk dentro de su subapartado: permite volver a unir chunks contiguos al montar el contexto
+CHUNK_INDEX_KEY = "chunk_index"
+
+
+def build_prefijo(metadata: dict) -> str:
+    return (
+        f"[CCAA: {metadata['ccaa']}]"
+        f"[Categoría: {metadata['categoria']}]"
+        f"[Subapartado: {metadata.get('subapartado', '')}]"
+    )
+
+
+class Chunker:
+    """Trocea documentos respetando un máximo de tokens por chunk (prefijo incluido).
+
+    Con un tokenizer "fast" tokeniza todos los prefijos y contenidos de una vez con la API por lotes
+    y corta los chunks usando los offsets de los tokens, sin volver a codificar ningún texto. Con un
+    tokenizer lento recurre al RecursiveCharacterTextSplitter, cacheando un splitter por tamaño efectivo.
+    """
+
+    def __init__(self, tokenizer, max_tokens_total: int, chunk_overlap: int = 64):
+        self.tokenizer = tokenizer
+        self.max_tokens_total = max_tokens_total
+        self.chunk_overlap = chunk_overlap
+        self._splitters = {}
+
+    def chunk_size_for(self, n_tokens_prefijo: int) -> int:
+        return max(MIN_CHUNK_SIZE, self.max_tokens_total - n_tokens_prefijo)
+
+    def split_documents(self, documents: list[Document]) -> list[Document]:
+        if not documents:
+            return []
+        prefijos = [build_prefijo(doc.metadata) for doc in documents]
+        if not getattr(self.tokenizer, "is_fast", False):
+            return [chunk for doc, prefijo in zip(documents, prefijos)
+                    for chunk in self._split_with_splitter(doc, prefijo)]
+
+        n_prefijos = [len(ids) for ids in self.tokenizer(prefijos, add_special_tokens=False)["input_ids"]]
+        contenidos = [doc.page_content for doc in documents]
+        encodings = self.tokenizer(contenidos, add_special_tokens=False, return_offsets_mapping=True)
+
+        chunks = []
+        for doc, prefijo, n_prefijo, offsets in zip(documents, prefijos, n_prefijos, encodings["offset_mapping"]):
+            chunk_size = self.chunk_size_for(n_prefijo)
+            for i, (start, end) in enumerate(self._cortes(doc.page_content, offsets, chunk_size)):
+                texto = doc.page_content[offsets[start][0]:offsets[end - 1][1]]
+                chunks.append(Document(page_content=f"{prefijo}\n{texto}",
+                                       metadata={**doc.metadata, CHUNK_INDEX_KEY: i}))
+        return chunks
+
+    def _cortes(self, text: str, offsets: list, chunk_size: int):
+        """Rangos [start, end) de tokens de cada chunk, con solapamiento de `chunk_overlap` tokens."""
+        n = len(offsets)
+        overlap = min(self.chunk_overlap, chunk_size // 2)
+        start = 0
+        while start < n:
+            end = min(start + chunk_size, n)
+            if end < n:
+                end = self._mejor_corte(text, offsets, start, end)
+            yield start, end
+            if end >= n:
+                break
+            start = self._inicio_de_palabra(text, offsets, max(end - overlap, start + 1), end)
+
+    @staticmethod
+    def _hueco(text: str, offsets: list, i: int) -> str:
+        """Texto entre el token i-1 y el token i (vacío si i continúa la misma palabra)."""
+        return text[offsets[i - 1][1]:offsets[i][0]]
+
+    def _mejor_corte(self, text: str, offsets: list, start: int, end: int) -> int:
+        # Se busca el mejor punto de corte en la segunda mitad de la ventana: salto de línea,
+        # fin de frase o, como mínimo, un espacio para no partir palabras
+        limite = start + (end - start) // 2
+        candidatos = range(end, limite, -1)
+        for es_corte in (
+            lambda i: "\n" in self._hueco(text, offsets, i),
+            lambda i: bool(self._hueco(text, offsets, i)) and text[offsets[i - 1][1] - 1] in SENTENCE_ENDINGS,
+            lambda i: bool(self._hueco(text, offsets, i)),
+        ):
+            for i in candidatos:
+                if es_corte(i):
+                    return i
+        return end
+
+    def _inicio_de_palabra(self, text: str, offsets: list, start: int, end: int) -> int:
+        i = start
+        while i < end and not self._hueco(text, offsets, i):
+            i += 1
+        return i if i < end else start
+
+    def _split_with_splitter(self, doc: Document, prefijo: str) -> list[Document]:
+        n_prefijo = len(self.tokenizer.encode(prefijo, add_special_tokens=False))
+        chunk_size = self.chunk_size_for(n_prefijo)
+        splitter = self._splitters.get(chunk_size)
+        if splitter is None:
+            splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+                tokenizer=self.tokenizer,
+                chunk_size=chunk_size,
+                chunk_overlap=self.chunk_overlap,
+            )
+            self._splitters[chunk_size] = splitter
+        return [Document(page_content=f"{prefijo}\n{chunk}", metadata={**doc.metadata, CHUNK_INDEX_KEY: i})
+                for i, chunk in enumerate(splitter.split_text(doc.page_content))]
+
+
+_worker_chunker = None
+
+
+def _init_worker(tokenizer_name: str, max_tokens_total: int, chunk_overlap: int):
+    global _worker_chunker
+    from transformers import AutoTokenizer
+    _worker_chunker = Chunker(AutoTokenizer.from_pretrained(tokenizer_name), max_tokens_total, chunk_overlap)
+
+
+def _split_shard(documents: list[Document]) -> list[Document]:
+    return _worker_chunker.split_documents(documents)
+
+
+def split_documents_parallel(documents: list[Document], tokenizer_name: str, max_tokens_total: int,
+                             chunk_overlap: int = 64, workers: int = 4, shard_size: int = 256) -> list[Document]:
+    """Trocea un corpus grande repartiendo lotes de documentos entre `workers` procesos.
+
+    Cada proceso carga su propio tokenizer una sola vez; el orden de los chunks se conserva.
+    """
+    shards = [documents[i:i + shard_size] for i in range(0, len(documents), shard_size)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(tokenizer_name, max_tokens_total, chunk_overlap)) as executor:
+        return [chunk for shard in executor.map(_split_shard, shards) for chunk in shard]
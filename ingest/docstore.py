@@ -0,0 +1,108 @@
+import json
+import pickle
+import sqlite3
+import threading
+from pathlib import Path
+
+from langchain.docstore.document import Document
+
+from ingest.chunking import CHUNK_INDEX_KEY
+
+DOCSTORE_FILE = "docstore.sqlite"
+
+
+def write_docstore(directory, chunks: list[Document], ids: list[str]) -> Path:
+    """Guarda los chunks en orden de vector (la posición FAISS es la clave) con los metadatos internados.
+
+    Los chunks de un mismo subapartado comparten exactamente los mismos metadatos, así que cada combinación
+    distinta se guarda una sola vez y los chunks la referencian por id; la posición del chunk dentro del
+    subapartado (lo único que los distingue) va en su propia columna.
+    """
+    path = Path(directory) / DOCSTORE_FILE
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.unlink(missing_ok=True)
+    conn = sqlite3.connect(tmp_path)
+    conn.executescript(
+        """
+        CREATE TABLE metadata (id INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE);
+        CREATE TABLE chunks (pos INTEGER PRIMARY KEY, id TEXT NOT NULL, content TEXT NOT NULL, metadata_id INTEGER NOT NULL,
+                             chunk_index INTEGER);
+        """
+    )
+    interned = {}
+    rows = []
+    for pos, (chunk, chunk_id) in enumerate(zip(chunks, ids)):
+        metadata = dict(chunk.metadata)
+        chunk_index = metadata.pop(CHUNK_INDEX_KEY, None)
+        key = json.dumps(metadata, ensure_ascii=False, sort_keys=True)
+        if key not in interned:
+            interned[key] = len(interned)
+        rows.append((pos, chunk_id, chunk.page_content, interned[key], chunk_index))
+    conn.executemany("INSERT INTO metadata (id, value) VALUES (?, ?)", [(i, k) for k, i in interned.items()])
+    conn.executemany("INSERT INTO chunks (pos, id, content, metadata_id, chunk_index) VALUES (?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+    tmp_path.replace(path)
+    return path
+
+
+class SQLiteDocstore:
+    """Docstore de solo lectura sobre docstore.sqlite: solo los metadatos internados (pocos) quedan en memoria,
+    el texto de cada chunk se lee por posición cuando una búsqueda lo devuelve."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._metadata = {i: json.loads(v) for i, v in self._conn.execute("SELECT id, value FROM metadata")}
+        self._size = self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(chunks)")}
+        # Docstores anteriores a chunk_index: los chunks salen sin esa clave
+        self._chunk_index_column = "chunk_index" if "chunk_index" in columns else "NULL"
+
+    def __len__(self):
+        return self._size
+
+    def get_many(self, positions: list[int]) -> list[Document]:
+        if not positions:
+            return []
+        placeholders = ",".join("?" * len(positions))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT pos, id, content, metadata_id, {self._chunk_index_column} FROM chunks "
+                f"WHERE pos IN ({placeholders})", positions).fetchall()
+        by_pos = {}
+        for pos, chunk_id, content, metadata_id, chunk_index in rows:
+            metadata = dict(self._metadata[metadata_id])
+            if chunk_index is not None:
+                metadata[CHUNK_INDEX_KEY] = chunk_index
+            by_pos[pos] = Document(id=chunk_id, page_content=content, metadata=metadata)
+        return [by_pos[p] for p in positions]
+
+    def get(self, position: int) -> Document:
+        return self.get_many([position])[0]
+
+    def close(self):
+        self._conn.close()
+
+
+class PickledDocstore:
+    """Particiones antiguas (index.pkl de FAISS.save_local): se cargan enteras en memoria como antes."""
+
+    def __init__(self, path):
+        with (Path(path) / "index.pkl").open("rb") as f:
+            self._docstore, self._index_to_id = pickle.load(f)
+
+    def __len__(self):
+        return len(self._index_to_id)
+
+    def get_many(self, positions: list[int]) -> list[Document]:
+        return [self._docstore.search(self._index_to_id[p]) for p in positions]
+
+    def get(self, position: int) -> Document:
+        return self.get_many([position])[0]
+
+
+def load_docstore(directory):
+    path = Path(directory) / DOCSTORE_FILE
+    return SQLiteDocstore(path) if path.exists() else PickledDocstore(directory)
@@ -0,0 +1,80 @@
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """Envuelve un modelo de embeddings con una caché persistente en SQLite.
+
+    La clave es (modelo, sha256 del texto), así que un chunk idéntico nunca se vuelve a embeber
+    aunque cambie de CCAA, de posición o de ejecución. Solo se cachean documentos, no consultas.
+    """
+
+    def __init__(self, underlying: Embeddings, model: str, path):
+        self.underlying = underlying
+        self.model = model
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, text_hash))"
+        )
+        self._conn.commit()
+
+    def _lookup(self, hashes: list[str]) -> dict[str, list[float]]:
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+        # SQLite limita el número de parámetros por consulta
+        for i in range(0, len(unique), 500):
+            batch = unique[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [self.model, *batch],
+                ).fetchall()
+            for h, blob in rows:
+                found[h] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        hashes = [text_hash(t) for t in texts]
+        cached = self._lookup(hashes)
+
+        missing = {}
+        for h, text in zip(hashes, texts):
+            if h not in cached and h not in missing:
+                missing[h] = text
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            vectors = self.underlying.embed_documents(list(missing.values()))
+            rows = []
+            for h, vector in zip(missing, vectors):
+                cached[h] = list(vector)
+                rows.append((self.model, h, np.asarray(vector, dtype=np.float32).tobytes()))
+            with self._lock:
+                self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+                self._conn.commit()
+
+        return [cached[h] for h in hashes]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.underlying.embed_query(text)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await self.underlying.aembed_query(text)
@@ -0,0 +1,177 @@
+import asyncio
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+import httpx
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_OLLAMA_HOST = "http://localhost:11434"
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# Endpoint de lotes de Ollama; sus vectores vienen normalizados (L2), a diferencia de los de /api/embeddings
+EMBED_ENDPOINT = "/api/embed"
+
+
+@dataclass
+class EmbeddingStats:
+    requests: int = 0
+    texts: int = 0
+    tokens: int = 0
+    seconds: float = 0.0
+
+    @property
+    def texts_per_s(self) -> float:
+        return self.texts / self.seconds if self.seconds else 0.0
+
+    @property
+    def tokens_per_s(self) -> float:
+        return self.tokens / self.seconds if self.seconds else 0.0
+
+    def report(self) -> str:
+        return (f"{self.texts} textos en {self.requests} peticiones, {self.seconds:.1f}s "
+                f"→ {self.texts_per_s:.1f} textos/s, {self.tokens_per_s:.0f} tokens/s")
+
+
+async def close_stale_client(client: httpx.AsyncClient, loop: asyncio.AbstractEventLoop | None):
+    """Cierra el pool de un AsyncClient creado en otro event loop: en ese loop si sigue vivo (otro hilo), si no aquí;
+    las conexiones de un loop ya cerrado pueden fallar al cerrarse, pero el cliente queda liberado igualmente."""
+    if loop is not None and loop.is_running() and loop is not asyncio.get_running_loop():
+        asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+        return
+    try:
+        await client.aclose()
+    except Exception:
+        pass
+
+
+class OllamaBatchEmbeddings(Embeddings):
+    """Cliente de embeddings de Ollama con lotes, concurrencia acotada y reintentos.
+
+    Usa el endpoint `/api/embed`, que acepta varios textos por petición, en lugar de una petición
+    por texto. Los lotes se envían en paralelo (como mucho `max_concurrency` a la vez) reutilizando
+    conexiones keep-alive. Ojo: `/api/embed` devuelve vectores normalizados (L2).
+    """
+
+    def __init__(self, model: str, base_url: str | None = None, batch_size: int = 32,
+                 max_concurrency: int = 4, max_retries: int = 3, backoff_factor: float = 0.5,
+                 timeout: float = 60.0):
+        self.model = model
+        self.base_url = (base_url or os.getenv("OLLAMA_HOST") or DEFAULT_OLLAMA_HOST).rstrip("/")
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.stats = EmbeddingStats()
+        self._stats_lock = threading.Lock()
+        self._client = httpx.Client(base_url=self.base_url, timeout=timeout,
+                                    limits=httpx.Limits(max_keepalive_connections=max_concurrency))
+        self._aclient = None
+        self._aclient_loop = None
+
+    def _record(self, n_texts: int, data: dict):
+        with self._stats_lock:
+            self.stats.requests += 1
+            self.stats.texts += n_texts
+            self.stats.tokens += data.get("prompt_eval_count", 0)
+
+    def _record_time(self, start: float):
+        # Tiempo de reloj de la llamada completa: con lotes en paralelo no se suman sus duraciones
+        with self._stats_lock:
+            self.stats.seconds += time.perf_counter() - start
+
+    def _payload(self, texts: list[str]) -> dict:
+        return {"model": self.model, "input": texts}
+
+    def _backoff(self, attempt: int) -> float:
+        return self.backoff_factor * (2 ** attempt)
+
+    def _embed_batch(self, texts: list[str]) -> list[list[float]]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                resp = self._client.post(EMBED_ENDPOINT, json=self._payload(texts))
+                if resp.status_code in RETRY_STATUS and attempt < self.max_retries:
+                    time.sleep(self._backoff(attempt))
+                    continue
+                resp.raise_for_status()
+            except httpx.TransportError:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+            data = resp.json()
+            self._record(len(texts), data)
+            return data["embeddings"]
+
+    async def _get_aclient(self) -> httpx.AsyncClient:
+        # Un AsyncClient solo puede usarse desde el event loop en el que se creó
+        loop = asyncio.get_running_loop()
+        if self._aclient is None or self._aclient_loop is not loop:
+            stale, stale_loop = self._aclient, self._aclient_loop
+            self._aclient = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout,
+                                              limits=httpx.Limits(max_connections=self.max_concurrency))
+            self._aclient_loop = loop
+            if stale is not None:
+                await close_stale_client(stale, stale_loop)
+        return self._aclient
+
+    async def _aembed_batch(self, texts: list[str], semaphore: asyncio.Semaphore) -> list[list[float]]:
+        client = await self._get_aclient()
+        for attempt in range(self.max_retries + 1):
+            async with semaphore:
+                try:
+                    resp = await client.post(EMBED_ENDPOINT, json=self._payload(texts))
+                except httpx.TransportError:
+                    if attempt == self.max_retries:
+                        raise
+                    resp = None
+            if resp is not None and (resp.status_code not in RETRY_STATUS or attempt == self.max_retries):
+                resp.raise_for_status()
+                data = resp.json()
+                self._record(len(texts), data)
+                return data["embeddings"]
+            await asyncio.sleep(self._backoff(attempt))
+
+    def _batches(self, texts: list[str]) -> list[list[str]]:
+        return [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        start = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        results = await asyncio.gather(*(self._aembed_batch(b, semaphore) for b in self._batches(texts)))
+        self._record_time(start)
+        return [vector for batch in results for vector in batch]
+
+    async def _aembed_documents_once(self, texts: list[str]) -> list[list[float]]:
+        try:
+            return await self.aembed_documents(texts)
+        finally:
+            if self._aclient is not None:
+                await self._aclient.aclose()
+                self._aclient = None
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self._aembed_documents_once(texts))
+        # Llamada síncrona desde dentro de un event loop: lotes secuenciales con el cliente síncrono
+        start = time.perf_counter()
+        vectors = [vector for batch in self._batches(texts) for vector in self._embed_batch(batch)]
+        self._record_time(start)
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        start = time.perf_counter()
+        vector = self._embed_batch([text])[0]
+        self._record_time(start)
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        start = time.perf_counter()
+        vector = (await self._aembed_batch([text], asyncio.Semaphore(1)))[0]
+        self._record_time(start)
+        return vector
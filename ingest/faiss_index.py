@@ -0,0 +1,111 @@
+import json
+import math
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+INDEX_META_FILE = "index_meta.json"
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq", "sq8")
+# Por debajo de 2**MIN_PQ_NBITS vectores los códigos PQ no aportan nada frente a buscar en todos
+MIN_PQ_NBITS = 4
+
+DEFAULT_PARAMS = {
+    "hnsw": {"m": 32, "ef_construction": 200, "ef_search": 64},
+    "ivf_flat": {"nlist": None, "nprobe": 8},
+    "ivf_pq": {"nlist": None, "nprobe": 8, "pq_m": 16, "pq_nbits": 8},
+    "sq8": {},
+    "flat": {},
+}
+
+
+def default_nlist(n_vectors: int) -> int:
+    # Regla habitual ~4*sqrt(n), sin bajar de 39 puntos de entrenamiento por centroide
+    return max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39))
+
+
+def resolve_params(index_type: str, params: dict | None, n_vectors: int) -> dict:
+    """Parámetros efectivos: los por defecto del tipo sobrescritos por los que no sean None."""
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Tipo de índice desconocido: {index_type}. Opciones: {', '.join(INDEX_TYPES)}")
+    resolved = dict(DEFAULT_PARAMS[index_type])
+    resolved.update({k: v for k, v in (params or {}).items() if k in resolved and v is not None})
+    if "nlist" in resolved:
+        # k-means necesita al menos un punto por centroide; cada partición (CCAA) tiene pocos chunks
+        nlist = resolved["nlist"] if resolved["nlist"] is not None else default_nlist(n_vectors)
+        resolved["nlist"] = max(1, min(nlist, n_vectors))
+        resolved["nprobe"] = min(resolved["nprobe"], resolved["nlist"])
+    if "pq_nbits" in resolved:
+        # El cuantizador PQ entrena 2**pq_nbits centroides por subespacio con los vectores de la partición
+        resolved["pq_nbits"] = max(1, min(resolved["pq_nbits"], int(math.log2(max(n_vectors, 1)))))
+    return resolved
+
+
+def fit_index_type(index_type: str, n_vectors: int) -> str:
+    """Tipo de índice a construir para `n_vectors`: ivf_pq pasa a flat si la partición es demasiado pequeña."""
+    if index_type == "ivf_pq" and n_vectors < 2 ** MIN_PQ_NBITS:
+        print(f"Aviso: {n_vectors} vectores no bastan para entrenar ivf_pq; se usa un índice flat.")
+        return "flat"
+    return index_type
+
+
+def build_faiss_index(vectors: np.ndarray, index_type: str = "flat", params: dict | None = None):
+    """Construye (y entrena si hace falta) un índice FAISS L2 del tipo pedido con `vectors`.
+
+    Devuelve el índice y los parámetros efectivos usados, para registrarlos junto al índice.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, dim = vectors.shape
+    params = resolve_params(index_type, params, n)
+
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dim)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, params["m"])
+        index.hnsw.efConstruction = params["ef_construction"]
+    elif index_type == "ivf_flat":
+        index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dim), dim, params["nlist"])
+    elif index_type == "ivf_pq":
+        if dim % params["pq_m"]:
+            raise ValueError(f"pq_m={params['pq_m']} debe dividir la dimensión {dim}")
+        index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, params["nlist"], params["pq_m"], params["pq_nbits"])
+    else:  # sq8
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit)
+
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    apply_search_params(index, params)
+    return index, params
+
+
+def apply_search_params(index, params: dict):
+    """Aplica los parámetros de búsqueda (efSearch / nprobe) que no forman parte de la estructura."""
+    if "ef_search" in params and hasattr(index, "hnsw"):
+        index.hnsw.efSearch = params["ef_search"]
+    if "nprobe" in params:
+        try:
+            ivf = faiss.extract_index_ivf(index)
+        except RuntimeError:
+            return
+        ivf.nprobe = min(params["nprobe"], ivf.nlist)
+
+
+def write_index_meta(directory, index_type: str, params: dict, ntotal: int, dim: int, **extra):
+    meta = {"index_type": index_type, "params": params, "ntotal": ntotal, "dim": dim, **extra}
+    with (Path(directory) / INDEX_META_FILE).open("w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return meta
+
+
+def read_index_meta(directory) -> dict:
+    """Metadatos del índice guardados por la ingesta; los índices antiguos sin fichero son planos."""
+    path = Path(directory) / INDEX_META_FILE
+    if not path.exists():
+        return {"index_type": "flat", "params": {}}
+    with path.open(encoding="utf-8") as f:
+        return json.load(f)
+
+
+def index_memory_bytes(index) -> int:
+    return int(faiss.serialize_index(index).nbytes)
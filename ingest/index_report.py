@@ -0,0 +1,104 @@
+"""Informe de recall@k, latencia y memoria de los tipos de índice FAISS frente al índice exacto.
+
+Usa el corpus real (scraping/data/*.jsonl, embeddings desde la caché) y como consultas las preguntas
+de ejemplo, las de --queries y una muestra de chunks del propio corpus.
+
+Uso: python ingest/index_report.py [--types hnsw ivf_flat ivf_pq sq8] [--k 5] [--queries preguntas.txt]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from ingest.faiss_index import INDEX_TYPES, build_faiss_index, index_memory_bytes
+from ingest.ingest_jsonl import DATA_DIR, chunks_de_jsonl, embedder
+
+PREGUNTAS_EJEMPLO = [
+    "deducción por alquiler de vivienda habitual en Madrid",
+    "deducción por nacimiento de hijos en la Comunitat Valenciana",
+    "requisitos de la deducción por familia numerosa",
+    "gastos de guardería para hijos menores de tres años",
+    "contribuyentes con discapacidad igual o superior al 33 por 100",
+    "deducción por donaciones a entidades sin fines de lucro",
+    "inversión en empresas de nueva creación",
+    "adquisición de vivienda habitual por jóvenes menores de 35 años",
+    "deducción por gastos educativos en Andalucía",
+    "ayudas por cuidado de ascendientes mayores de 75 años",
+]
+
+
+def percentil_ms(valores: list[float], p: float) -> float:
+    return float(np.percentile(valores, p)) * 1000
+
+
+def evaluar(index, queries: np.ndarray, exactos: np.ndarray, k: int) -> dict:
+    latencias = []
+    aciertos = 0
+    for i in range(len(queries)):
+        start = time.perf_counter()
+        _, ids = index.search(queries[i:i + 1], k)
+        latencias.append(time.perf_counter() - start)
+        aciertos += len(set(ids[0]) & set(exactos[i]))
+    return {
+        "recall": aciertos / (len(queries) * k),
+        "p50": percentil_ms(latencias, 50),
+        "p99": percentil_ms(latencias, 99),
+        "memoria": index_memory_bytes(index),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--types", nargs="+", choices=INDEX_TYPES, default=["hnsw", "ivf_flat", "ivf_pq", "sq8"])
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--queries", help="Fichero con una consulta por línea.")
+    parser.add_argument("--sample", type=int, default=200, help="Chunks del corpus usados además como consulta.")
+    parser.add_argument("--hnsw-m", dest="m", type=int)
+    parser.add_argument("--ef-construction", type=int)
+    parser.add_argument("--ef-search", type=int)
+    parser.add_argument("--nlist", type=int)
+    parser.add_argument("--nprobe", type=int)
+    parser.add_argument("--pq-m", type=int)
+    parser.add_argument("--pq-nbits", type=int)
+    args = parser.parse_args()
+    params = {k: getattr(args, k) for k in ("m", "ef_construction", "ef_search", "nlist", "nprobe", "pq_m", "pq_nbits")}
+
+    chunks = [c for p in sorted(DATA_DIR.glob("*.jsonl")) for c in chunks_de_jsonl(p, verbose=False)]
+    if not chunks:
+        print(f"No hay chunks en {DATA_DIR}.")
+        return
+    vectors = np.array(embedder.embed_documents([c.page_content for c in chunks]), dtype=np.float32)
+
+    preguntas = list(PREGUNTAS_EJEMPLO)
+    if args.queries:
+        with open(args.queries, encoding="utf-8") as f:
+            preguntas.extend(line.strip() for line in f if line.strip())
+    queries = np.array([embedder.embed_query(q) for q in preguntas], dtype=np.float32)
+    rng = np.random.default_rng(0)
+    muestra = rng.choice(len(vectors), size=min(args.sample, len(vectors)), replace=False)
+    queries = np.vstack([queries, vectors[muestra]])
+
+    k = min(args.k, len(vectors))
+    exacto, _ = build_faiss_index(vectors, "flat")
+    _, exactos = exacto.search(queries, k)
+    print(f"{len(vectors)} vectores de dimensión {vectors.shape[1]}, {len(queries)} consultas, k={k}\n")
+    print(f"{'tipo':<10}{'recall@k':>10}{'p50 ms':>10}{'p99 ms':>10}{'memoria MB':>12}{'build s':>10}  parámetros")
+
+    for index_type in ["flat"] + [t for t in args.types if t != "flat"]:
+        start = time.perf_counter()
+        try:
+            index, efectivos = build_faiss_index(vectors, index_type, params)
+        except (ValueError, RuntimeError) as e:
+            print(f"{index_type:<10} error: {e}")
+            continue
+        build = time.perf_counter() - start
+        r = evaluar(index, queries, exactos, k)
+        print(f"{index_type:<10}{r['recall']:>10.3f}{r['p50']:>10.3f}{r['p99']:>10.3f}"
+              f"{r['memoria'] / 1e6:>12.2f}{build:>10.2f}  {efectivos}")
+
+
+if __name__ == "__main__":
+    main()
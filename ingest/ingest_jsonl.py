@@ -1,95 +1,208 @@
+import argparse
 import json
 from pathlib import Path
 from langchain.schema import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter, CharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import FastEmbedEmbeddings, OllamaEmbeddings
+import faiss
 from transformers import AutoTokenizer
 import sys
 import os
 from dotenv import load_dotenv
 load_dotenv()
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from ingest.embedding_cache import CachedEmbeddings
+from ingest.embeddings import EMBED_ENDPOINT, OllamaBatchEmbeddings
+from ingest.chunking import TOKENIZER_NAME, Chunker, split_documents_parallel
+from ingest.faiss_index import INDEX_TYPES, build_faiss_index, fit_index_type, read_index_meta, write_index_meta
+from ingest.load_faiss import PARTITIONS_DIR, partition_dir
+from ingest.bm25 import BM25Index
+from ingest.docstore import write_docstore
+from ingest.snapshots import (current_snapshot, file_sha256, link_tree, new_version, partition_files, prune_snapshots,
+                              publish, read_manifest, staging_dir, KEEP_SNAPSHOTS)
+import shutil
+import numpy as np
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
-MAX_TOKENS_TOTAL = os.getenv("MAX_TOKENS_TOTAL")
+MAX_TOKENS_TOTAL = int(os.getenv("MAX_TOKENS_TOTAL", 512))
 DATA_DIR = Path("scraping/data")
 OUTPUT_DIR = Path("db/")
+EMBEDDING_CACHE_PATH = OUTPUT_DIR / "cache" / "embeddings.sqlite"
+SCRAPE_REPORT_PATH = DATA_DIR / "scrape_report.json"
 
-tokenizer = AutoTokenizer.from_pretrained('mixedbread-ai/mxbai-embed-large-v1')
-embedder = OllamaEmbeddings(model=EMBEDDING_MODEL)
+
+tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_NAME)
+ollama_embedder = OllamaBatchEmbeddings(
+    model=EMBEDDING_MODEL,
+    batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", 32)),
+    max_concurrency=int(os.getenv("EMBEDDING_CONCURRENCY", 4)),
+)
+# /api/embed devuelve vectores normalizados: no se mezclan en la caché con los del cliente antiguo
+embedder = CachedEmbeddings(ollama_embedder, model=f"{EMBEDDING_MODEL}{EMBED_ENDPOINT}", path=EMBEDDING_CACHE_PATH)
 
 # Configuración global
 
 CHUNK_OVERLAP = 64
-
-def build_prefijo(metadata: dict) -> str:
-    return (
-        f"[CCAA: {metadata['ccaa']}]"
-        f"[Categoría: {metadata['categoria']}]"
-        f"[Subapartado: {metadata.get('subapartado', '')}]"
-    )
+chunker = Chunker(tokenizer, MAX_TOKENS_TOTAL, CHUNK_OVERLAP)
 
 def count_tokens(text: str) -> int:
     return len(tokenizer.encode(text, add_special_tokens=False))
 
-def split_with_prefijo_tokenizado(doc: Document) -> list[Document]:
-    prefijo = build_prefijo(doc.metadata)
-    n_tokens_prefijo = count_tokens(prefijo)
-
-    # Chunk size máximo posible para el contenido
-    chunk_size = max(32, MAX_TOKENS_TOTAL - n_tokens_prefijo)
-
-    splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
-        tokenizer=tokenizer,
-        chunk_size=chunk_size,
-        chunk_overlap=CHUNK_OVERLAP
-    )
-
-    sub_chunks = splitter.split_text(doc.page_content)
-    # if len(sub_chunks)>1:
-    #     print("-" * 50)
-    #     print(prefijo)
-    #     for chunk in sub_chunks:
-    #         page_content=f"{prefijo}\n{chunk}"
-    #         print(page_content)
-    #         print(f"TOKENS: {count_tokens(page_content)}")
-        
-    return [
-        Document(
-            page_content=f"{prefijo}\n{chunk}",
-            metadata=doc.metadata
-        )
-        for chunk in sub_chunks
-    ]
-
-for jsonl_path in DATA_DIR.glob("*.jsonl"):
+def chunks_de_jsonl(jsonl_path: Path, workers: int = 1, verbose: bool = True) -> list[Document]:
     ccaa_slug = jsonl_path.stem
-    output_path = OUTPUT_DIR 
-    
-
     with jsonl_path.open(encoding="utf-8") as f:
         raw_docs = [json.loads(line) for line in f]
 
-    documents = [Document(page_content=d["content"], metadata=d["metadata"])
+    documents = [Document(page_content=d["content"], metadata={**d["metadata"], "ccaa_slug": ccaa_slug})
                  for d in raw_docs]
 
     # aplicar splitter dentro de cada subapartado (si necesario)
-    chunks = []
-    for doc in documents:
-        chunks.extend(split_with_prefijo_tokenizado(doc))
-    for chunk in chunks[:2]:
+    if workers > 1:
+        chunks = split_documents_parallel(documents, TOKENIZER_NAME, MAX_TOKENS_TOTAL, CHUNK_OVERLAP, workers=workers)
+    else:
+        chunks = chunker.split_documents(documents)
+    for chunk in chunks[:2] if verbose else []:
         print("-" * 50)
         print(chunk.page_content)
         print(f"TOKENS: {count_tokens(chunk.page_content)}")
 
     print(f"🔧 {ccaa_slug}: {len(documents)} docs → {len(chunks)} chunks")
-    
-    if output_path.exists():
-        vs = FAISS.load_local(str(output_path), embedder, allow_dangerous_deserialization=True)
-        vs.add_documents(chunks)
-    else:
-        vs = FAISS.from_documents(chunks, embedder)
-    
-    vs.save_local(str(output_path))
+    return chunks
+
+def ids_de_chunks(ccaa_slug: str, chunks: list[Document]) -> list[str]:
+    # Ids deterministas: reingestar la misma CCAA siempre produce los mismos ids
+    return [f"{ccaa_slug}:{i}" for i in range(len(chunks))]
+
+def construir_particion(jsonl_path: Path, index_type: str, params: dict, workers: int = 1):
+    """Construye los índices (FAISS y BM25) de una CCAA desde cero y devuelve también sus chunks y el tipo y los parámetros
+    de FAISS realmente usados (se ajustan al tamaño de la partición). Los embeddings salen de la caché salvo los chunks nuevos."""
+    ccaa_slug = jsonl_path.stem
+    chunks = chunks_de_jsonl(jsonl_path, workers=workers)
+    if not chunks:
+        return None, None, None, index_type, params
+
+    hits, misses = embedder.hits, embedder.misses
+    texts = [c.page_content for c in chunks]
+    vectors = embedder.embed_documents(texts)
+    print(f"🧠 {ccaa_slug}: {embedder.misses - misses} chunks embebidos, {embedder.hits - hits} desde caché")
+
+    index_type = fit_index_type(index_type, len(vectors))
+    index, params = build_faiss_index(np.array(vectors, dtype=np.float32), index_type, params)
+    # Mismo orden que el índice FAISS: la posición de cada chunk sirve de id en FAISS, BM25 y el docstore
+    bm25 = BM25Index.build(texts)
+    return index, chunks, bm25, index_type, params
+
+def slugs_cambiados() -> set | None:
+    """Slugs marcados como cambiados en el último informe de scraping (None si no hay informe)."""
+    if not SCRAPE_REPORT_PATH.exists():
+        return None
+    with SCRAPE_REPORT_PATH.open(encoding="utf-8") as f:
+        return set(json.load(f).get("changed", []))
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingesta de los .jsonl de deducciones en un índice FAISS por CCAA.")
+    parser.add_argument("--only-changed", action="store_true",
+                        help=f"Procesa solo las CCAA marcadas como cambiadas en {SCRAPE_REPORT_PATH}.")
+    parser.add_argument("--batch-size", type=int, default=ollama_embedder.batch_size,
+                        help="Textos por petición a Ollama.")
+    parser.add_argument("--concurrency", type=int, default=ollama_embedder.max_concurrency,
+                        help="Peticiones de embeddings simultáneas.")
+    parser.add_argument("--chunk-workers", type=int, default=1,
+                        help="Procesos para trocear documentos (útil en corpus grandes).")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default=os.getenv("INDEX_TYPE", "flat"),
+                        help="flat (exacto), hnsw, ivf_flat, ivf_pq o sq8 (cuantización escalar de 8 bits).")
+    parser.add_argument("--hnsw-m", dest="m", type=int, help="HNSW: vecinos por nodo.")
+    parser.add_argument("--ef-construction", type=int, help="HNSW: amplitud de búsqueda al construir.")
+    parser.add_argument("--ef-search", type=int, help="HNSW: amplitud de búsqueda al consultar.")
+    parser.add_argument("--nlist", type=int, help="IVF: número de listas (por defecto ~4*sqrt(n)).")
+    parser.add_argument("--nprobe", type=int, help="IVF: listas visitadas por consulta.")
+    parser.add_argument("--pq-m", type=int, help="IVF-PQ: subvectores (debe dividir la dimensión).")
+    parser.add_argument("--pq-nbits", type=int, help="IVF-PQ: bits por subvector.")
+    args = parser.parse_args()
+    ollama_embedder.batch_size = args.batch_size
+    ollama_embedder.max_concurrency = args.concurrency
+    index_params = {k: getattr(args, k) for k in ("m", "ef_construction", "ef_search", "nlist", "nprobe", "pq_m", "pq_nbits")}
+
+    if (OUTPUT_DIR / "index.faiss").exists():
+        print(f"Aviso: {OUTPUT_DIR} contiene un índice sin particionar; la API usará el snapshot activo en su lugar.")
+
+    cambiados = slugs_cambiados() if args.only_changed else None
+    if args.only_changed and cambiados is None:
+        print(f"No existe {SCRAPE_REPORT_PATH}; se procesan todas las CCAA.")
+
+    # Cada ingesta escribe un snapshot nuevo e inmutable; las CCAA sin cambios se enlazan desde el anterior
+    # (o desde db/ccaa si aún no hay snapshots)
+    anterior = current_snapshot(OUTPUT_DIR)
+    anterior = anterior if anterior is not None and anterior.exists() else OUTPUT_DIR
+    particiones_anteriores = read_manifest(anterior).get("partitions", {})
+    raiz_anterior = Path(anterior) / PARTITIONS_DIR
+    slugs_anteriores = {p.name for p in raiz_anterior.iterdir() if (p / "index.faiss").exists()} \
+        if raiz_anterior.exists() else set()
+    version = new_version(OUTPUT_DIR)
+    staging = staging_dir(OUTPUT_DIR, version)
+    particiones = {}
+    construidas = 0
+    try:
+        for jsonl_path in sorted(DATA_DIR.glob("*.jsonl")):
+            ccaa_slug = jsonl_path.stem
+            previa = partition_dir(anterior, ccaa_slug)
+            output_path = partition_dir(staging, ccaa_slug)
+            existente = (previa / "index.faiss").exists()
+            meta_previa = read_index_meta(previa)
+            mismo_tipo = meta_previa.get("requested_index_type", meta_previa["index_type"]) == args.index_type
+            if cambiados is not None and ccaa_slug not in cambiados and existente and mismo_tipo:
+                link_tree(previa, output_path)
+                particiones[ccaa_slug] = {**particiones_anteriores.get(ccaa_slug, {}),
+                                          "files": partition_files(output_path)}
+                continue
+
+            index, chunks, bm25, index_type, params = construir_particion(jsonl_path, args.index_type, index_params,
+                                                                          workers=args.chunk_workers)
+            if index is None:
+                continue
+            output_path.mkdir(parents=True, exist_ok=True)
+            faiss.write_index(index, str(output_path / "index.faiss"))
+            write_docstore(output_path, chunks, ids_de_chunks(ccaa_slug, chunks))
+            bm25.save(output_path)
+            write_index_meta(output_path, index_type, params, index.ntotal, index.d,
+                             requested_index_type=args.index_type)
+            with jsonl_path.open(encoding="utf-8") as f:
+                n_docs = sum(1 for _ in f)
+            particiones[ccaa_slug] = {"n_docs": n_docs, "n_chunks": len(chunks), "index_type": index_type,
+                                      "params": params, "dim": index.d, "source_sha256": file_sha256(jsonl_path),
+                                      "files": partition_files(output_path)}
+            construidas += 1
+            print(f"✅ FAISS ({index_type}) guardado en {output_path}: {index.ntotal} vectores\n")
+
+        # Las CCAA cuyo .jsonl se ha borrado o ha quedado vacío no pasan al snapshot nuevo
+        eliminadas = slugs_anteriores - set(particiones)
+        if eliminadas and particiones:
+            print(f"🗑️ Particiones sin datos, se retiran: {', '.join(sorted(eliminadas))}")
+        if not particiones:
+            print(f"Sin datos en {DATA_DIR}: se mantiene el snapshot actual de {OUTPUT_DIR}.")
+            shutil.rmtree(staging)
+        elif construidas == 0 and not eliminadas and anterior != OUTPUT_DIR:
+            print(f"Sin cambios: se mantiene el snapshot actual de {OUTPUT_DIR}.")
+            shutil.rmtree(staging)
+        else:
+            manifest = {
+                "embedding_model": EMBEDDING_MODEL,
+                "embedding_endpoint": EMBED_ENDPOINT,
+                "tokenizer": TOKENIZER_NAME,
+                "chunking": {"max_tokens_total": MAX_TOKENS_TOTAL, "chunk_overlap": CHUNK_OVERLAP},
+                "index_type": args.index_type,
+                "n_docs": sum(p.get("n_docs", 0) for p in particiones.values()),
+                "n_chunks": sum(p.get("n_chunks", 0) for p in particiones.values()),
+                "partitions": particiones,
+            }
+            final = publish(OUTPUT_DIR, version, staging, manifest)
+            print(f"📦 Snapshot {version} publicado en {final} ({construidas} CCAA reconstruidas, "
+                  f"{len(particiones) - construidas} reutilizadas).")
+            eliminados = prune_snapshots(OUTPUT_DIR, KEEP_SNAPSHOTS)
+            if eliminados:
+                print(f"🧹 Snapshots antiguos eliminados: {', '.join(eliminados)}")
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    print(f"📈 Embeddings: {ollama_embedder.stats.report()}")
 
-    print(f"✅ FAISS guardado en {output_path}\n")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import asyncio
+import os
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+from langchain.docstore.document import Document
+
+from ingest.bm25 import BM25Index, reciprocal_rank_fusion
+from ingest.docstore import load_docstore
+from ingest.snapshots import current_snapshot, read_manifest
+from ingest.faiss_index import apply_search_params, read_index_meta
+
+PARTITIONS_DIR = "ccaa"
+LEGACY_PARTITION = "todas"
+# Vectores en memoria compartida: con mmap de solo lectura varios workers usan la misma copia de la page cache
+FAISS_MMAP = os.getenv("FAISS_MMAP", "1") == "1"
+
+
+def partition_dir(db_dir, ccaa_slug: str) -> Path:
+    return Path(db_dir) / PARTITIONS_DIR / ccaa_slug
+
+
+class UnknownCCAAError(KeyError):
+    """Se pidió una CCAA sin partición cargada; el mensaje lista las disponibles."""
+
+    def __str__(self):
+        return self.args[0]
+
+
+class PartitionedVectorStore:
+    """Un índice FAISS por CCAA (particionado por el slug de `ccaa`), consultable por separado o en conjunto.
+
+    La consulta se embebe una sola vez; si se piden varias CCAA (o todas), cada partición devuelve su top-k
+    y se fusionan por distancia, así que el coste crece con el tamaño de las regiones consultadas.
+    Las particiones con índice BM25 admiten además búsqueda léxica (sin embeddings) e híbrida.
+    Los chunks se leen del docstore de cada partición por posición del vector, solo los que se devuelven.
+    """
+
+    def __init__(self, partitions: dict[str, faiss.Index], embeddings, lexical: dict[str, BM25Index] | None = None,
+                 docstores: dict | None = None, version: str | None = None, manifest: dict | None = None):
+        self.partitions = partitions
+        self.embeddings = embeddings
+        self.lexical = lexical or {}
+        self.docstores = docstores or {}
+        self.version = version
+        self.manifest = manifest or {}
+
+    @property
+    def slugs(self) -> list[str]:
+        return sorted(self.partitions)
+
+    def select_slugs(self, ccaa_slugs) -> list[str]:
+        """Slugs a consultar para `ccaa_slugs` (todos si no se filtra); UnknownCCAAError si alguno no tiene índice."""
+        # Un índice antiguo sin particionar ("todas") no puede filtrar por CCAA: se busca en él entero
+        if not ccaa_slugs or list(self.partitions) == [LEGACY_PARTITION]:
+            return self.slugs
+        if isinstance(ccaa_slugs, str):
+            ccaa_slugs = [ccaa_slugs]
+        unknown = [s for s in ccaa_slugs if s not in self.partitions]
+        if unknown:
+            raise UnknownCCAAError(f"Slugs sin índice: {', '.join(unknown)}. Disponibles: {', '.join(self.slugs)}")
+        return list(dict.fromkeys(ccaa_slugs))
+
+    def _vector_search(self, slug: str, embedding: list[float], k: int) -> list[tuple[int, float]]:
+        distances, positions = self.partitions[slug].search(np.array([embedding], dtype=np.float32), k)
+        return [(int(p), float(d)) for p, d in zip(positions[0], distances[0]) if p != -1]
+
+    def _documents(self, hits: list[tuple[str, int]]) -> list[Document]:
+        """Lee los chunks de los pares (slug, posición) con una consulta por partición, conservando el orden."""
+        by_slug = {}
+        for slug, pos in hits:
+            by_slug.setdefault(slug, []).append(pos)
+        docs = {}
+        for slug, positions in by_slug.items():
+            docs.update(((slug, p), d) for p, d in zip(positions, self.docstores[slug].get_many(positions)))
+        return [docs[hit] for hit in hits]
+
+    def similarity_search_with_score_by_vector(self, embedding: list[float], k: int = 5,
+                                               ccaa_slugs=None) -> list[tuple[Document, float]]:
+        results = []
+        for slug in self.select_slugs(ccaa_slugs):
+            results.extend((slug, pos, dist) for pos, dist in self._vector_search(slug, embedding, k))
+        # Distancias L2 en todas las particiones: menor es mejor
+        results = sorted(results, key=lambda r: r[2])[:k]
+        docs = self._documents([(slug, pos) for slug, pos, _ in results])
+        return list(zip(docs, [dist for _, _, dist in results]))
+
+    def lexical_search_with_score(self, query: str, k: int = 5, ccaa_slugs=None) -> list[tuple[Document, float]]:
+        """Búsqueda BM25 pura: no necesita embeber la consulta."""
+        results = []
+        for slug in self.select_slugs(ccaa_slugs):
+            if slug in self.lexical:
+                results.extend((slug, pos, score) for pos, score in self.lexical[slug].search(query, k))
+        results = sorted(results, key=lambda r: r[2], reverse=True)[:k]
+        docs = self._documents([(slug, pos) for slug, pos, _ in results])
+        return list(zip(docs, [score for _, _, score in results]))
+
+    def hybrid_search(self, query: str, k: int = 5, ccaa_slugs=None, fetch_k: int = 20,
+                      embedding: list[float] | None = None) -> list[Document]:
+        """Fusiona (RRF) el ranking vectorial y el léxico de las particiones consultadas y devuelve los k mejores.
+
+        Cada ranking se forma juntando los resultados de todas las particiones (vectorial por distancia L2,
+        léxico por puntuación BM25): con un ranking por partición el primero de cada CCAA empataría en la fusión
+        y el resultado saldría alternando CCAA en vez de por relevancia.
+        """
+        slugs = self.select_slugs(ccaa_slugs)
+        if embedding is None:
+            embedding = self.embeddings.embed_query(query)
+        vector_hits, lexical_hits = [], []
+        for slug in slugs:
+            vector_hits.extend((slug, pos, dist) for pos, dist in self._vector_search(slug, embedding, fetch_k))
+            if slug in self.lexical:
+                lexical_hits.extend((slug, pos, score) for pos, score in self.lexical[slug].search(query, fetch_k))
+        vector_ranking = [(slug, pos) for slug, pos, _ in sorted(vector_hits, key=lambda r: r[2])[:fetch_k]]
+        lexical_ranking = [(slug, pos) for slug, pos, _ in
+                           sorted(lexical_hits, key=lambda r: r[2], reverse=True)[:fetch_k]]
+        fused = reciprocal_rank_fusion([vector_ranking, lexical_ranking])[:k]
+        return self._documents(fused)
+
+    def similarity_search_with_score(self, query: str, k: int = 5, ccaa_slugs=None) -> list[tuple[Document, float]]:
+        self.select_slugs(ccaa_slugs)  # valida los slugs antes de pagar el embedding
+        return self.similarity_search_with_score_by_vector(self.embeddings.embed_query(query), k, ccaa_slugs)
+
+    def similarity_search(self, query: str, k: int = 5, ccaa_slugs=None) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, ccaa_slugs)]
+
+    # Versiones async: el embedding de la consulta se espera sin ocupar un hilo y la búsqueda en FAISS/BM25 y la
+    # lectura del docstore (CPU y disco) van a un hilo para no bloquear el event loop
+
+    async def ahybrid_search(self, query: str, k: int = 5, ccaa_slugs=None, fetch_k: int = 20,
+                             embedding: list[float] | None = None) -> list[Document]:
+        self.select_slugs(ccaa_slugs)
+        if embedding is None:
+            embedding = await self.embeddings.aembed_query(query)
+        return await asyncio.to_thread(self.hybrid_search, query, k, ccaa_slugs, fetch_k, embedding)
+
+    async def asimilarity_search(self, query: str, k: int = 5, ccaa_slugs=None,
+                                 embedding: list[float] | None = None) -> list[Document]:
+        self.select_slugs(ccaa_slugs)
+        if embedding is None:
+            embedding = await self.embeddings.aembed_query(query)
+        results = await asyncio.to_thread(self.similarity_search_with_score_by_vector, embedding, k, ccaa_slugs)
+        return [doc for doc, _ in results]
+
+    async def alexical_search_with_score(self, query: str, k: int = 5, ccaa_slugs=None) -> list[tuple[Document, float]]:
+        return await asyncio.to_thread(self.lexical_search_with_score, query, k, ccaa_slugs)
+
+
+def read_faiss_index(path, mmap: bool = FAISS_MMAP, index_type: str | None = None):
+    """Lee index.faiss; con `mmap` lo abre mapeado en memoria y de solo lectura, o normal si el tipo no lo admite.
+
+    IO_FLAG_MMAP solo mapea las listas invertidas de los IVF; flat, HNSW y SQ8 se leen con IO_FLAG_MMAP_IFC, que
+    deja vectores y códigos en el fichero mapeado en vez de copiarlos a memoria anónima.
+    """
+    path = str(Path(path) / "index.faiss")
+    if mmap:
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if (index_type or "").startswith("ivf") \
+            else faiss.IO_FLAG_MMAP_IFC
+        try:
+            return faiss.read_index(path, flags)
+        except RuntimeError as e:
+            print(f"mmap not supported for {path} ({e}); loading it into memory.")
+    return faiss.read_index(path)
+
+
+def load_partition(path, mmap: bool = FAISS_MMAP):
+    """Índice FAISS (con sus parámetros de búsqueda) y docstore de una partición; sin deserializar pickles
+    salvo en particiones antiguas que aún no tienen docstore.sqlite."""
+    meta = read_index_meta(path)
+    index = read_faiss_index(path, mmap, meta.get("index_type"))
+    apply_search_params(index, meta.get("params", {}))
+    return index, load_docstore(path)
+
+
+def load_vectorstore(db_dir, embeddings=None, mmap: bool = FAISS_MMAP) -> PartitionedVectorStore:
+    """Carga todas las particiones del snapshot activo (`db_dir/CURRENT`) o, sin snapshots, de `db_dir/ccaa/`.
+    Un índice antiguo sin particionar se carga como "todas"."""
+    if embeddings is None:
+        from ingest.embeddings import OllamaBatchEmbeddings
+        embeddings = OllamaBatchEmbeddings(model=os.getenv("EMBEDDING_MODEL"), base_url=os.getenv("OLLAMA_HOST"))
+
+    snapshot = current_snapshot(db_dir)
+    if snapshot is not None and snapshot.exists():
+        db_dir = snapshot
+    manifest = read_manifest(db_dir) if snapshot is not None else {}
+    root = Path(db_dir) / PARTITIONS_DIR
+    paths = {}
+    if root.exists():
+        paths = {p.name: p for p in sorted(root.iterdir()) if (p / "index.faiss").exists()}
+    elif (Path(db_dir) / "index.faiss").exists():
+        paths = {LEGACY_PARTITION: Path(db_dir)}
+    if not paths:
+        raise FileNotFoundError(f"No hay índices FAISS en {db_dir}")
+
+    loaded = {slug: load_partition(path, mmap) for slug, path in paths.items()}
+    lexical = {slug: bm25 for slug, path in paths.items() if (bm25 := BM25Index.load(path)) is not None}
+    return PartitionedVectorStore({slug: index for slug, (index, _) in loaded.items()}, embeddings, lexical,
+                                  {slug: docstore for slug, (_, docstore) in loaded.items()},
+                                  version=manifest.get("version"), manifest=manifest)
@@ -0,0 +1,106 @@
+"""Snapshots inmutables y versionados del índice: db/snapshots/<versión>/ con manifest.json y un puntero db/CURRENT.
+
+La ingesta construye cada snapshot en un directorio temporal, lo renombra y después sustituye CURRENT de forma
+atómica (os.replace), así la API nunca ve un índice a medio escribir.
+"""
+import hashlib
+import json
+import os
+import shutil
+from datetime import datetime, timezone
+from pathlib import Path
+
+SNAPSHOTS_DIR = "snapshots"
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+KEEP_SNAPSHOTS = int(os.getenv("KEEP_SNAPSHOTS", 3))
+
+
+def file_sha256(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def current_version(db_dir) -> str | None:
+    path = Path(db_dir) / CURRENT_FILE
+    if not path.exists():
+        return None
+    return path.read_text(encoding="utf-8").strip() or None
+
+
+def snapshot_path(db_dir, version: str) -> Path:
+    return Path(db_dir) / SNAPSHOTS_DIR / version
+
+
+def current_snapshot(db_dir) -> Path | None:
+    version = current_version(db_dir)
+    return snapshot_path(db_dir, version) if version else None
+
+
+def read_manifest(snapshot_dir) -> dict:
+    path = Path(snapshot_dir) / MANIFEST_FILE
+    if not path.exists():
+        return {}
+    with path.open(encoding="utf-8") as f:
+        return json.load(f)
+
+
+def new_version(db_dir) -> str:
+    version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    candidate, n = version, 1
+    while snapshot_path(db_dir, candidate).exists():
+        n += 1
+        candidate = f"{version}-{n}"
+    return candidate
+
+
+def staging_dir(db_dir, version: str) -> Path:
+    path = Path(db_dir) / SNAPSHOTS_DIR / f".tmp-{version}"
+    if path.exists():
+        shutil.rmtree(path)
+    path.mkdir(parents=True)
+    return path
+
+
+def link_tree(src: Path, dst: Path):
+    """Reutiliza una partición sin cambios del snapshot anterior: hardlinks (los ficheros nunca se modifican)."""
+    dst.mkdir(parents=True, exist_ok=True)
+    for item in src.iterdir():
+        try:
+            os.link(item, dst / item.name)
+        except OSError:
+            shutil.copy2(item, dst / item.name)
+
+
+def partition_files(partition_dir: Path) -> dict:
+    return {p.name: file_sha256(p) for p in sorted(partition_dir.iterdir()) if p.is_file()}
+
+
+def publish(db_dir, version: str, staging: Path, manifest: dict) -> Path:
+    """Escribe el manifiesto, mueve el snapshot a su sitio y apunta CURRENT a él (rename atómico)."""
+    manifest = {"version": version, "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"), **manifest}
+    with (staging / MANIFEST_FILE).open("w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    final = snapshot_path(db_dir, version)
+    staging.rename(final)
+    tmp_current = Path(db_dir) / f".{CURRENT_FILE}.tmp"
+    tmp_current.write_text(version, encoding="utf-8")
+    os.replace(tmp_current, Path(db_dir) / CURRENT_FILE)
+    return final
+
+
+def prune_snapshots(db_dir, keep: int = KEEP_SNAPSHOTS) -> list[str]:
+    """Borra los snapshots más antiguos salvo los `keep` últimos y el actual. Un proceso que aún tenga mapeados
+    sus ficheros los sigue leyendo hasta soltarlos (en Linux el borrado solo quita el nombre)."""
+    root = Path(db_dir) / SNAPSHOTS_DIR
+    if not root.exists():
+        return []
+    versions = sorted(p.name for p in root.iterdir() if p.is_dir() and not p.name.startswith("."))
+    current = current_version(db_dir)
+    removed = [v for v in versions[:-keep] if v != current] if keep else []
+    for version in removed:
+        shutil.rmtree(root / version)
+    return removed
@@ -1,10 +1,24 @@
 # utils/hacienda_loader.py
 from pathlib import Path
 import requests, bs4
-from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urljoin, urlparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from langchain.docstore.document import Document
+import hashlib
+import json
+import os
+import threading
 import re
 
+REQUEST_TIMEOUT = 20
+MAX_CONNECTIONS_PER_HOST = 4
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+
 def normalizar_espacios(texto):
     return (texto.replace("\xa0", " ")     # nbsp
                  .replace("\u200b", "")     # zero-width
@@ -61,35 +75,345 @@ def extraer_subapartados(soup, categoria, url, ccaa):
         for titulo, content in secciones
     ]
 
+def build_session(pool_size: int = MAX_CONNECTIONS_PER_HOST,
+                  max_retries: int = MAX_RETRIES,
+                  backoff_factor: float = BACKOFF_FACTOR) -> requests.Session:
+    """Sesión keep-alive compartida, con pool de conexiones y reintentos con backoff exponencial."""
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+class HostLimiter:
+    """Limita el número de peticiones simultáneas contra un mismo host."""
+    def __init__(self, max_per_host: int = MAX_CONNECTIONS_PER_HOST):
+        self.max_per_host = max_per_host
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def limit(self, url: str):
+        host = urlparse(url).netloc
+        with self._lock:
+            semaphore = self._semaphores.setdefault(host, threading.BoundedSemaphore(self.max_per_host))
+        with semaphore:
+            yield
+
+_MAIN_RE = re.compile(r"<main\b.*?</main>", re.IGNORECASE | re.DOTALL)
+_SCRIPT_RE = re.compile(r"<(script|style)\b.*?</\1>", re.IGNORECASE | re.DOTALL)
+_SPACES_RE = re.compile(r"\s+")
+_TAG_SPACES_RE = re.compile(r">\s+<")
+
+def hash_contenido(html: str) -> str:
+    """Hash del contenido normalizado de una página (solo <main>, sin scripts ni espacios redundantes).
+
+    Así los cambios en cabeceras, pies o tokens de sesión no cuentan como cambios de la deducción.
+    """
+    match = _MAIN_RE.search(html)
+    contenido = match.group(0) if match else html
+    contenido = _SCRIPT_RE.sub("", contenido)
+    contenido = _SPACES_RE.sub(" ", contenido).strip()
+    contenido = _TAG_SPACES_RE.sub("><", contenido)
+    return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+class FetchCache:
+    """Caché persistente de descargas indexada por URL.
+
+    El índice (JSON) solo guarda, para cada URL, los validadores HTTP (ETag / Last-Modified) y el hash del
+    contenido normalizado. El resultado ya parseado va en un fichero por URL junto al índice y solo se lee
+    cuando la página no ha cambiado (304 o mismo hash), así la memoria y el coste de `save()` no crecen con
+    el tamaño del corpus.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.payload_dir = self.path.with_name(self.path.stem + "_payloads")
+        self._lock = threading.Lock()
+        self._entries = {}
+        if self.path.exists():
+            try:
+                with self.path.open(encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"ADVERTENCIA: caché de descargas ilegible en {self.path}, se ignora: {e}")
+        for entry in self._entries.values():
+            entry.pop("payload", None)  # formato antiguo con el resultado dentro del índice
+
+    def get(self, url: str):
+        with self._lock:
+            return self._entries.get(url)
+
+    def _payload_path(self, url: str) -> Path:
+        return self.payload_dir / f"{hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]}.json"
+
+    def has_payload(self, url: str) -> bool:
+        return self._payload_path(url).exists()
+
+    def load_payload(self, url: str, content_hash: str):
+        """Resultado parseado guardado para `url`, o None si no existe o es de otra versión de la página."""
+        try:
+            with self._payload_path(url).open(encoding="utf-8") as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return stored["payload"] if stored.get("content_hash") == content_hash else None
+
+    def conditional_headers(self, url: str) -> dict:
+        entry = self.get(url)
+        # Sin el resultado en disco un 304 no serviría de nada: se pide la página completa
+        if not entry or not self.has_payload(url):
+            return {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def update(self, url: str, content_hash: str, payload, etag=None, last_modified=None):
+        previous = self.get(url)
+        if not previous or previous["content_hash"] != content_hash or not self.has_payload(url):
+            self.payload_dir.mkdir(parents=True, exist_ok=True)
+            path = self._payload_path(url)
+            tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+            with tmp_path.open("w", encoding="utf-8") as f:
+                json.dump({"url": url, "content_hash": content_hash, "payload": payload}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        with self._lock:
+            self._entries[url] = {
+                "etag": etag,
+                "last_modified": last_modified,
+                "content_hash": content_hash,
+            }
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with self._lock:
+            with tmp_path.open("w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
 class HaciendaLoader:
     BASE = ("https://sede.agenciatributaria.gob.es/Sede/ayuda/"
             "manuales-videos-folletos/manuales-practicos/"
             "irpf-2024-deducciones-autonomicas/")
 
-    def __init__(self, ccaa_slug="comunitat-valenciana"):
-        self.index_url = urljoin(self.BASE, f"{ccaa_slug}.html")
+    def __init__(self, ccaa_slug="comunitat-valenciana", session=None, host_limiter=None,
+                 max_workers=MAX_CONNECTIONS_PER_HOST, base_url=None, timeout=REQUEST_TIMEOUT,
+                 cache: FetchCache | None = None):
+        self.index_url = urljoin(base_url or self.BASE, f"{ccaa_slug}.html")
         self.ccaa = ccaa_slug.replace("-", " ").title()
+        self.session = session or build_session()
+        self.host_limiter = host_limiter or HostLimiter()
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.cache = cache
+        self.paginas_cambiadas = 0
+        self.paginas_sin_cambios = 0
+        self._stats_lock = threading.Lock()
+        self._enlaces = None
 
-    def load(self):
-        docs = []
-        lista_deducciones = []
-        index_html = requests.get(self.index_url, timeout=20)
-        index_html.encoding = "utf-8"   
-        soup = bs4.BeautifulSoup(index_html.text, "lxml")
+    def _fetch_parsed(self, url: str, parse):
+        """Descarga `url` y devuelve `parse(html)`, reutilizando el resultado cacheado si la página no ha cambiado."""
+        entry = self.cache.get(url) if self.cache else None
+        headers = self.cache.conditional_headers(url) if self.cache else {}
+        with self.host_limiter.limit(url):
+            resp = self.session.get(url, timeout=self.timeout, headers=headers)
+
+        if resp.status_code == 304 and entry:
+            payload = self.cache.load_payload(url, entry["content_hash"])
+            if payload is not None:
+                self._count(cambiada=False)
+                return payload
+            # El resultado guardado se ha perdido: se descarga la página completa
+            with self.host_limiter.limit(url):
+                resp = self.session.get(url, timeout=self.timeout)
+        resp.raise_for_status()
+        resp.encoding = "utf-8"
+
+        content_hash = hash_contenido(resp.text)
+        payload = None
+        if entry and entry["content_hash"] == content_hash:
+            payload = self.cache.load_payload(url, content_hash)
+        if payload is not None:
+            self._count(cambiada=False)
+        else:
+            payload = parse(resp.text)
+            self._count(cambiada=True)
+        if self.cache:
+            self.cache.update(url, content_hash, payload,
+                              etag=resp.headers.get("ETag"),
+                              last_modified=resp.headers.get("Last-Modified"))
+        return payload
+
+    def _count(self, cambiada: bool):
+        with self._stats_lock:
+            if cambiada:
+                self.paginas_cambiadas += 1
+            else:
+                self.paginas_sin_cambios += 1
 
+    def _parse_indice(self, html: str) -> list:
+        soup = bs4.BeautifulSoup(html, "lxml")
+        enlaces = []
         for a in soup.select("main a[href$='.html']"):
-            href = a["href"]
-            full_url = urljoin(self.index_url, href)
-            # slug = Path(href).stem # No se usa slug aquí directamente
-            categoria = a.get_text(" ", strip=True)
-            categoria = normalizar_espacios(categoria)
-            lista_deducciones.append(categoria) # Guardamos el título de la deducción
-
-            resp = requests.get(full_url, timeout=20)
-            resp.encoding = "utf-8"      
-            soup2 = bs4.BeautifulSoup(resp.text, "lxml")
-
-            docs.extend(
-                extraer_subapartados(soup2, categoria=categoria, url=full_url, ccaa=self.ccaa)
-            )
+            full_url = urljoin(self.index_url, a["href"])
+            categoria = normalizar_espacios(a.get_text(" ", strip=True))
+            enlaces.append([categoria, full_url])
+        return enlaces
+
+    def _load_deduccion(self, categoria: str, full_url: str) -> list[Document]:
+        def parse(html):
+            soup = bs4.BeautifulSoup(html, "lxml")
+            docs = extraer_subapartados(soup, categoria=categoria, url=full_url, ccaa=self.ccaa)
+            # Se guarda serializado para poder cachearlo en JSON
+            return [{"content": d.page_content, "metadata": d.metadata} for d in docs]
+
+        return [Document(page_content=d["content"], metadata=d["metadata"])
+                for d in self._fetch_parsed(full_url, parse)]
+
+    def load_indice(self) -> list:
+        """Enlaces [categoria, url] de las deducciones de la CCAA, en el orden del índice."""
+        if self._enlaces is None:
+            self._enlaces = self._fetch_parsed(self.index_url, self._parse_indice)
+        return self._enlaces
+
+    def lazy_load(self, skip_urls=()):
+        """Genera los Documents a medida que se parsea cada página, en el orden del índice.
+
+        Las páginas se descargan en paralelo, pero como mucho hay `2 * max_workers` en vuelo o
+        esperando a ser consumidas, así que la memoria no crece con el número de deducciones.
+        """
+        enlaces = iter([e for e in self.load_indice() if e[1] not in skip_urls])
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                for enlace in enlaces:
+                    pending.append(executor.submit(self._load_deduccion, *enlace))
+                    if len(pending) >= 2 * self.max_workers:
+                        break
+                while pending:
+                    page_docs = pending.popleft().result()
+                    siguiente = next(enlaces, None)
+                    if siguiente is not None:
+                        pending.append(executor.submit(self._load_deduccion, *siguiente))
+                    yield from page_docs
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def load(self):
+        docs = list(self.lazy_load())
+        lista_deducciones = [categoria for categoria, _ in self.load_indice()] # Guardamos el título de la deducción
         return docs, lista_deducciones
+
+def load_all(ccaa_slugs, max_workers=4, max_per_host=MAX_CONNECTIONS_PER_HOST, page_stats=None, load=None,
+             **loader_kwargs):
+    """Carga varias CCAA en paralelo compartiendo sesión y límite de conexiones por host.
+
+    Devuelve un dict slug -> (docs, lista_deducciones) o la excepción producida para ese slug.
+    Con `load(slug, loader)` cada CCAA se procesa con esa función (p. ej. volcando a disco según se parsea)
+    y el dict lleva lo que devuelva. Si se pasa `page_stats`, se rellena con el número de páginas
+    cambiadas / sin cambios por slug.
+    """
+    session = loader_kwargs.pop("session", None) or build_session(pool_size=max_per_host)
+    host_limiter = loader_kwargs.pop("host_limiter", None) or HostLimiter(max_per_host)
+
+    def _load(slug):
+        loader = HaciendaLoader(slug, session=session, host_limiter=host_limiter, **loader_kwargs)
+        try:
+            return load(slug, loader) if load is not None else loader.load()
+        except Exception as e:
+            return e
+        finally:
+            if page_stats is not None:
+                page_stats[slug] = {"changed": loader.paginas_cambiadas, "unchanged": loader.paginas_sin_cambios}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(ccaa_slugs, executor.map(_load, ccaa_slugs)))
+
+class JsonlCheckpointWriter:
+    """Escribe Documents en un .jsonl de forma incremental, con checkpoint para reanudar.
+
+    Las líneas se añaden a `<salida>.partial`. Cada vez que termina una página (cambia la `url` de los
+    documentos) se guarda en `<salida>.checkpoint.json` la lista de URLs completas y el tamaño del
+    parcial. Si la ejecución se interrumpe, la siguiente trunca el parcial a ese tamaño y continúa
+    saltándose `done_urls`. Al cerrar sin errores, la salida solo se sustituye si su contenido cambia.
+    """
+    def __init__(self, output_path):
+        self.output_path = Path(output_path)
+        self.partial_path = self.output_path.with_name(self.output_path.name + ".partial")
+        self.checkpoint_path = self.output_path.with_name(self.output_path.name + ".checkpoint.json")
+        self.done_urls = []
+        self.n_docs = 0
+        self.changed = False
+        self._current_url = None
+
+        offset = 0
+        if self.checkpoint_path.exists() and self.partial_path.exists():
+            with self.checkpoint_path.open(encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            self.done_urls = checkpoint["done_urls"]
+            self.n_docs = checkpoint["n_docs"]
+            offset = checkpoint["offset"]
+            self._file = self.partial_path.open("r+b")
+        else:
+            self._file = self.partial_path.open("wb")
+        self._file.truncate(offset)
+        self._file.seek(offset)
+
+    def write(self, doc: Document):
+        url = doc.metadata.get("url")
+        if self._current_url is not None and url != self._current_url:
+            self._checkpoint()
+        self._current_url = url
+        line = json.dumps({"content": doc.page_content, "metadata": doc.metadata}, ensure_ascii=False) + "\n"
+        self._file.write(line.encode("utf-8"))
+        self.n_docs += 1
+
+    def _checkpoint(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.done_urls.append(self._current_url)
+        tmp_path = self.checkpoint_path.with_suffix(".tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump({"done_urls": self.done_urls, "n_docs": self.n_docs, "offset": self._file.tell()}, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def finish(self) -> bool:
+        """Cierra el parcial y lo publica si difiere de la salida existente. Devuelve si ha cambiado."""
+        self._file.close()
+        if self.n_docs == 0:
+            self.partial_path.unlink()
+        elif self.output_path.exists() and _file_digest(self.output_path) == _file_digest(self.partial_path):
+            self.partial_path.unlink()
+        else:
+            os.replace(self.partial_path, self.output_path)
+            self.changed = True
+        self.checkpoint_path.unlink(missing_ok=True)
+        return self.changed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.finish()
+        else:
+            # Se conservan el parcial y el checkpoint para reanudar en la siguiente ejecución
+            self._file.close()
+
+def _file_digest(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for bloque in iter(lambda: f.read(1 << 16), b""):
+            h.update(bloque)
+    return h.hexdigest()
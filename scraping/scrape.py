@@ -1,6 +1,7 @@
 import json
+from datetime import datetime
 from pathlib import Path
-from aeat_loader import HaciendaLoader
+from aeat_loader import FetchCache, HostLimiter, JsonlCheckpointWriter, build_session, load_all, MAX_CONNECTIONS_PER_HOST
 
 # Comunidades a scrapear (usa los slugs del sitio web)
 CCAA_SLUGS = [
@@ -13,50 +14,75 @@ CCAA_SLUGS = [
 DATA_DIR = Path("scraping/data")
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
-# Diccionario para guardar el índice de deducciones por CCAA
+# Número de CCAA que se descargan a la vez (el límite de conexiones por host es global)
+MAX_WORKERS_CCAA = 4
+
+# Caché de descargas (validadores HTTP + hash del contenido) y informe de cambios para la ingesta
+FETCH_CACHE_PATH = Path("scraping/.cache/fetch_cache.json")
+REPORT_PATH = DATA_DIR / "scrape_report.json"
+
+indice_deducciones_path = DATA_DIR / "deducciones_por_ccaa.json"
+# Partimos del índice anterior para no perder la lista de una CCAA si falla su descarga
 deducciones_por_ccaa = {}
+if indice_deducciones_path.exists():
+    with indice_deducciones_path.open(encoding="utf-8") as f_index:
+        deducciones_por_ccaa = json.load(f_index)
+
+report = {"changed": [], "unchanged": [], "failed": [], "pages": {}}
+
+session = build_session(pool_size=MAX_CONNECTIONS_PER_HOST)
+host_limiter = HostLimiter(MAX_CONNECTIONS_PER_HOST)
+cache = FetchCache(FETCH_CACHE_PATH)
+
+def scrape_ccaa(slug, loader):
+    """Vuelca los documentos de una CCAA a su .jsonl según se van parseando, reanudando si quedó a medias."""
+    output_path = DATA_DIR / f"{slug}.jsonl"
+    lista_nombres_deducciones = [categoria for categoria, _ in loader.load_indice()]
+    with JsonlCheckpointWriter(output_path) as writer:
+        if writer.done_urls:
+            print(f"Reanudando {output_path.name}: {len(writer.done_urls)} páginas ya guardadas")
+        for doc in loader.lazy_load(skip_urls=set(writer.done_urls)):
+            writer.write(doc)
+    return lista_nombres_deducciones, writer
+
+print(f"Procesando {len(CCAA_SLUGS)} CCAA en paralelo...")
+try:
+    resultados = load_all(CCAA_SLUGS, max_workers=MAX_WORKERS_CCAA, page_stats=report["pages"], load=scrape_ccaa,
+                          session=session, host_limiter=host_limiter, cache=cache)
+finally:
+    cache.save()
 
 for slug in CCAA_SLUGS:
     output_path = DATA_DIR / f"{slug}.jsonl"
-    
-    print(f"Procesando {slug.replace('-', ' ').title()}...")
-    loader = HaciendaLoader(slug)
-    try:
-        # Siempre cargamos para obtener la lista de deducciones
-        docs, lista_nombres_deducciones = loader.load()
-        deducciones_por_ccaa[slug] = lista_nombres_deducciones
-
-    except Exception as e:
-        print(f"Error al cargar datos para {slug}: {e}")
-        # Si hay un error al cargar, no podemos obtener la lista de deducciones para esta CCAA
-        # Es importante decidir cómo manejar esto. Por ahora, continuamos.
-        # Podríamos añadir un placeholder o simplemente omitirla del índice.
-        deducciones_por_ccaa[slug] = [] # Opcional: añadir lista vacía si falla
+    resultado = resultados[slug]
+    if isinstance(resultado, Exception):
+        print(f"Error al cargar datos para {slug}: {resultado}")
+        # Se conservan la lista anterior (si la hay) y el .jsonl existente; el parcial queda para reanudar
+        deducciones_por_ccaa.setdefault(slug, [])
+        report["failed"].append(slug)
         continue
 
-    # Solo escribimos el archivo .jsonl si no existe o si está vacío y tenemos documentos
-    if not output_path.exists() or (output_path.stat().st_size == 0 and docs):
-        if not docs:
-            print(f"No se generaron documentos para {slug} (loader.load() no devolvió docs). No se creará {output_path.name}.")
-        else:
-            print(f"Scrapeando y guardando {slug.replace('-', ' ').title()} en {output_path.name}...")
-            with output_path.open("w", encoding="utf-8") as f:
-                for d in docs:
-                    json.dump({
-                        "content": d.page_content,
-                        "metadata": d.metadata
-                    }, f, ensure_ascii=False)
-                    f.write("\n")
-            print(f"Guardado: {output_path.name} ({len(docs)} documentos)\n")
-    elif docs: # Si el archivo existe y tenemos documentos (aunque no vayamos a sobreescribir)
-        print(f"Ya existe: {output_path.name}. No se sobrescribe. Se usaron {len(docs)} documentos para el índice.\n")
-    else: # Si el archivo existe pero no obtuvimos documentos (raro si load tuvo éxito antes)
-         print(f"Ya existe: {output_path.name} y no se obtuvieron nuevos documentos. No se sobrescribe.\n")
+    lista_nombres_deducciones, writer = resultado
+    deducciones_por_ccaa[slug] = lista_nombres_deducciones
+    if writer.n_docs == 0:
+        print(f"No se generaron documentos para {slug}. No se modifica {output_path.name}.")
+        report["failed"].append(slug)
+    elif writer.changed:
+        print(f"Guardado: {output_path.name} ({writer.n_docs} documentos)")
+        report["changed"].append(slug)
+    else:
+        print(f"Sin cambios: {output_path.name} ({writer.n_docs} documentos)")
+        report["unchanged"].append(slug)
 
 # Guardar el índice de deducciones en un archivo JSON
-indice_deducciones_path = DATA_DIR / "deducciones_por_ccaa.json"
 with indice_deducciones_path.open("w", encoding="utf-8") as f_index:
     json.dump(deducciones_por_ccaa, f_index, ensure_ascii=False, indent=2)
 
 print(f"Guardado índice de deducciones: {indice_deducciones_path.name}")
 
+report["generated_at"] = datetime.now().isoformat(timespec="seconds")
+with REPORT_PATH.open("w", encoding="utf-8") as f_report:
+    json.dump(report, f_report, ensure_ascii=False, indent=2)
+
+print(f"Cambiadas: {report['changed'] or '-'} | Sin cambios: {report['unchanged'] or '-'} | Fallidas: {report['failed'] or '-'}")
+print(f"Guardado informe de cambios: {REPORT_PATH.name}")
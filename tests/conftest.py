@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# app.logging_config arranca al importarse un listener que escribe en LOG_DIR: los tests no deben tocar logs/
+os.environ.setdefault("LOG_DIR", tempfile.mkdtemp(prefix="agente_fiscal_logs_"))
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from app.admission import AdmissionController, AdmissionRejected
+
+
+def test_global_cap_and_per_thread_order():
+    async def run():
+        controller = AdmissionController(max_in_flight=2, max_queue=10, timeout=5)
+        running, peak, order = 0, 0, []
+
+        async def turn(thread_id, n):
+            nonlocal running, peak
+            ticket = await controller.acquire(thread_id)
+            running += 1
+            peak = max(peak, running)
+            order.append((thread_id, n))
+            await asyncio.sleep(0.01)
+            running -= 1
+            ticket.release()
+            ticket.release()  # idempotente
+
+        await asyncio.gather(*(turn(f"t{i % 3}", i) for i in range(9)))
+        return controller, peak, order
+
+    controller, peak, order = asyncio.run(run())
+    assert peak == 2
+    for thread_id in ("t0", "t1", "t2"):
+        turns = [n for t, n in order if t == thread_id]
+        assert turns == sorted(turns)
+    assert controller.in_flight == controller.waiting == 0
+    assert controller._threads == {}
+
+
+def test_queue_full_and_timeout_are_rejected():
+    async def run():
+        controller = AdmissionController(max_in_flight=1, max_queue=1, timeout=0.05)
+        held = await controller.acquire("a")
+        waiter = asyncio.create_task(controller.acquire("b"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as full:
+            await controller.acquire("c")
+        with pytest.raises(AdmissionRejected) as timeout:
+            await waiter
+        held.release()
+        return controller, full.value.reason, timeout.value.reason
+
+    controller, full, timeout = asyncio.run(run())
+    assert (full, timeout) == ("queue_full", "timeout")
+    assert controller.in_flight == controller.waiting == 0
+    assert controller._threads == {}
@@ -0,0 +1,198 @@
+import json
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+from scraping.aeat_loader import (FetchCache, HaciendaLoader, HostLimiter, JsonlCheckpointWriter, build_session,
+                                  hash_contenido, load_all)
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures" / "aeat"
+
+
+class FixtureHandler(SimpleHTTPRequestHandler):
+    """Sirve el HTML guardado, con latencia artificial y fallos 503 configurables."""
+    delay = 0.05
+    fail_once = set()
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+            fail = self.path in cls.fail_once
+            cls.fail_once.discard(self.path)
+        try:
+            time.sleep(cls.delay)
+            if fail:
+                self.send_error(503)
+            else:
+                super().do_GET()
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def base_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(FixtureHandler, directory=str(FIXTURES_DIR)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/"
+    server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def reset_handler():
+    FixtureHandler.fail_once = set()
+    FixtureHandler.max_in_flight = 0
+
+
+def test_load_parses_index_and_subapartados(base_url):
+    docs, lista = HaciendaLoader("comunitat-valenciana", base_url=base_url).load()
+    assert lista == ["Por nacimiento, adopción o acogimiento familiar", "Por familia numerosa o monoparental"]
+    # Los documentos conservan el orden del índice aunque se descarguen en paralelo
+    assert [d.metadata["categoria"] for d in docs] == [lista[0]] * 3 + [lista[1]]
+    assert docs[1].metadata["subapartado"] == "Importe de la deducción"
+    assert docs[0].metadata["ccaa"] == "Comunitat Valenciana"
+    assert "\xa0" not in docs[2].page_content
+
+
+def test_load_all_in_parallel(base_url):
+    resultados = load_all(["comunitat-valenciana", "comunidad-madrid"], base_url=base_url)
+    docs, lista = resultados["comunidad-madrid"]
+    assert lista == ["Por arrendamiento de vivienda habitual por menores de 35 años"]
+    assert {d.metadata["ccaa"] for d in docs} == {"Comunidad Madrid"}
+    assert not isinstance(resultados["comunitat-valenciana"], Exception)
+
+
+def test_load_all_reports_errors_per_slug(base_url):
+    resultados = load_all(["comunidad-madrid", "no-existe"], base_url=base_url)
+    assert isinstance(resultados["no-existe"], Exception)
+    assert not isinstance(resultados["comunidad-madrid"], Exception)
+
+
+def test_load_all_runs_a_custom_load_per_slug(base_url):
+    # Como scrape.py: cada CCAA se consume en streaming con lazy_load en lugar de load()
+    page_stats = {}
+    resultados = load_all(["comunidad-madrid", "no-existe"], page_stats=page_stats, base_url=base_url,
+                          load=lambda slug, loader: (slug, len(list(loader.lazy_load()))))
+    assert resultados["comunidad-madrid"] == ("comunidad-madrid", 2)
+    assert isinstance(resultados["no-existe"], Exception)
+    assert page_stats["comunidad-madrid"]["changed"] + page_stats["comunidad-madrid"]["unchanged"] > 0
+
+
+def test_host_limiter_bounds_concurrency(base_url):
+    resultados = load_all(["comunitat-valenciana", "comunidad-madrid"], max_workers=2,
+                          max_per_host=1, base_url=base_url)
+    assert not any(isinstance(r, Exception) for r in resultados.values())
+    assert FixtureHandler.max_in_flight == 1
+
+
+def test_retries_with_backoff(base_url):
+    FixtureHandler.fail_once = {"/comunidad-madrid/arrendamiento-vivienda.html"}
+    loader = HaciendaLoader("comunidad-madrid", base_url=base_url,
+                            session=build_session(backoff_factor=0.01), host_limiter=HostLimiter(2))
+    docs, _ = loader.load()
+    assert len(docs) == 2
+    assert not FixtureHandler.fail_once
+
+
+def test_fetch_cache_conditional_requests(base_url, tmp_path):
+    cache = FetchCache(tmp_path / "fetch_cache.json")
+    primero = HaciendaLoader("comunitat-valenciana", base_url=base_url, cache=cache)
+    docs, _ = primero.load()
+    assert (primero.paginas_cambiadas, primero.paginas_sin_cambios) == (3, 0)
+    cache.save()
+
+    # Con los validadores guardados el servidor responde 304 y no se vuelve a parsear nada
+    segundo = HaciendaLoader("comunitat-valenciana", base_url=base_url, cache=FetchCache(tmp_path / "fetch_cache.json"))
+    docs_cacheados, _ = segundo.load()
+    assert (segundo.paginas_cambiadas, segundo.paginas_sin_cambios) == (0, 3)
+    assert [d.page_content for d in docs_cacheados] == [d.page_content for d in docs]
+
+
+def test_fetch_cache_content_hash_skips_parse(base_url, tmp_path):
+    cache = FetchCache(tmp_path / "fetch_cache.json")
+    loader = HaciendaLoader("comunidad-madrid", base_url=base_url, cache=cache)
+    loader.load()
+    # Sin validadores HTTP, el hash del contenido normalizado sigue evitando el parseo
+    for url in list(cache._entries):
+        cache._entries[url]["etag"] = cache._entries[url]["last_modified"] = None
+    loader = HaciendaLoader("comunidad-madrid", base_url=base_url, cache=cache)
+    loader.load()
+    assert (loader.paginas_cambiadas, loader.paginas_sin_cambios) == (0, 2)
+
+
+def test_fetch_cache_index_keeps_only_validators(base_url, tmp_path):
+    cache = FetchCache(tmp_path / "fetch_cache.json")
+    HaciendaLoader("comunitat-valenciana", base_url=base_url, cache=cache).load()
+    cache.save()
+    with (tmp_path / "fetch_cache.json").open(encoding="utf-8") as f:
+        index = json.load(f)
+    assert all(set(entry) == {"etag", "last_modified", "content_hash"} for entry in index.values())
+    assert len(list(cache.payload_dir.glob("*.json"))) == 3
+
+    # Si falta el resultado en disco la página se vuelve a descargar y parsear
+    for path in cache.payload_dir.glob("*.json"):
+        path.unlink()
+    loader = HaciendaLoader("comunitat-valenciana", base_url=base_url, cache=FetchCache(tmp_path / "fetch_cache.json"))
+    loader.load()
+    assert (loader.paginas_cambiadas, loader.paginas_sin_cambios) == (3, 0)
+
+
+def test_hash_contenido_ignores_outside_main():
+    a = "<html><head><title>A</title></head><body><main><p>Texto</p></main></body></html>"
+    b = "<html><head><title>B</title></head><body><main>\n  <p>Texto</p>\n</main><footer>x</footer></body></html>"
+    assert hash_contenido(a) == hash_contenido(b)
+    assert hash_contenido(a) != hash_contenido(a.replace("Texto", "Otro"))
+
+
+def test_lazy_load_matches_load(base_url):
+    loader = HaciendaLoader("comunitat-valenciana", base_url=base_url, max_workers=1)
+    lazy = loader.lazy_load()
+    primero = next(lazy)
+    assert primero.metadata["categoria"] == "Por nacimiento, adopción o acogimiento familiar"
+    resto = list(lazy)
+    docs, _ = HaciendaLoader("comunitat-valenciana", base_url=base_url).load()
+    assert [d.page_content for d in [primero] + resto] == [d.page_content for d in docs]
+
+
+def test_jsonl_writer_resumes_after_interruption(base_url, tmp_path):
+    output_path = tmp_path / "comunitat-valenciana.jsonl"
+    loader = HaciendaLoader("comunitat-valenciana", base_url=base_url)
+    docs, _ = loader.load()
+    primera_url = docs[0].metadata["url"]
+
+    # Se interrumpe a mitad de la segunda página: la primera queda en el checkpoint
+    with pytest.raises(RuntimeError):
+        with JsonlCheckpointWriter(output_path) as writer:
+            for doc in docs:
+                writer.write(doc)
+                if doc.metadata["url"] != primera_url:
+                    raise RuntimeError("interrumpido")
+    assert not output_path.exists()
+
+    writer = JsonlCheckpointWriter(output_path)
+    assert writer.done_urls == [primera_url]
+    with writer:
+        for doc in loader.lazy_load(skip_urls=set(writer.done_urls)):
+            writer.write(doc)
+    assert writer.changed
+    lineas = output_path.read_text(encoding="utf-8").splitlines()
+    assert len(lineas) == len(docs)
+    assert not writer.checkpoint_path.exists() and not writer.partial_path.exists()
+
+    # Repetir la descarga sin cambios no toca el fichero
+    with JsonlCheckpointWriter(output_path) as writer:
+        for doc in loader.lazy_load():
+            writer.write(doc)
+    assert not writer.changed
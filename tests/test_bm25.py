@@ -0,0 +1,38 @@
+from ingest.bm25 import BM25Index, reciprocal_rank_fusion, tokenize
+
+CHUNKS = [
+    "[CCAA: Comunitat Valenciana][Categoría: Por familia numerosa o monoparental]\n330 euros por familia numerosa de categoría general.",
+    "[CCAA: Comunitat Valenciana][Categoría: Por las cantidades destinadas a la custodia en guarderías]\nGastos de custodia de hijos menores de tres años.",
+    "[CCAA: Comunidad Madrid][Categoría: Por discapacidad]\nContribuyentes con discapacidad en grado igual o superior al 33 por 100.",
+    "[CCAA: Comunidad Madrid][Categoría: Por arrendamiento de vivienda]\nMenores de 35 años que paguen el alquiler de su vivienda habitual. Familia.",
+]
+
+
+def test_tokenize_normalizes_accents_plurals_and_stopwords():
+    terms = tokenize("Las Guarderías de los hijos")
+    assert "guarderia" in terms
+    assert "hijo" in terms
+    assert "las" not in terms and "de" not in terms
+    assert "guarderia_hijo" in terms
+
+
+def test_exact_legal_terms_rank_first():
+    index = BM25Index.build(CHUNKS)
+    assert index.search("familia numerosa", k=1)[0][0] == 0
+    assert index.search("guarderías", k=1)[0][0] == 1
+    assert index.search("discapacidad igual o superior al 33", k=1)[0][0] == 2
+    assert index.search("término inexistente") == []
+
+
+def test_save_and_load_roundtrip(tmp_path):
+    index = BM25Index.build(CHUNKS)
+    index.save(tmp_path)
+    loaded = BM25Index.load(tmp_path)
+    assert loaded.search("alquiler vivienda", k=2) == index.search("alquiler vivienda", k=2)
+    assert BM25Index.load(tmp_path / "no-existe") is None
+
+
+def test_reciprocal_rank_fusion_rewards_agreement():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["b", "d", "e"]])
+    assert fused[0] == "b"
+    assert set(fused) == {"a", "b", "c", "d", "e"}
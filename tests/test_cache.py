@@ -0,0 +1,103 @@
+import time
+
+from app.cache import CachedQueryEmbeddings, SemanticAnswerCache, TTLCache, normalize_query
+
+
+class CountingEmbeddings:
+    def __init__(self):
+        self.calls = 0
+
+    def embed_query(self, text):
+        self.calls += 1
+        return [float(len(text))]
+
+
+def test_normalize_query():
+    assert normalize_query("  ¿Deducción por   alquiler en Madrid? ") == "deducción por alquiler en madrid"
+
+
+def test_lru_eviction_and_counters():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # expulsa "b", el menos usado
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"], stats["size"]) == (2, 1, 1, 2)
+
+
+def test_ttl_expiry():
+    cache = TTLCache(maxsize=2, ttl=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_repeated_queries_skip_embedding_service():
+    underlying = CountingEmbeddings()
+    embeddings = CachedQueryEmbeddings(underlying, TTLCache())
+    first = embeddings.embed_query("Nacimiento de hijos Valencia")
+    assert embeddings.embed_query("nacimiento de hijos  valencia?") == first
+    assert underlying.calls == 1
+
+
+def test_semantic_answer_cache_threshold_and_savings():
+    cache = SemanticAnswerCache(maxsize=4, threshold=0.95)
+    fingerprint = ("v1", "prompt", "model")
+    assert cache.lookup([1.0, 0.0], fingerprint) is None
+    cache.store("¿Deducción por alquiler en Madrid?", [1.0, 0.0], "Sí, hasta 1.000 €.", latency=4.0,
+                fingerprint=fingerprint)
+    assert cache.lookup([0.99, 0.05], fingerprint) == "Sí, hasta 1.000 €."  # casi idéntica
+    assert cache.lookup([0.6, 0.8], fingerprint) is None  # por debajo del umbral
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["saved_seconds"]) == (1, 2, 4.0)
+    assert stats["top_entries"][0]["hits"] == 1
+
+
+def test_semantic_answer_cache_lru_and_invalidation():
+    cache = SemanticAnswerCache(maxsize=2, threshold=0.95)
+    for i, vector in enumerate(([1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0])):
+        cache.store(f"q{i}", vector, f"a{i}", latency=1.0, fingerprint="v1")
+    assert cache.stats()["evictions"] == 1
+    assert cache.lookup([1.0, 0.0, 0.0], "v1") is None
+    assert cache.lookup([0.0, 0.0, 1.0], "v1") == "a2"
+    # Nuevo snapshot o nuevo prompt: nada de lo anterior es válido
+    assert cache.lookup([0.0, 0.0, 1.0], "v2") is None
+    assert cache.stats()["size"] == 0 and cache.stats()["invalidations"] == 1
+
+
+def test_semantic_answer_cache_never_shares_answers_across_scopes():
+    cache = SemanticAnswerCache(threshold=0.95)
+    cache.store("¿Deducción por alquiler en Madrid?", [1.0, 0.0], "Madrid: 30 %.", latency=3.0, fingerprint="v1",
+                scope=(("comunidad-madrid",), ()))
+    assert cache.lookup([1.0, 0.01], "v1", scope=(("comunitat-valenciana",), ())) is None
+    assert cache.lookup([1.0, 0.01], "v1", scope=(("comunidad-madrid",), ())) == "Madrid: 30 %."
+    cache.store("¿Deducción por alquiler en Valencia?", [1.0, 0.01], "Valencia: 20 %.", latency=3.0,
+                fingerprint="v1", scope=(("comunitat-valenciana",), ()))
+    assert cache.stats()["size"] == 2
+    assert cache.lookup([1.0, 0.0], "v1", scope=(("comunitat-valenciana",), ())) == "Valencia: 20 %."
+
+
+def test_answer_cache_scope_and_degraded_runs_are_not_stored():
+    from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+    from app.main import answer_cache_scope, cacheable_answer
+    from app.tools import DEGRADED_MESSAGES
+
+    madrid = answer_cache_scope("¿Cuánto se deduce por alquiler en Madrid?")
+    valencia = answer_cache_scope("¿Cuánto se deduce por alquiler en Valencia?")
+    assert madrid == (("comunidad-madrid",), ()) and valencia[0] == ("comunitat-valenciana",)
+    assert answer_cache_scope("¿Y con 2 hijos?") != answer_cache_scope("¿Y con 3 hijos?")
+
+    turn = [HumanMessage(content="¿Alquiler en Madrid?"), AIMessage(content="", tool_calls=[
+        {"name": "regional_tax_deductions_details", "args": {"query": "alquiler"}, "id": "c1"}])]
+    ok = turn + [ToolMessage(content="* [CCAA: Comunidad Madrid] 30 %", tool_call_id="c1"), AIMessage(content="30 %.")]
+    assert cacheable_answer(ok) == "30 %."
+    timed_out = turn + [ToolMessage(content=next(iter(DEGRADED_MESSAGES)), tool_call_id="c1"),
+                        AIMessage(content="No he podido consultarlo.")]
+    assert cacheable_answer(timed_out) is None
+    failed = turn + [ToolMessage(content="Error: boom", tool_call_id="c1", status="error"), AIMessage(content="Lo siento.")]
+    assert cacheable_answer(failed) is None
@@ -0,0 +1,47 @@
+import asyncio
+import sqlite3
+
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.prebuilt import create_react_agent
+
+from app.checkpoints import PooledSqliteSaver
+
+
+class AgentModel(GenericFakeChatModel):
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+
+def count(path, table, thread_id):
+    with sqlite3.connect(path) as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM {table} WHERE thread_id = ?", (thread_id,)).fetchone()[0]
+
+
+def test_retention_delete_and_sweep(tmp_path):
+    path = str(tmp_path / "memory.db")
+    answers = (AIMessage(content=f"respuesta {i}") for i in range(100))
+
+    async def run():
+        async with PooledSqliteSaver.open(path, pool_size=2, keep_last=3) as saver:
+            agent = create_react_agent(AgentModel(messages=answers), tools=[], checkpointer=saver)
+            for thread_id in ("a", "b"):
+                config = {"configurable": {"thread_id": thread_id}}
+                for i in range(6):
+                    await agent.ainvoke({"messages": [HumanMessage(content=f"pregunta {i}")]}, config)
+            state = await agent.aget_state({"configurable": {"thread_id": "a"}})
+            assert [m.content for m in state.values["messages"][-2:]] == ["pregunta 5", "respuesta 5"]
+            assert len(state.values["messages"]) == 12  # la retención no pierde historial
+            assert count(path, "checkpoints", "a") < 2 * 3
+
+            await saver.adelete_thread("a")
+            assert count(path, "checkpoints", "a") == count(path, "writes", "a") == 0
+            assert await agent.aget_state({"configurable": {"thread_id": "a"}}) is not None
+
+            assert await saver.sweep_idle_threads(ttl=3600) == 0
+            assert await saver.sweep_idle_threads(ttl=0) == 1
+            assert count(path, "checkpoints", "b") == 0
+
+    asyncio.run(run())
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
@@ -0,0 +1,67 @@
+import re
+
+import pytest
+from langchain.schema import Document
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+
+from ingest.chunking import SENTENCE_ENDINGS, Chunker, build_prefijo
+
+MAX_TOKENS_TOTAL = 60
+CHUNK_OVERLAP = 8
+META = {"ccaa": "Comunidad Madrid", "categoria": "Por arrendamiento de vivienda", "subapartado": "Requisitos"}
+SENTENCES = [
+    "Podrán aplicar la deducción los contribuyentes menores de 35 años.",
+    "La base estará constituida por las cantidades satisfechas en el período impositivo.",
+    "El límite será de 1.000 euros anuales por declaración.",
+    "Se exige que la vivienda sea la residencia habitual del contribuyente.",
+    "Deberá acreditarse el depósito de la fianza en el organismo competente.",
+    "La deducción es compatible con las demás deducciones autonómicas.",
+]
+TEXT = " ".join(SENTENCES * 3)
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    """Tokenizer "fast" local de una palabra o signo por token, sin descargar nada."""
+    corpus = TEXT + " " + build_prefijo(META)
+    vocab = {"[UNK]": 0}
+    for token in re.findall(r"\w+|[^\w\s]+", corpus):
+        vocab.setdefault(token, len(vocab))
+    backend = Tokenizer(models.WordLevel(vocab, unk_token="[UNK]"))
+    backend.pre_tokenizer = pre_tokenizers.Whitespace()
+    return PreTrainedTokenizerFast(tokenizer_object=backend, unk_token="[UNK]")
+
+
+@pytest.fixture(scope="module")
+def chunks(tokenizer):
+    chunker = Chunker(tokenizer, MAX_TOKENS_TOTAL, CHUNK_OVERLAP)
+    assert tokenizer.is_fast
+    return chunker.split_documents([Document(page_content=TEXT, metadata=META)])
+
+
+def body(chunk: Document) -> str:
+    return chunk.page_content.split("\n", 1)[1]
+
+
+def test_every_chunk_with_its_prefix_fits_the_token_budget(tokenizer, chunks):
+    assert len(chunks) > 3
+    for chunk in chunks:
+        assert chunk.page_content.startswith(build_prefijo(META) + "\n")
+        assert len(tokenizer.encode(chunk.page_content, add_special_tokens=False)) <= MAX_TOKENS_TOTAL
+    assert [c.metadata["chunk_index"] for c in chunks] == list(range(len(chunks)))
+
+
+def test_consecutive_chunks_overlap_by_about_chunk_overlap_tokens(tokenizer, chunks):
+    for previous, following in zip(chunks, chunks[1:]):
+        a, b = body(previous), body(following)
+        shared = max(n for n in range(len(b) + 1) if a.endswith(b[:n]))
+        overlap = len(tokenizer.encode(b[:shared], add_special_tokens=False))
+        # Se ajusta al inicio de palabra, así que puede quedar algún token por debajo
+        assert CHUNK_OVERLAP - 3 <= overlap <= CHUNK_OVERLAP
+
+
+def test_cuts_prefer_sentence_endings(chunks):
+    for chunk in chunks[:-1]:
+        assert body(chunk)[-1] in SENTENCE_ENDINGS
+    assert body(chunks[-1]).endswith(SENTENCES[-1])
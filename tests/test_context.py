@@ -0,0 +1,51 @@
+import pytest
+from langchain.docstore.document import Document
+
+import app.context as context
+from app.context import assemble_context, merge_overlapping
+from ingest.chunking import build_prefijo
+
+META = {"ccaa": "Comunidad Madrid", "categoria": "Por arrendamiento de vivienda", "subapartado": "Requisitos",
+        "ccaa_slug": "comunidad-madrid"}
+TEXT = ("Podrán aplicar la deducción los contribuyentes menores de 35 años que satisfagan alquiler de su vivienda "
+        "habitual. La base de la deducción estará constituida por las cantidades satisfechas en el período. "
+        "El límite de la deducción será de 1.000 euros anuales por declaración.")
+
+
+@pytest.fixture(autouse=True)
+def approximate_tokens(monkeypatch):
+    monkeypatch.setattr(context, "_tokenizer", False)  # ~4 caracteres por token, sin descargar el tokenizer
+
+
+def chunk(text, index, **metadata):
+    meta = {**META, **metadata, "chunk_index": index}
+    return Document(page_content=f"{build_prefijo(meta)}\n{text}", metadata=meta)
+
+
+def test_merge_overlapping_removes_repeated_text():
+    assert merge_overlapping(TEXT[:150], TEXT[100:]) == TEXT
+    assert merge_overlapping("Primer tramo.", "Otro texto distinto.") == "Primer tramo.\nOtro texto distinto."
+
+
+def test_adjacent_chunks_are_merged_under_one_prefix():
+    docs = [chunk(TEXT[100:], 1), chunk(TEXT[:150], 0),
+            chunk("Importe: 30 % de lo satisfecho.", 0, subapartado="Importe de la deducción")]
+    text, report = assemble_context(docs)
+    assert text.count("[Subapartado: Requisitos]") == 1
+    assert f"* {build_prefijo(META)}\n{TEXT}" in text
+    assert text.index("Requisitos") < text.index("Importe de la deducción")  # orden del ranking
+    assert report["groups"] == 2 and report["saved_tokens"] > 0 and not report["truncated"]
+
+
+def test_non_adjacent_chunks_keep_a_gap_and_duplicates_are_dropped():
+    docs = [chunk("Primer tramo del texto.", 0), chunk("Tercer tramo del texto.", 2), chunk("Primer tramo del texto.", 0)]
+    text, report = assemble_context(docs)
+    assert text.endswith("Primer tramo del texto.\n[...]\nTercer tramo del texto.")
+    assert report["chunks"] == 3 and report["groups"] == 1
+
+
+def test_context_is_trimmed_to_the_token_budget():
+    docs = [chunk(TEXT, 0, subapartado=f"Apartado {i}") for i in range(6)]
+    text, report = assemble_context(docs, budget=150)
+    assert report["truncated"] and report["tokens"] <= 150
+    assert text.endswith(" …")
@@ -0,0 +1,43 @@
+import sqlite3
+
+import faiss
+import numpy as np
+from langchain.docstore.document import Document
+
+from ingest.bm25 import BM25Index
+from ingest.docstore import DOCSTORE_FILE, SQLiteDocstore, write_docstore
+from ingest.load_faiss import PartitionedVectorStore
+
+META = {"ccaa": "Comunidad Madrid", "categoria": "Por arrendamiento de vivienda", "ccaa_slug": "comunidad-madrid"}
+CHUNKS = [
+    Document(page_content="Alquiler de vivienda habitual por menores de 35 años.", metadata=META),
+    Document(page_content="Límite de la deducción: 1.000 euros anuales.", metadata=META),
+    Document(page_content="Gastos educativos de escolaridad y uniformes.",
+             metadata={**META, "categoria": "Por gastos educativos"}),
+]
+
+
+def test_roundtrip_interns_metadata_and_keeps_order(tmp_path):
+    write_docstore(tmp_path, CHUNKS, [f"comunidad-madrid:{i}" for i in range(len(CHUNKS))])
+    with sqlite3.connect(tmp_path / DOCSTORE_FILE) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0] == 2
+    docstore = SQLiteDocstore(tmp_path / DOCSTORE_FILE)
+    assert len(docstore) == 3
+    docs = docstore.get_many([2, 0])
+    assert [d.page_content for d in docs] == [CHUNKS[2].page_content, CHUNKS[0].page_content]
+    assert docs[1].id == "comunidad-madrid:0" and docs[1].metadata == META
+    docs[1].metadata["ccaa"] = "otra"  # cada Document recibe su propia copia
+    assert docstore.get(0).metadata == META
+
+
+def test_partitioned_store_fetches_chunks_by_vector_position(tmp_path):
+    write_docstore(tmp_path, CHUNKS, [f"comunidad-madrid:{i}" for i in range(len(CHUNKS))])
+    vectors = np.eye(3, 4, dtype=np.float32)
+    index = faiss.IndexFlatL2(4)
+    index.add(vectors)
+    store = PartitionedVectorStore({"comunidad-madrid": index}, embeddings=None,
+                                   lexical={"comunidad-madrid": BM25Index.build([c.page_content for c in CHUNKS])},
+                                   docstores={"comunidad-madrid": SQLiteDocstore(tmp_path / DOCSTORE_FILE)})
+    doc, distance = store.similarity_search_with_score_by_vector(vectors[1].tolist(), k=1)[0]
+    assert doc.page_content == CHUNKS[1].page_content and distance == 0
+    assert store.lexical_search_with_score("gastos educativos", k=1)[0][0].metadata["categoria"] == "Por gastos educativos"
@@ -0,0 +1,69 @@
+import sqlite3
+
+from langchain_core.embeddings import Embeddings
+
+from ingest.embedding_cache import CachedEmbeddings
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.calls = 0
+        self.texts = []
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        self.texts.extend(texts)
+        return [[float(len(t)), float(sum(map(ord, t)) % 97)] for t in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+CHUNKS = ["[CCAA: Comunidad Madrid] Alquiler de vivienda.", "[CCAA: Galicia] Nacimiento de hijos.",
+          "[CCAA: Comunitat Valenciana] Donativos."]
+
+
+def rows(path) -> int:
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+def test_rerun_of_unchanged_chunks_makes_no_upstream_calls(tmp_path):
+    path = tmp_path / "embeddings.sqlite"
+    first = CountingEmbeddings()
+    vectors = CachedEmbeddings(first, model="nomic", path=path).embed_documents(CHUNKS)
+    assert first.calls == 1
+
+    # Nueva ejecución (otro proceso): mismo modelo y mismos textos, ni una llamada a Ollama
+    second = CountingEmbeddings()
+    cached = CachedEmbeddings(second, model="nomic", path=path)
+    assert cached.embed_documents(CHUNKS) == vectors
+    assert second.calls == 0 and (cached.hits, cached.misses) == (3, 0)
+
+    # Solo el chunk nuevo sale al modelo
+    cached.embed_documents(CHUNKS + ["[CCAA: Galicia] Gastos de guardería."])
+    assert second.texts == ["[CCAA: Galicia] Gastos de guardería."]
+
+
+def test_model_change_misses_the_cache(tmp_path):
+    path = tmp_path / "embeddings.sqlite"
+    CachedEmbeddings(CountingEmbeddings(), model="nomic", path=path).embed_documents(CHUNKS)
+    other = CountingEmbeddings()
+    cached = CachedEmbeddings(other, model="bge-m3", path=path)
+    cached.embed_documents(CHUNKS)
+    assert other.texts == CHUNKS and cached.misses == 3
+    assert rows(path) == 6  # una fila por (modelo, texto)
+
+
+def test_same_key_upserted_twice_keeps_one_row(tmp_path):
+    path = tmp_path / "embeddings.sqlite"
+    underlying = CountingEmbeddings()
+    cached = CachedEmbeddings(underlying, model="nomic", path=path)
+    cached.embed_documents([CHUNKS[0], CHUNKS[0]])  # repetido dentro del lote: se embebe una vez
+    assert underlying.texts == [CHUNKS[0]]
+
+    # Otro worker que consultó la caché antes de que se escribiera la fila vuelve a guardar la misma clave
+    concurrent = CachedEmbeddings(CountingEmbeddings(), model="nomic", path=path)
+    concurrent._lookup = lambda hashes: {}
+    concurrent.embed_documents([CHUNKS[0]])
+    assert rows(path) == 1
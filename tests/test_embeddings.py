@@ -0,0 +1,115 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from ingest.embeddings import OllamaBatchEmbeddings
+
+
+def fake_vector(text: str) -> list[float]:
+    return [float(len(text)), float(sum(map(ord, text)) % 97), 1.0]
+
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    """Imita `/api/embed` de Ollama: un vector determinista por texto y fallos 503 configurables."""
+    delay = 0.05
+    failures = 0
+    batch_sizes = []
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        cls = type(self)
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+            fail = cls.failures > 0
+            cls.failures -= int(fail)
+        try:
+            time.sleep(cls.delay)
+            if fail:
+                self.send_error(503)
+                return
+            texts = body["input"]
+            with cls.lock:
+                cls.batch_sizes.append(len(texts))
+            data = json.dumps({
+                "model": body["model"],
+                "embeddings": [fake_vector(t) for t in texts],
+                "prompt_eval_count": sum(len(t.split()) for t in texts),
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def base_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubOllamaHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def reset_handler():
+    StubOllamaHandler.failures = 0
+    StubOllamaHandler.batch_sizes = []
+    StubOllamaHandler.max_in_flight = 0
+
+
+def test_batches_and_bounded_concurrency(base_url):
+    embedder = OllamaBatchEmbeddings("stub", base_url=base_url, batch_size=4, max_concurrency=2)
+    texts = [f"deducción número {i}" for i in range(18)]
+    vectors = embedder.embed_documents(texts)
+    assert vectors == [fake_vector(t) for t in texts]
+    assert sorted(StubOllamaHandler.batch_sizes) == [2, 4, 4, 4, 4]
+    assert StubOllamaHandler.max_in_flight == 2
+    assert embedder.stats.requests == 5
+    assert embedder.stats.texts == 18
+    assert embedder.stats.tokens == 54
+    assert embedder.stats.texts_per_s > 0
+
+
+def test_retries_transient_errors(base_url):
+    StubOllamaHandler.failures = 2
+    embedder = OllamaBatchEmbeddings("stub", base_url=base_url, backoff_factor=0.01)
+    assert embedder.embed_query("alquiler en Madrid") == fake_vector("alquiler en Madrid")
+    assert StubOllamaHandler.failures == 0
+
+
+def test_async_api(base_url):
+    StubOllamaHandler.failures = 1
+    embedder = OllamaBatchEmbeddings("stub", base_url=base_url, batch_size=2, backoff_factor=0.01)
+
+    async def run():
+        docs = await embedder.aembed_documents(["a", "bb", "ccc"])
+        query = await embedder.aembed_query("guarderías")
+        return docs, query
+
+    docs, query = asyncio.run(run())
+    assert docs == [fake_vector(t) for t in ["a", "bb", "ccc"]]
+    assert query == fake_vector("guarderías")
+
+
+def test_client_of_a_previous_event_loop_is_closed(base_url):
+    embedder = OllamaBatchEmbeddings("stub", base_url=base_url)
+    asyncio.run(embedder.aembed_query("alquiler"))
+    stale = embedder._aclient
+    assert not stale.is_closed
+
+    # Nuevo event loop (otra llamada a asyncio.run): se crea otro cliente y se cierra el anterior
+    assert asyncio.run(embedder.aembed_query("hijos")) == fake_vector("hijos")
+    assert stale.is_closed and embedder._aclient is not stale
@@ -0,0 +1,66 @@
+import faiss
+import numpy as np
+import pytest
+
+from ingest.faiss_index import (INDEX_TYPES, apply_search_params, build_faiss_index, default_nlist, fit_index_type,
+                                read_index_meta, resolve_params, write_index_meta)
+from ingest.load_faiss import read_faiss_index
+
+PARAMS = {"m": 16, "ef_construction": 80, "ef_search": 40, "nlist": 16, "nprobe": 4, "pq_m": 8, "pq_nbits": 8}
+
+
+@pytest.fixture(scope="module")
+def vectors():
+    return np.random.default_rng(0).random((2000, 32), dtype=np.float32)
+
+
+def test_resolve_params_fills_defaults_and_rejects_unknown_types():
+    assert resolve_params("ivf_flat", {"nprobe": None}, 10_000) == {"nlist": default_nlist(10_000), "nprobe": 8}
+    assert resolve_params("flat", PARAMS, 100) == {}
+    with pytest.raises(ValueError):
+        resolve_params("lsh", None, 100)
+
+
+@pytest.mark.parametrize("index_type", INDEX_TYPES)
+@pytest.mark.parametrize("mmap", [True, False])
+def test_each_index_type_roundtrips_with_its_search_params(index_type, mmap, vectors, tmp_path):
+    index, params = build_faiss_index(vectors, index_type, PARAMS)
+    assert index.ntotal == len(vectors)
+    faiss.write_index(index, str(tmp_path / "index.faiss"))
+    written = write_index_meta(tmp_path, index_type, params, index.ntotal, vectors.shape[1])
+
+    meta = read_index_meta(tmp_path)
+    assert meta == written and meta["index_type"] == index_type and meta["params"] == params
+    loaded = read_faiss_index(tmp_path, mmap=mmap, index_type=index_type)
+    apply_search_params(loaded, meta["params"])
+
+    if index_type == "hnsw":
+        assert loaded.hnsw.efSearch == PARAMS["ef_search"]
+    if index_type.startswith("ivf"):
+        assert faiss.extract_index_ivf(loaded).nprobe == PARAMS["nprobe"]
+        assert faiss.extract_index_ivf(loaded).nlist == PARAMS["nlist"]
+    _, positions = loaded.search(vectors[:20], 5)
+    recall = np.mean([i in positions[i] for i in range(20)])
+    assert recall >= (0.5 if index_type == "ivf_pq" else 0.9)
+
+
+@pytest.mark.parametrize("index_type", ["ivf_flat", "ivf_pq"])
+def test_ivf_types_fit_a_realistic_partition_size(index_type):
+    vectors = np.random.default_rng(1).random((150, 32), dtype=np.float32)  # una CCAA típica
+    index, params = build_faiss_index(vectors, index_type)
+    assert index.ntotal == 150
+    ivf = faiss.extract_index_ivf(index)
+    assert params["nlist"] == ivf.nlist <= 150 // 39
+    assert params["nprobe"] == ivf.nprobe <= params["nlist"]
+    if index_type == "ivf_pq":
+        assert 2 ** params["pq_nbits"] <= 150 and params["pq_nbits"] == index.pq.nbits
+    _, positions = index.search(vectors[:20], 5)
+    assert np.mean([i in positions[i] for i in range(20)]) >= (0.5 if index_type == "ivf_pq" else 0.9)
+
+
+def test_tiny_partition_falls_back_to_flat_and_nprobe_is_clamped_on_load():
+    assert fit_index_type("ivf_pq", 11) == "flat" and fit_index_type("ivf_flat", 11) == "ivf_flat"
+    index, params = build_faiss_index(np.random.default_rng(2).random((11, 32), dtype=np.float32), "ivf_flat")
+    assert params == {"nlist": 1, "nprobe": 1}
+    apply_search_params(index, {"nprobe": 8})  # meta antiguo con nprobe mayor que nlist
+    assert faiss.extract_index_ivf(index).nprobe == 1
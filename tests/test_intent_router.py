@@ -0,0 +1,67 @@
+import asyncio
+import json
+
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.prebuilt import create_react_agent
+
+from app.intent_router import IntentRouter, fold
+from app.streaming import stream_direct_answer
+
+DEDUCCIONES = {
+    "comunidad-madrid": ["Por nacimiento o adopción de hijos", "Por arrendamiento de vivienda habitual"],
+    "comunitat-valenciana": ["Por nacimiento, adopción o acogimiento familiar"],
+    "comunidad-autonoma-andalucia": ["Por inversión en vivienda habitual protegida"],
+    "comunidad-autonoma-cataluna": [],
+}
+
+
+def test_fold_removes_accents_and_punctuation():
+    assert fold("¿Qué deducciones hay en Cataluña?") == "que deducciones hay en cataluna"
+
+
+def test_listing_questions_resolve_aliases_and_typos():
+    router = IntentRouter(DEDUCCIONES)
+    assert router.match("¿Qué deducciones hay en Madrid?") == ["comunidad-madrid"]
+    assert router.match("¿Cuáles son las deducciones de la Comunidad Valenciana?") == ["comunitat-valenciana"]
+    assert router.match("Dime las deducciones autonómicas de Andalucía y Valencia, por favor") == [
+        "comunidad-autonoma-andalucia", "comunitat-valenciana"]
+    assert router.match("que deducciones hay en madriz") == ["comunidad-madrid"]
+
+
+def test_ambiguous_or_specific_questions_fall_through():
+    router = IntentRouter(DEDUCCIONES)
+    assert router.match("¿Qué deducciones por alquiler hay en Madrid?") is None  # tema concreto
+    assert router.match("¿Cómo aplico la deducción por nacimiento en Madrid?") is None
+    assert router.match("¿Qué deducciones hay?") is None  # sin CCAA
+    assert router.match("¿Qué deducciones hay en Galicia?") is None  # CCAA sin datos cargados
+    assert router.match("¿Qué deducciones hay en Cataluña?") is None  # listado vacío: mejor que conteste el agente
+
+
+def test_route_answers_from_data_and_tracks_hit_rate():
+    router = IntentRouter(DEDUCCIONES)
+    answer = router.route("qué deducciones tiene madrid")
+    assert "**Comunidad de Madrid** (2 deducciones)" in answer
+    assert "- Por arrendamiento de vivienda habitual" in answer
+    assert router.route("¿Qué requisitos tiene la deducción por alquiler?") is None
+    assert router.stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_direct_answer_is_persisted_in_the_thread():
+    model = GenericFakeChatModel(messages=iter([AIMessage(content="Sí, la de alquiler.")]))
+    agent = create_react_agent(model, tools=[], checkpointer=InMemorySaver())
+    config = {"configurable": {"thread_id": "t1"}}
+    answer = IntentRouter(DEDUCCIONES).route("¿Qué deducciones hay en Madrid?")
+
+    async def run():
+        lines = [e async for e in stream_direct_answer(agent, "¿Qué deducciones hay en Madrid?", answer, config)]
+        followup = await agent.ainvoke({"messages": [("user", "¿Alguna de vivienda?")]}, config)
+        return lines, followup
+
+    lines, followup = asyncio.run(run())
+    out = [json.loads(line[len("data: "):]) for line in lines]
+    assert out[0] == {"token": answer}
+    assert out[-1]["event"] == "end" and out[-1]["source"] == "router"
+    assert [m.content for m in followup["messages"]] == [
+        "¿Qué deducciones hay en Madrid?", answer, "¿Alguna de vivienda?", "Sí, la de alquiler."]
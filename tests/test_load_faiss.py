@@ -0,0 +1,85 @@
+import faiss
+import numpy as np
+import pytest
+from langchain.docstore.document import Document
+
+from app.metrics import process_memory
+from ingest.bm25 import BM25Index
+from ingest.docstore import load_docstore, write_docstore
+from ingest.faiss_index import build_faiss_index, write_index_meta
+from ingest.load_faiss import PartitionedVectorStore, UnknownCCAAError, read_faiss_index
+
+
+def test_flat_index_is_file_backed_when_memory_mapped(tmp_path):
+    vectors = np.random.default_rng(0).random((40_000, 256), dtype=np.float32)  # ~40 MB
+    index, params = build_faiss_index(vectors, "flat")
+    faiss.write_index(index, str(tmp_path / "index.faiss"))
+    write_index_meta(tmp_path, "flat", params, index.ntotal, 256)
+    size = vectors.nbytes
+    del index, vectors
+
+    before = process_memory()
+    loaded = read_faiss_index(tmp_path, mmap=True, index_type="flat")
+    loaded.search(np.zeros((1, 256), dtype=np.float32), 5)  # recorre todos los vectores
+    after = process_memory()
+    assert loaded.ntotal == 40_000
+    assert after["file"] - before["file"] > 0.8 * size
+    assert after["anon"] - before["anon"] < 0.2 * size
+
+
+class FixedEmbeddings:
+    def __init__(self, vector):
+        self.vector = vector
+
+    def embed_query(self, text):
+        return self.vector
+
+
+def make_store(tmp_path, partitions: dict, query_vector=(0.0, 0.0)) -> PartitionedVectorStore:
+    """Particiones de prueba: {slug: [(texto, vector 2D)]}, con FAISS plano, docstore y BM25."""
+    indexes, lexical, docstores = {}, {}, {}
+    for slug, rows in partitions.items():
+        directory = tmp_path / slug
+        directory.mkdir()
+        index = faiss.IndexFlatL2(2)
+        index.add(np.array([v for _, v in rows], dtype=np.float32))
+        docs = [Document(page_content=text, metadata={"ccaa_slug": slug}) for text, _ in rows]
+        write_docstore(directory, docs, [f"{slug}-{i}" for i in range(len(rows))])
+        indexes[slug], lexical[slug], docstores[slug] = index, BM25Index.build([t for t, _ in rows]), load_docstore(directory)
+    return PartitionedVectorStore(indexes, FixedEmbeddings(list(query_vector)), lexical, docstores)
+
+
+def test_hybrid_search_ranks_across_partitions_by_relevance(tmp_path):
+    store = make_store(tmp_path, {
+        "comunidad-madrid": [("alquiler de vivienda para jóvenes", (0.1, 0.0)),
+                             ("alquiler de vivienda habitual", (0.2, 0.0)),
+                             ("alquiler vivienda jóvenes menores de 35", (0.3, 0.0))],
+        "comunitat-valenciana": [("donativos a entidades", (5.0, 5.0)), ("gastos de guardería", (6.0, 5.0))],
+        "galicia": [("nacimiento de hijos", (7.0, 7.0)), ("alquiler de local", (8.0, 8.0))],
+    })
+    docs = store.hybrid_search("alquiler de vivienda", k=3)
+    assert [d.metadata["ccaa_slug"] for d in docs] == ["comunidad-madrid"] * 3
+
+
+def test_merged_top_k_across_partitions_is_ordered_by_distance(tmp_path):
+    store = make_store(tmp_path, {
+        "galicia": [("a", (3.0, 0.0)), ("b", (0.5, 0.0))],
+        "aragon": [("c", (1.0, 0.0)), ("d", (9.0, 0.0))],
+        "cantabria": [("e", (2.0, 0.0))],
+    })
+    results = store.similarity_search_with_score_by_vector([0.0, 0.0], k=4)
+    assert [d.page_content for d, _ in results] == ["b", "c", "e", "a"]
+    scores = [s for _, s in results]
+    assert scores == sorted(scores)
+
+
+def test_unknown_slug_raises_key_error_listing_available_partitions(tmp_path):
+    store = make_store(tmp_path, {"galicia": [("a", (0.0, 0.0))], "aragon": [("b", (1.0, 0.0))]})
+    with pytest.raises(UnknownCCAAError, match="Slugs sin índice: murcia. Disponibles: aragon, galicia"):
+        store.similarity_search("alquiler", ccaa_slugs=["murcia", "galicia"])
+
+
+def test_legacy_unpartitioned_store_ignores_ccaa_filter(tmp_path):
+    store = make_store(tmp_path, {"todas": [("alquiler", (0.0, 0.0)), ("donativos", (1.0, 0.0))]})
+    docs = store.similarity_search("alquiler", k=2, ccaa_slugs=["galicia"])
+    assert [d.page_content for d in docs] == ["alquiler", "donativos"]
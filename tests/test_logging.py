@@ -0,0 +1,39 @@
+import json
+import logging
+import queue
+import sys
+
+from app.logging_config import JsonFormatter, LazyQueueHandler
+
+
+class Payload:
+    reprs = 0
+
+    def __repr__(self):
+        Payload.reprs += 1
+        return "<payload>"
+
+
+def record(msg, *args, **kwargs):
+    return logging.getLogger("test").makeRecord("test", logging.DEBUG, __file__, 1, msg, args, None, **kwargs)
+
+
+def test_json_formatter_includes_extra_fields_and_exception():
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        rec = logging.getLogger("test").makeRecord("test", logging.ERROR, __file__, 1, "fallo en %s", ("t1",),
+                                                   sys.exc_info(), extra={"thread_id": "t1"})
+    entry = json.loads(JsonFormatter().format(rec))
+    assert entry["message"] == "fallo en t1" and entry["level"] == "ERROR" and entry["thread_id"] == "t1"
+    assert "ValueError: boom" in entry["exc_info"]
+
+
+def test_queue_handler_defers_formatting_and_drops_when_full():
+    handler = LazyQueueHandler(queue.Queue(maxsize=1))
+    Payload.reprs = 0
+    handler.handle(record("chunk %r", Payload()))
+    handler.handle(record("chunk %r", Payload()))
+    assert Payload.reprs == 0  # el mensaje se construye en el listener, no en quien registra
+    assert handler.dropped == 1
+    assert handler.queue.get_nowait().getMessage() == "chunk <payload>"
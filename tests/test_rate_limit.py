@@ -0,0 +1,76 @@
+import asyncio
+import sqlite3
+import threading
+import time
+
+from fastapi import Depends, FastAPI, Request, Response
+from fastapi.testclient import TestClient
+
+from app.rate_limit import MemoryBackend, RateLimiter, SQLiteBackend
+
+
+def make_client(*limiters):
+    app = FastAPI()
+
+    @app.get("/limited", dependencies=[Depends(limiter) for limiter in limiters])
+    async def limited():
+        return {"ok": True}
+
+    return TestClient(app)
+
+
+def test_token_bucket_headers_and_retry_after():
+    client = make_client(RateLimiter(requests_limit=2, time_window=60, backend=MemoryBackend()))
+    first = client.get("/limited")
+    assert first.status_code == 200
+    assert first.headers["RateLimit-Limit"] == "2"
+    assert first.headers["RateLimit-Remaining"] == "1"
+    assert first.headers["RateLimit-Policy"] == "2;w=60"
+    assert client.get("/limited").headers["RateLimit-Remaining"] == "0"
+    blocked = client.get("/limited")
+    assert blocked.status_code == 429
+    assert 0 < int(blocked.headers["Retry-After"]) <= 30
+
+
+def test_most_restrictive_limiter_is_advertised():
+    client = make_client(RateLimiter(10, 60, backend=MemoryBackend()),
+                         RateLimiter(3, 60, limit_type="global_path", backend=MemoryBackend()))
+    assert client.get("/limited").headers["RateLimit-Limit"] == "3"
+
+
+def test_memory_backend_expires_full_buckets_lazily():
+    backend = MemoryBackend()
+    for i in range(100):
+        backend.take(f"ip:{i}", capacity=5, rate=1e6)  # se rellenan casi al instante
+    backend.take("ip:nuevo", capacity=5, rate=1e6)
+    assert len(backend) == 1
+
+
+def test_sqlite_backend_is_shared_between_workers(tmp_path):
+    path = str(tmp_path / "rate_limit.db")
+    worker_a, worker_b = SQLiteBackend(path), SQLiteBackend(path)
+    assert worker_a.take("global:/api/chat", capacity=2, rate=0.01)[0]
+    assert worker_b.take("global:/api/chat", capacity=2, rate=0.01)[0]
+    allowed, remaining, _ = worker_a.take("global:/api/chat", capacity=2, rate=0.01)
+    assert not allowed and remaining < 1
+
+
+def test_sqlite_backend_waits_for_the_lock_off_the_event_loop(tmp_path):
+    path = str(tmp_path / "rate_limit.db")
+    limiter = RateLimiter(5, 60, backend=SQLiteBackend(path))
+    blocker = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    blocker.execute("BEGIN IMMEDIATE")  # otro worker con la escritura tomada
+    threading.Timer(0.5, blocker.rollback).start()
+    request = Request({"type": "http", "method": "GET", "path": "/api/chat", "query_string": b"", "headers": [],
+                       "client": ("127.0.0.1", 1234), "server": ("testserver", 80), "scheme": "http"})
+
+    async def main():
+        check = asyncio.create_task(limiter(request, Response()))
+        start = time.perf_counter()
+        await asyncio.sleep(0.05)
+        tick = time.perf_counter() - start
+        return tick, await check
+
+    tick, allowed = asyncio.run(main())
+    assert tick < 0.3  # el event loop siguió atendiendo mientras el limitador esperaba
+    assert allowed
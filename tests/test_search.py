@@ -0,0 +1,119 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.search import SearchCache, TavilySearch
+
+
+class StubTavilyHandler(BaseHTTPRequestHandler):
+    """Imita `POST /search` de Tavily: un resultado por dominio permitido y un retardo configurable."""
+    delay = 0.0
+    requests = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        type(self).requests.append(body)
+        time.sleep(type(self).delay)
+        results = [{"title": f"{body['query']} ({domain})", "url": domain, "content": "Texto " * 10, "score": 0.9}
+                   for domain in body["include_domains"] or ["https://example.com/"]][:body["max_results"]]
+        data = json.dumps({"query": body["query"], "results": results}).encode()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # el cliente ya abandonó la petición por timeout
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def base_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubTavilyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def reset_handler():
+    StubTavilyHandler.delay = 0.0
+    StubTavilyHandler.requests = []
+
+
+def test_results_are_cached_by_normalized_query_and_domains(base_url, tmp_path):
+    search = TavilySearch(api_key="k", base_url=base_url, cache=SearchCache(tmp_path / "search.sqlite"))
+    domains = ["https://declarando.es/", "https://taxdown.es/"]
+
+    async def run():
+        first = await search.search("Deducción por alquiler", include_domains=domains)
+        again = await search.search("  deducción por ALQUILER? ", include_domains=list(reversed(domains)))
+        other = await search.search("Deducción por alquiler", include_domains=domains[:1])
+        await search.aclose()
+        return first, again, other
+
+    first, again, other = asyncio.run(run())
+    assert [r["url"] for r in first] == domains and again == first
+    assert len(other) == 1
+    assert len(StubTavilyHandler.requests) == 2  # la repetida no sale a la red
+    assert StubTavilyHandler.requests[0]["api_key"] == "k"
+
+
+def test_cache_persists_on_disk_and_expires(tmp_path):
+    cache = SearchCache(tmp_path / "search.sqlite", ttl=60)
+    cache.set("k", [{"title": "t", "url": "u", "content": "c"}])
+    assert SearchCache(tmp_path / "search.sqlite").get("k") == [{"title": "t", "url": "u", "content": "c"}]
+    start = time.perf_counter()
+    for _ in range(1000):
+        cache.get("k")
+    assert (time.perf_counter() - start) / 1000 < 1e-3
+    expired = SearchCache(tmp_path / "expired.sqlite", ttl=-1)
+    expired.set("k", [{"title": "t"}])
+    assert SearchCache(tmp_path / "expired.sqlite").get("k") is None
+
+
+def test_slow_provider_is_cut_at_the_timeout(base_url, tmp_path):
+    StubTavilyHandler.delay = 2.0
+    search = TavilySearch(api_key="k", base_url=base_url, timeout=0.2, cache=SearchCache(tmp_path / "search.sqlite"))
+
+    async def run():
+        start = time.perf_counter()
+        with pytest.raises(asyncio.TimeoutError):
+            await search.search("consulta lenta")
+        elapsed = time.perf_counter() - start
+        await search.aclose()
+        return elapsed
+
+    assert asyncio.run(run()) < 1.0
+
+
+def test_client_from_a_previous_event_loop_is_closed(base_url, tmp_path):
+    search = TavilySearch(api_key="k", base_url=base_url, cache=SearchCache(tmp_path / "search.sqlite"))
+    asyncio.run(search.search("primera consulta"))
+    first_client = search._client
+    asyncio.run(search.search("segunda consulta"))
+    assert first_client.is_closed and search._client is not first_client
+    asyncio.run(search.aclose())
+
+
+def test_disk_cache_is_read_and_written_off_the_event_loop(tmp_path, monkeypatch):
+    cache = SearchCache(tmp_path / "search.sqlite")
+    loop_thread = threading.get_ident()
+    threads = []
+    monkeypatch.setattr(cache, "_get_disk", lambda key: threads.append(threading.get_ident()))
+    monkeypatch.setattr(cache, "_set_disk", lambda key, results: threads.append(threading.get_ident()))
+
+    async def run():
+        assert await cache.aget("k") is None
+        await cache.aset("k", [{"title": "t"}])
+        assert await cache.aget("k") == [{"title": "t"}]  # acierto en memoria, sin salir del loop
+
+    asyncio.run(run())
+    assert len(threads) == 2 and loop_thread not in threads
@@ -0,0 +1,72 @@
+import faiss
+import numpy as np
+from langchain.docstore.document import Document
+
+from ingest.bm25 import BM25Index
+from ingest.docstore import write_docstore
+from ingest.load_faiss import load_vectorstore, partition_dir
+from ingest.snapshots import (CURRENT_FILE, current_version, link_tree, new_version, partition_files, prune_snapshots,
+                              publish, read_manifest, snapshot_path, staging_dir)
+
+SLUG = "comunidad-madrid"
+
+
+def build_partition(directory, texts):
+    directory.mkdir(parents=True, exist_ok=True)
+    index = faiss.IndexFlatL2(4)
+    index.add(np.eye(len(texts), 4, dtype=np.float32))
+    faiss.write_index(index, str(directory / "index.faiss"))
+    write_docstore(directory, [Document(page_content=t, metadata={"ccaa_slug": SLUG}) for t in texts],
+                   [f"{SLUG}:{i}" for i in range(len(texts))])
+    BM25Index.build(texts).save(directory)
+
+
+def make_snapshot(db_dir, version, texts):
+    staging = staging_dir(db_dir, version)
+    build_partition(partition_dir(staging, SLUG), texts)
+    return publish(db_dir, version, staging, {"embedding_model": "stub",
+                                              "partitions": {SLUG: {"n_chunks": len(texts)}}})
+
+
+def test_publish_moves_snapshot_and_points_current_to_it(tmp_path):
+    final = make_snapshot(tmp_path, "v1", ["alquiler", "hijos"])
+    assert final == snapshot_path(tmp_path, "v1") and final.exists()
+    assert (tmp_path / CURRENT_FILE).read_text() == "v1"
+    assert not any(p.name.startswith(".") for p in (tmp_path / "snapshots").iterdir())
+    manifest = read_manifest(final)
+    assert manifest["version"] == "v1" and manifest["partitions"][SLUG]["n_chunks"] == 2
+
+    make_snapshot(tmp_path, "v2", ["alquiler", "hijos", "donativos"])
+    assert current_version(tmp_path) == "v2"
+    assert read_manifest(snapshot_path(tmp_path, "v1"))["version"] == "v1"  # el anterior no se toca
+
+
+def test_load_vectorstore_follows_current(tmp_path):
+    build_partition(partition_dir(tmp_path, SLUG), ["antiguo"])  # layout sin snapshots
+    assert load_vectorstore(tmp_path, embeddings=object()).version is None
+    make_snapshot(tmp_path, "v1", ["alquiler", "hijos"])
+    store = load_vectorstore(tmp_path, embeddings=object())
+    assert store.version == "v1" and store.manifest["embedding_model"] == "stub"
+    assert store.partitions[SLUG].ntotal == 2
+
+
+def test_link_tree_reuses_files_of_previous_snapshot(tmp_path):
+    final = make_snapshot(tmp_path, "v1", ["alquiler"])
+    target = partition_dir(tmp_path / "otro", SLUG)
+    link_tree(partition_dir(final, SLUG), target)
+    assert partition_files(target) == partition_files(partition_dir(final, SLUG))
+    assert (target / "index.faiss").stat().st_ino == (partition_dir(final, SLUG) / "index.faiss").stat().st_ino
+
+
+def test_prune_keeps_latest_and_current(tmp_path):
+    for version in ("v1", "v2", "v3", "v4"):
+        make_snapshot(tmp_path, version, ["alquiler"])
+    (tmp_path / CURRENT_FILE).write_text("v1")  # rollback manual a una versión antigua
+    assert prune_snapshots(tmp_path, keep=2) == ["v2"]
+    assert sorted(p.name for p in (tmp_path / "snapshots").iterdir()) == ["v1", "v3", "v4"]
+
+
+def test_new_version_avoids_collisions(tmp_path):
+    version = new_version(tmp_path)
+    snapshot_path(tmp_path, version).mkdir(parents=True)
+    assert new_version(tmp_path).startswith(version) and new_version(tmp_path) != version
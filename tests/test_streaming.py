@@ -0,0 +1,89 @@
+import asyncio
+import json
+import time
+
+from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
+
+from app.streaming import SSE_BATCH_CHARS, SSEBatcher, stream_agent
+
+
+def events(lines):
+    return [json.loads(line[len("data: "):]) for line in lines]
+
+
+class ScriptedAgent:
+    """Reproduce una secuencia fija de (modo, chunk) como agent.astream(stream_mode=[...])."""
+
+    def __init__(self, items, delay=0.0):
+        self.items = items
+        self.delay = delay
+
+    async def astream(self, agent_input, config=None, stream_mode=None):
+        assert stream_mode == ["messages", "updates"]
+        for item in self.items:
+            await asyncio.sleep(self.delay)
+            yield item
+
+
+def test_batcher_flushes_by_size_and_time():
+    batcher = SSEBatcher(max_chars=5, max_delay=0.01)
+    assert batcher.add("ab") is None
+    assert events([batcher.add("cde")]) == [{"token": "abcde"}]
+    assert batcher.add("x") is None
+    time.sleep(0.02)
+    assert events([batcher.poll()]) == [{"token": "x"}]
+    assert batcher.flush() is None
+
+
+def test_stream_agent_tokens_tools_and_end():
+    call = {"name": "regional_tax_deductions_details", "args": {"query": "alquiler"}, "id": "c1"}
+    agent_meta = {"langgraph_node": "agent"}
+    items = [
+        ("messages", (AIMessageChunk(content="resumen", id="s"), {"langgraph_node": "pre_model_hook"})),
+        ("updates", {"agent": {"messages": [AIMessage(content="", tool_calls=[call], id="m1")]}}),
+        ("updates", {"tools": {"messages": [ToolMessage(content="* doc", name=call["name"], tool_call_id="c1")]}}),
+        ("messages", (AIMessageChunk(content="La ", id="m2"), agent_meta)),
+        ("messages", (AIMessageChunk(content="deducción ", id="m2"), agent_meta)),
+        ("messages", (AIMessageChunk(content="existe.", id="m2"), agent_meta)),
+        ("updates", {"agent": {"messages": [AIMessage(content="La deducción existe.", id="m2")]}}),
+    ]
+
+    async def run():
+        return [e async for e in stream_agent(ScriptedAgent(items), {}, {})]
+
+    out = events(asyncio.run(run()))
+    assert out[0] == {"event": "tool_start", "tool": call["name"], "id": "c1"}
+    assert out[1] == {"event": "tool_end", "tool": call["name"], "id": "c1", "status": "success"}
+    assert out[2] == {"token": "La "}  # el primer token no espera al lote
+    assert "".join(e.get("token", "") for e in out) == "La deducción existe."
+    assert out[-1]["event"] == "end" and out[-1]["ttft_ms"] is not None
+
+
+def test_stream_agent_without_token_streaming_sends_whole_message():
+    items = [("updates", {"agent": {"messages": [AIMessage(content="Respuesta completa", id="m1")]}})]
+
+    async def run():
+        return [e async for e in stream_agent(ScriptedAgent(items), {}, {})]
+
+    out = events(asyncio.run(run()))
+    assert out[0] == {"token": "Respuesta completa"}
+    assert out[-1]["event"] == "end"
+
+
+def test_stream_agent_long_first_token_is_sent_once():
+    long_token = "La deducción por alquiler de vivienda habitual existe en Madrid."
+    assert len(long_token) >= SSE_BATCH_CHARS
+    agent_meta = {"langgraph_node": "agent"}
+    items = [
+        ("messages", (AIMessageChunk(content=long_token, id="m1"), agent_meta)),
+        ("messages", (AIMessageChunk(content=" fin", id="m1"), agent_meta)),
+    ]
+
+    async def run():
+        return [e async for e in stream_agent(ScriptedAgent(items), {}, {})]
+
+    lines = asyncio.run(run())
+    assert all(isinstance(line, str) for line in lines)
+    out = events(lines)
+    assert out[0] == {"token": long_token}
+    assert "".join(e.get("token", "") for e in out) == long_token + " fin"
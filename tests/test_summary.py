@@ -0,0 +1,74 @@
+import asyncio
+from functools import partial
+from typing import Any
+
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.prebuilt import create_react_agent
+from langgraph.prebuilt.chat_agent_executor import AgentState, RunnableCallable
+from langmem.short_term import SummarizationNode
+
+from app.utils import BackgroundSummaries, acustom_summarize_llm_input, custom_summarize_llm_input, deferred_summarizer
+
+
+class State(AgentState):
+    context: dict[str, Any]
+
+
+class AgentModel(GenericFakeChatModel):
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+
+class AsyncOnlySummaryModel(GenericFakeChatModel):
+    calls: int = 0
+
+    def _generate(self, *args, **kwargs):
+        raise AssertionError("el resumen no debe llamar al modelo de forma síncrona")
+
+    async def _agenerate(self, *args, **kwargs):
+        self.calls += 1
+        return ChatResult(generations=[ChatGeneration(message=next(self.messages))])
+
+
+def test_summary_is_refreshed_in_background_not_inline():
+    answers = (AIMessage(content="respuesta larga " * 40) for _ in range(10))
+    summary_model = AsyncOnlySummaryModel(messages=(AIMessage(content=f"RESUMEN {i}") for i in range(10)))
+    node = SummarizationNode(token_counter=count_tokens_approximately, model=summary_model, max_tokens=600,
+                             max_tokens_before_summary=200, max_summary_tokens=64,
+                             input_messages_key="messages_to_summarize_input_key",
+                             output_messages_key="summarized_part_output_key")
+    hook = deferred_summarizer(node)
+    llm_inputs = []
+
+    async def spy(state, **kwargs):
+        update = await acustom_summarize_llm_input(state, **kwargs)
+        llm_inputs.append(update["llm_input_messages"])
+        return update
+
+    kwargs = {"internal_summarizer": hook, "n_last_messages": 1}
+    agent = create_react_agent(AgentModel(messages=answers), tools=[], state_schema=State, checkpointer=MemorySaver(),
+                               pre_model_hook=RunnableCallable(partial(custom_summarize_llm_input, **kwargs),
+                                                               partial(spy, **kwargs)))
+    background = BackgroundSummaries(agent, node)
+    config = {"configurable": {"thread_id": "t"}}
+
+    async def run():
+        for i in range(3):
+            await background.wait("t")
+            calls_before = summary_model.calls
+            await agent.ainvoke({"messages": [HumanMessage(content=f"pregunta {i}")]}, config)
+            assert summary_model.calls == calls_before  # nada de resúmenes en el camino crítico
+            background.schedule(config)
+        await background.wait("t")
+        return await agent.aget_state(config)
+
+    state = asyncio.run(run())
+    assert state.values["context"]["running_summary"].summary == "RESUMEN 0"
+    assert state.next == ()
+    # El tercer turno ya recibió el resumen en lugar del historial completo
+    assert "RESUMEN 0" in llm_inputs[-1][0].content
+    assert llm_inputs[-1][-1].content == "pregunta 2"
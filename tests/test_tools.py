@@ -0,0 +1,190 @@
+import asyncio
+import threading
+import time
+
+import faiss
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage
+from langgraph.prebuilt import ToolNode
+
+import app.context as context
+import app.tools as tools
+from app import metrics
+from ingest.bm25 import BM25Index
+from ingest.docstore import write_docstore
+from ingest.embeddings import EMBED_ENDPOINT
+from ingest.load_faiss import UnknownCCAAError, partition_dir
+from ingest.snapshots import publish, staging_dir
+
+
+class FakeEmbeddings:
+    async def aembed_query(self, text):
+        return [0.0]
+
+
+class SlowVectorStore:
+    version = "v1"
+    embeddings = FakeEmbeddings()
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def select_slugs(self, ccaa_slugs):
+        return ccaa_slugs
+
+    async def ahybrid_search(self, query, k=5, ccaa_slugs=None, embedding=None):
+        await asyncio.sleep(self.delay)
+        return [Document(page_content=f"{query} en {ccaa_slugs}")]
+
+
+@pytest.fixture(autouse=True)
+def approximate_tokens(monkeypatch):
+    monkeypatch.setattr(context, "_tokenizer", False)
+
+
+def call(name, args, call_id):
+    return {"name": name, "args": args, "id": call_id, "type": "tool_call"}
+
+
+def test_parallel_tool_calls_run_concurrently(monkeypatch):
+    monkeypatch.setattr(tools, "_vectorstore", SlowVectorStore(delay=0.3))
+    tools.retrieval_cache.clear()
+    node = ToolNode([tools.regional_tax_deductions_details, tools.list_regional_tax_deductions])
+    message = AIMessage(content="", tool_calls=[
+        call("regional_tax_deductions_details", {"query": "alquiler", "ccaa_slugs": "comunidad-madrid"}, "c1"),
+        call("regional_tax_deductions_details", {"query": "alquiler", "ccaa_slugs": "comunitat-valenciana"}, "c2"),
+        call("list_regional_tax_deductions", {"ccaa_slugs": "comunidad-madrid"}, "c3"),
+    ])
+    start = time.perf_counter()
+    out = asyncio.run(node.ainvoke({"messages": [message]}))["messages"]
+    assert time.perf_counter() - start < 0.55  # dos búsquedas de 0.3 s a la vez, no una detrás de otra
+    assert [m.tool_call_id for m in out] == ["c1", "c2", "c3"]
+    assert "comunitat-valenciana" in out[1].content
+
+
+def test_slow_tool_returns_degraded_message_and_records_latency(monkeypatch):
+    monkeypatch.setattr(tools, "_vectorstore", SlowVectorStore(delay=1.0))
+    monkeypatch.setitem(tools.TOOL_TIMEOUTS, "regional_tax_deductions_details", 0.1)
+    tools.retrieval_cache.clear()
+    before = metrics.snapshot()["tool_regional_tax_deductions_details_timeouts_total"]
+    start = time.perf_counter()
+    result = asyncio.run(tools.regional_tax_deductions_details.ainvoke({"query": "donativos"}))
+    assert time.perf_counter() - start < 0.5
+    assert result.startswith("La búsqueda de detalles no respondió a tiempo")
+    snapshot = metrics.snapshot()
+    assert snapshot["tool_regional_tax_deductions_details_timeouts_total"] == before + 1
+    assert snapshot["tool_regional_tax_deductions_details_seconds"]["count"] >= 1
+
+
+class BrokenEmbeddings:
+    async def aembed_query(self, text):
+        raise KeyError("embedding")
+
+
+class StrictVectorStore(SlowVectorStore):
+    embeddings = BrokenEmbeddings()
+
+    def select_slugs(self, ccaa_slugs):
+        if ccaa_slugs == "murcia":
+            raise UnknownCCAAError("Slugs sin índice: murcia. Disponibles: galicia")
+        return [ccaa_slugs]
+
+
+def test_only_unknown_ccaa_errors_are_returned_to_the_model(monkeypatch):
+    monkeypatch.setattr(tools, "_vectorstore", StrictVectorStore(delay=0))
+    tools.retrieval_cache.clear()
+    result = asyncio.run(tools.regional_tax_deductions_details.ainvoke({"query": "alquiler", "ccaa_slugs": "murcia"}))
+    assert result == "Slugs sin índice: murcia. Disponibles: galicia"
+    # Un KeyError de otra etapa (embedding, docstore, caché) no se disfraza de slug desconocido
+    with pytest.raises(KeyError, match="embedding"):
+        asyncio.run(tools.regional_tax_deductions_details.ainvoke({"query": "alquiler", "ccaa_slugs": "galicia"}))
+
+
+class StubOllamaEmbeddings:
+    def __init__(self, **kwargs):
+        pass
+
+    def embed_query(self, text):
+        return [1.0, 0.0, 0.0, 0.0]
+
+
+def publish_snapshot(db_dir, version, texts, **manifest):
+    staging = staging_dir(db_dir, version)
+    directory = partition_dir(staging, "galicia")
+    directory.mkdir(parents=True)
+    index = faiss.IndexFlatL2(4)
+    index.add(np.eye(len(texts), 4, dtype=np.float32))
+    faiss.write_index(index, str(directory / "index.faiss"))
+    write_docstore(directory, [Document(page_content=t, metadata={"ccaa_slug": "galicia"}) for t in texts],
+                   [f"galicia:{i}" for i in range(len(texts))])
+    BM25Index.build(texts).save(directory)
+    publish(db_dir, version, staging, {"embedding_model": None, "partitions": {"galicia": {"n_chunks": len(texts)}},
+                                       **manifest})
+
+
+def test_refresh_vectorstore_swaps_to_new_snapshot_while_old_one_keeps_serving(monkeypatch, tmp_path):
+    monkeypatch.setattr(tools, "DB_DIR", str(tmp_path))
+    monkeypatch.setattr(tools, "OllamaBatchEmbeddings", StubOllamaEmbeddings)
+    monkeypatch.setattr(tools, "_vectorstore", None)
+    publish_snapshot(tmp_path, "v1", ["alquiler v1"])
+    held = tools.get_vectorstore()  # una petición en curso que sigue usando v1
+    assert held.version == "v1"
+    assert tools.refresh_vectorstore() is False  # misma versión en disco: no recarga
+
+    publish_snapshot(tmp_path, "v2", ["alquiler v2", "hijos v2"])
+    tools.retrieval_cache.set("v1|consulta", "resultado antiguo")
+    assert tools.refresh_vectorstore() is True
+    assert tools.get_vectorstore().version == "v2"
+    assert tools.retrieval_cache.get("v1|consulta") is None
+    assert [d.page_content for d in held.similarity_search("alquiler", k=1)] == ["alquiler v1"]
+    assert [d.page_content for d in tools.get_vectorstore().similarity_search("alquiler", k=1)] == ["alquiler v2"]
+
+
+def test_get_vectorstore_does_not_wait_for_the_load_lock_once_loaded(monkeypatch):
+    store = SlowVectorStore(delay=0)
+    monkeypatch.setattr(tools, "_vectorstore", store)
+    locked, release = threading.Event(), threading.Event()
+
+    def loading():  # otro hilo cargando o sustituyendo el índice
+        with tools._lock:
+            locked.set()
+            release.wait(2)
+
+    holder = threading.Thread(target=loading)
+    holder.start()
+    locked.wait()
+    start = time.perf_counter()
+    assert tools.get_vectorstore() is store
+    elapsed = time.perf_counter() - start
+    release.set()
+    holder.join()
+    assert elapsed < 0.5
+
+
+def test_load_warns_when_index_was_not_built_with_normalised_embeddings(monkeypatch, tmp_path, capsys):
+    monkeypatch.setattr(tools, "DB_DIR", str(tmp_path))
+    monkeypatch.setattr(tools, "OllamaBatchEmbeddings", StubOllamaEmbeddings)
+    publish_snapshot(tmp_path, "v1", ["alquiler"])  # manifest sin embedding_endpoint: /api/embeddings
+    tools._load()
+    assert "re-run the ingestion" in capsys.readouterr().out
+
+    publish_snapshot(tmp_path, "v2", ["alquiler"], embedding_endpoint=EMBED_ENDPOINT)
+    assert tools._load().version == "v2"
+    assert "re-run the ingestion" not in capsys.readouterr().out
+
+
+def test_read_path_picks_up_new_snapshot_without_poller(monkeypatch, tmp_path):
+    monkeypatch.setattr(tools, "DB_DIR", str(tmp_path))
+    monkeypatch.setattr(tools, "OllamaBatchEmbeddings", StubOllamaEmbeddings)
+    monkeypatch.setattr(tools, "_vectorstore", None)
+    monkeypatch.setattr(tools, "INDEX_CHECK_INTERVAL", 60)
+    publish_snapshot(tmp_path, "v1", ["alquiler v1"])
+    assert tools.get_vectorstore().version == "v1"
+
+    publish_snapshot(tmp_path, "v2", ["alquiler v2"])  # reingesta con SNAPSHOT_POLL_INTERVAL=0
+    monkeypatch.setattr(tools, "_checked_at", time.monotonic())
+    assert asyncio.run(tools.aget_vectorstore()).version == "v1"  # dentro del intervalo no se mira el disco
+    monkeypatch.setattr(tools, "_checked_at", time.monotonic() - 61)
+    assert asyncio.run(tools.aget_vectorstore()).version == "v2"
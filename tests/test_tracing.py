@@ -0,0 +1,67 @@
+import asyncio
+import contextvars
+import re
+import time
+from uuid import uuid4
+
+from app import metrics, tracing
+
+
+def test_spans_feed_histogram_and_active_trace():
+    before = tracing.stage_histogram("test_stage").count
+
+    async def request():
+        trace = tracing.start_trace("chat", thread_id="t1")
+        with tracing.span("test_stage"):
+            await asyncio.sleep(0.01)
+        # Las etapas que corren en hilos o en otras tareas ven la misma traza
+        await asyncio.to_thread(tracing.observe, "test_stage", 0.02)
+        await asyncio.create_task(asyncio.to_thread(tracing.observe, "other_stage", 0.005))
+        trace.first_token()
+        trace.finish()
+        return trace
+
+    trace = asyncio.run(request())
+    breakdown = trace.breakdown()
+    assert breakdown["test_stage"]["count"] == 2 and breakdown["test_stage"]["ms"] >= 30
+    assert breakdown["other_stage"]["count"] == 1
+    assert trace.ttft is not None
+    assert tracing.stage_histogram("test_stage").count == before + 2
+    assert metrics.snapshot()["requests_in_flight"] == 0
+
+
+def test_span_without_trace_only_records_histogram():
+    ctx = contextvars.Context()
+    ctx.run(lambda: tracing.observe("untraced_stage", 0.1))
+    assert ctx.run(tracing.current_trace) is None
+    assert metrics.snapshot()["stage_untraced_stage_seconds"]["count"] == 1
+
+
+def test_callback_handler_splits_agent_and_summarizer_llm_calls():
+    trace = tracing.RequestTrace("chat")
+    handler = tracing.StageCallbackHandler(trace)
+    agent_run, summary_run = uuid4(), uuid4()
+    handler.on_chat_model_start({}, [], run_id=agent_run, metadata={"langgraph_node": "agent"})
+    handler.on_chat_model_start({}, [], run_id=summary_run, metadata={"langgraph_node": "pre_model_hook"})
+    time.sleep(0.01)
+    handler.on_llm_end(None, run_id=agent_run)
+    handler.on_llm_error(RuntimeError(), run_id=summary_run)
+    assert set(trace.breakdown()) == {"llm", "summarizer_llm"}
+    assert trace.breakdown()["llm"]["ms"] >= 10
+
+
+def test_render_prometheus_text_format():
+    hist = metrics.histogram("test_render_seconds", "Latencia\nde prueba", buckets=(0.1, 1.0))
+    hist.observe(0.05)
+    hist.observe(0.5)
+    hist.observe(3.0)
+    metrics.counter("test_render_total", fn=lambda: 7)
+    text = metrics.render_prometheus()
+    assert "# HELP test_render_seconds Latencia\\nde prueba\n# TYPE test_render_seconds histogram\n" in text
+    assert 'test_render_seconds_bucket{le="0.1"} 1\n' in text
+    assert 'test_render_seconds_bucket{le="1.0"} 2\n' in text
+    assert 'test_render_seconds_bucket{le="+Inf"} 3\n' in text
+    assert "test_render_seconds_count 3\n" in text
+    assert "# TYPE test_render_total counter\ntest_render_total 7\n" in text
+    sample = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{le="[^"]+"\})? \S+$')
+    assert all(line.startswith("# ") or sample.match(line) for line in text.splitlines())